@@ -49,6 +49,7 @@ setup(
         'pyramid_basemodel',
         'pyramid_hsts',
         'pyramid_layout',
+        'requests',
         'transaction',
         'zope.interface'
     ],
@@ -5,7 +5,11 @@ from pyramid.events import BeforeRender, ContextFound, NewRequest, NewResponse
 from pyramid.settings import asbool
 
 from .campaign import get_campaign_url
+from .csrf import get_csrf_exemptions
+from .csrf import get_csrf_token
 from .csrf import validate_against_csrf
+from .csrf import validate_csrf_settings
+from .executor import configure_executor
 from .flash import get_joined_flash
 from .flat import add_flatten_functions
 from .hsts import hsts_redirect_to_https
@@ -14,8 +18,12 @@ from .hsts import secure_application_url
 from .hsts import secure_resource_url
 from .hsts import secure_route_url
 from .i18n import add_underscore_translation
+from .namespace import add_template_namespace
+from .markdown import invalidate_markdown
 from .markdown import markdown_to_html
+from .markdown import prerender_markdown
 from .nav import add_is_active_function
+from .nav import register_navigation
 from .redirect import get_redirect_to
 from .seen import set_seen_cookie
 from .seen import get_has_been_seen
@@ -33,27 +41,45 @@ def includeme(config):
       Setup::
 
           >>> from mock import Mock
+          >>> from pyramid.registry import Registry
           >>> mock_config = Mock()
+          >>> mock_config.registry = Registry()
+          >>> mock_config.registry.settings = {}
           >>> includeme(mock_config)
 
       CSRF validation::
 
           >>> mock_config.add_subscriber.assert_any_call(validate_against_csrf,
           ...         ContextFound)
+          >>> from pyramid_weblayer.csrf import ICSRFExemptions
+          >>> mock_config.registry.queryUtility(ICSRFExemptions).__class__.__name__
+          'CSRFExemptions'
+          >>> mock_config.set_request_property.assert_any_call(get_csrf_token,
+          ...         'csrf_token', reify=True)
 
-      Provide `_` template namespace::
+      The signed CSRF mode requires a secret::
 
-          >>> mock_config.add_subscriber.assert_any_call(add_underscore_translation,
-          ...         BeforeRender)
-          >>> mock_config.add_subscriber.assert_any_call(add_is_active_function,
-          ...         BeforeRender)
+          >>> mock_config.registry.settings = {'csrf.mode': 'signed'}
+          >>> includeme(mock_config)
+          Traceback (most recent call last):
+          ...
+          ValueError: The signed CSRF mode requires a `csrf.secret`.
+          >>> mock_config.registry.settings = {}
 
-      Add flatten and snip functions to template namespace::
+      Provide the `_`, `is_active`, flatten and snip functions in the template
+      namespace, using a single subscriber::
 
-          >>> mock_config.add_subscriber.assert_any_call(add_flatten_functions,
-          ...         BeforeRender)
-          >>> mock_config.add_subscriber.assert_any_call(add_snip_functions,
+          >>> mock_config.add_subscriber.assert_any_call(add_template_namespace,
           ...         BeforeRender)
+          >>> subscribers = [args[0][0] for args in
+          ...         mock_config.add_subscriber.call_args_list]
+          >>> add_underscore_translation in subscribers
+          False
+
+      Register the site's navigation paths, to precompile ``is_active``::
+
+          >>> mock_config.add_directive.assert_any_call('register_navigation',
+          ...         register_navigation)
 
       Optionally force https::
 
@@ -63,6 +89,17 @@ def includeme(config):
           >>> includeme(mock_config)
           >>> mock_config.include.assert_any_call('pyramid_hsts')
 
+      Optionally configure the background executor::
+      
+          >>> from pyramid_weblayer import executor
+          >>> _original = executor._executor
+          >>> mock_config.registry.settings = {'background.max_workers': 2}
+          >>> includeme(mock_config)
+          >>> executor.get_executor().max_workers
+          2
+          >>> executor.get_executor().shutdown()
+          >>> executor._executor = _original
+      
       Has been seen flag.::
 
           >>> mock_config.add_subscriber.assert_any_call(set_seen_cookie,
@@ -84,6 +121,10 @@ def includeme(config):
 
           >>> mock_config.set_request_property.assert_any_call(markdown_to_html,
           ...         'markdown_to_html', reify=True)
+          >>> mock_config.add_request_method.assert_any_call(prerender_markdown,
+          ...         'prerender_markdown')
+          >>> mock_config.add_request_method.assert_any_call(invalidate_markdown,
+          ...         'invalidate_markdown')
 
       Track event::
 
@@ -98,26 +139,37 @@ def includeme(config):
 
       Scan::
 
-          >>> mock_config.scan.assert_called_with('pyramid_weblayer')
+          >>> mock_config.scan.assert_called_with('pyramid_weblayer',
+          ...         ignore=['pyramid_weblayer._async_queue'])
 
     """
 
-    # CSRF validation.
+    # CSRF validation, checking the settings and parsing the exempt routes
+    # and paths up front.
+    validate_csrf_settings(config.registry.settings)
+    get_csrf_exemptions(config.registry)
     config.add_subscriber(validate_against_csrf, ContextFound)
 
-    # Provide `_` template namespace.
-    config.add_subscriber(add_underscore_translation, BeforeRender)
-    config.add_subscriber(add_is_active_function, BeforeRender)
+    # Provide ``request.csrf_token``, from the session or a signed cookie.
+    config.set_request_property(get_csrf_token, 'csrf_token', reify=True)
 
-    # Add snip and flatten functions to the template namespace.
-    config.add_subscriber(add_flatten_functions, BeforeRender)
-    config.add_subscriber(add_snip_functions, BeforeRender)
+    # Provide `_`, `is_active` and the snip and flatten functions in the
+    # template namespace.
+    config.add_subscriber(add_template_namespace, BeforeRender)
+
+    # Provide ``config.register_navigation(paths)``.
+    config.add_directive('register_navigation', register_navigation)
 
     # Optionally force https://
     settings = config.registry.settings
     should_force_https = asbool(settings.get('hsts.force_https', False))
     if should_force_https:
         config.include('pyramid_hsts')
+    
+    # Optionally configure the bounded background executor used by
+    # ``call_in_background``.
+    if [k for k in settings if k.startswith('background.')]:
+        configure_executor(settings)
 
     # Has been seen flag.
     config.add_subscriber(set_seen_cookie, NewResponse)
@@ -135,6 +187,10 @@ def includeme(config):
     # Provide ``request.markdown_to_html``.
     config.set_request_property(markdown_to_html, 'markdown_to_html', reify=True)
 
+    # Provide ``request.prerender_markdown`` and ``request.invalidate_markdown``.
+    config.add_request_method(prerender_markdown, 'prerender_markdown')
+    config.add_request_method(invalidate_markdown, 'invalidate_markdown')
+
     # Provide ``request.redirect_to``.
     config.add_request_method(get_redirect_to, 'redirect_to')
 
@@ -148,5 +204,7 @@ def includeme(config):
     # Favicon and robots.txt.
     config.add_route('favicon_ico', 'favicon.ico')
     config.add_route('robots_txt', 'robots.txt')
-    config.scan('pyramid_weblayer')
+    # The ``asyncio`` queue processor is Python 3.5+ only, so don't import it
+    # when scanning.
+    config.scan('pyramid_weblayer', ignore=['pyramid_weblayer._async_queue'])
 
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""Provides an ``asyncio`` native ``AsyncQueueProcessor`` that consumes and
+  processes data from one or more redis channels, with the same channels,
+  handler and requeue contract as ``pyramid_weblayer.queue.QueueProcessor``.
+
+  Requires Python 3.5+ and a redis client whose commands are coroutines, e.g.
+  ``redis.asyncio.Redis``. Import it from ``pyramid_weblayer.queue``::
+
+      from pyramid_weblayer.queue import AsyncQueueProcessor
+
+      async def handle_data(data_str):
+          ...
+
+      processor = AsyncQueueProcessor(redis_client, ['channel1'], handle_data,
+              concurrency=20)
+
+  Run as a task on the current event loop::
+
+      task = processor.start()
+
+  Shutdown cancels the consuming task (rather than waiting for a blocking pop
+  to time out) and then waits for in flight handlers to finish::
+
+      await processor.stop()
+
+  The handler can be a coroutine function or a plain function. Up to
+  ``concurrency`` handlers run at once: no more messages are popped until
+  one of them finishes.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+import inspect
+
+class AsyncQueueProcessor(object):
+    """Consume data from a redis queue.  When it arrives, schedule a call to
+      ``self.handle_function``.
+    """
+
+    running = False
+
+    def __init__(self, redis_client, channels, handle_function, timeout=20,
+            should_requeue=False, concurrency=10):
+        self.redis = redis_client
+        self.channels = channels
+        self.handle_function = handle_function
+        self.timeout = timeout
+        self.should_requeue = should_requeue
+        self.concurrency = concurrency
+        self.slots = None
+        self.task = None
+        self.in_flight = set()
+
+    def start(self):
+        """Start consuming in a task on the current event loop and return it."""
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    async def stop(self, timeout=None):
+        """Cancel the consuming task and wait up to ``timeout`` seconds for in
+          flight handlers to finish.
+        """
+
+        logger.info('AsyncQueueProcessor.stop()')
+
+        task, self.task = self.task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.in_flight:
+            await asyncio.wait(list(self.in_flight), timeout=timeout)
+
+    async def run(self):
+        """Actually process the input queue(s) until cancelled."""
+
+        logger.info('AsyncQueueProcessor.start()')
+        logger.info(self.channels)
+
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.running = True
+        try:
+            while True:
+                # Apply backpressure: don't pop until a handler slot is free.
+                await self.slots.acquire()
+                try:
+                    return_value = await self.redis.blpop(self.channels,
+                            timeout=self.timeout)
+                except asyncio.CancelledError:
+                    self.slots.release()
+                    raise
+                except Exception as err:
+                    self.slots.release()
+                    logger.warning(err, exc_info=True)
+                    await asyncio.sleep(self.timeout)
+                    continue
+                if return_value is None:
+                    self.slots.release()
+                    continue
+                channel, body = return_value
+                handler = asyncio.ensure_future(self.handle(channel, body))
+                self.in_flight.add(handler)
+                handler.add_done_callback(self.in_flight.discard)
+        finally:
+            self.running = False
+
+    async def handle(self, channel, body):
+        """Call the handler, requeueing on error if ``self.should_requeue``."""
+
+        try:
+            return_value = self.handle_function(body)
+            if inspect.isawaitable(return_value):
+                await return_value
+        except Exception as err:
+            logger.warning(err, exc_info=True)
+            logger.warning((channel, body))
+            if self.should_requeue:
+                await self.redis.rpush(channel, body)
+        finally:
+            self.slots.release()
+
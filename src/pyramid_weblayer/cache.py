@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a small, thread safe, bounded ``LRUCache``, used to memoize hot
+  render path work, like rendering template snippets.
+"""
+
+__all__ = [
+    'LRUCache',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import threading
+
+_missing = object()
+
+class LRUCache(object):
+    """Map keys to values, evicting the least recently used entry once the
+      cache holds ``max_size`` entries.
+      
+      Setup::
+      
+          >>> cache = LRUCache(max_size=2)
+      
+      Get and set::
+      
+          >>> cache.get('a') is None
+          True
+          >>> cache.set('a', 1)
+          >>> cache.get('a')
+          1
+      
+      Evicts the least recently used entry::
+      
+          >>> cache.set('b', 2)
+          >>> _ = cache.get('a')
+          >>> cache.set('c', 3)
+          >>> 'b' in cache, 'a' in cache, len(cache)
+          (False, True, 2)
+      
+      Computes missing values on demand::
+      
+          >>> cache.get_or_set('d', lambda: 4)
+          4
+          >>> cache.get_or_set('d', lambda: 5)
+          4
+          >>> cache.stats()
+          {'hits': 3, 'misses': 2, 'size': 2}
+      
+    """
+    
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+    
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+    
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            self._data[key] = value
+            self._hits += 1
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    
+    def delete(self, key):
+        """Remove ``key``, if present.
+          
+              >>> cache = LRUCache()
+              >>> cache.set('a', 1)
+              >>> cache.delete('a')
+              >>> cache.delete('a')
+              >>> 'a' in cache
+              False
+          
+        """
+        
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def get_or_set(self, key, factory):
+        """Return the cached value for ``key`` or, if missing, call ``factory()``
+          and cache the result. The factory is called outside the lock, so
+          concurrent misses may each call it.
+        """
+        
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = factory()
+            self.set(key, value)
+        return value
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._data),
+            }
+    
+
+
@@ -4,34 +4,257 @@
 """Provides a ``validate_against_csrf`` ``pyramid.events.ContextFound`` subscriber
   that uses a ``CSRFValidator`` utility to validate incoming requests against
   cross site request forgeries.
+  
+  By default, the token is stored in the session. Set ``csrf.mode = signed``
+  to instead use stateless, *double submit* tokens: the token is signed
+  with ``csrf.secret``, expires after ``csrf.max_age`` seconds (allowing
+  for ``csrf.max_skew`` seconds of clock skew between nodes) and is sent
+  to the client in a cookie (``csrf.cookie_name``, defaulting to
+  ``csrf_token``), which each unsafe request must echo in the ``_csrf``
+  param or ``X-CSRFToken`` header. Validating it needs no session I/O, so
+  any node can validate any request.
+  
+  Either way, use ``request.csrf_token`` to get the current token.
 """
 
 __all__ = [
     'CSRFError',
+    'CSRFExemptions',
     'CSRFValidator',
+    'ICSRFExemptions',
     'METHODS_WITH_SIDE_EFFECTS',
+    'SignedCSRFValidator',
+    'get_csrf_exemptions',
+    'get_csrf_token',
+    'make_signed_token',
     'validate_against_csrf',
+    'validate_csrf_settings',
     'validate_session_authenticated',
+    'verify_signed_token',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
+import binascii
+import hashlib
+import hmac
+import os
+import re
+import time
+
 from pyramid.httpexceptions import HTTPUnauthorized
+from pyramid.renderers import render
 from pyramid.interfaces import IAuthenticationPolicy
 from pyramid.security import unauthenticated_userid
 from pyramid_layout.panel import panel_config
+from zope.interface import Interface
+
+from .cache import LRUCache
 
 METHODS_WITH_SIDE_EFFECTS = (
     'delete',
     'post', 
     'put',
 )
+UPPER_METHODS_WITH_SIDE_EFFECTS = [item.upper() for item in METHODS_WITH_SIDE_EFFECTS]
+
+CSRF_AJAX_SETUP_TEMPLATE = 'pyramid_weblayer:templates/csrf_ajax_setup.mako'
+# Rendered into the cached panel output in place of the token.
+CSRF_TOKEN_PLACEHOLDER = '__csrf_token_placeholder__'
+csrf_ajax_setup_cache = LRUCache(max_size=16)
+
+DEFAULT_COOKIE_NAME = 'csrf_token'
+DEFAULT_MAX_AGE = 60 * 60 * 24
+# Tolerate tokens issued by a node whose clock is up to this many seconds
+# ahead of the one verifying them.
+DEFAULT_MAX_SKEW = 30
 
 class CSRFError(ValueError):
     """Raised when csrf validation fails."""
 
 
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+def _glob_to_regex(pattern):
+    """Translate a path glob into a regular expression: ``**`` matches
+      anything, ``*`` and ``?`` match within a path segment and ``[...]``
+      matches a character class.
+      
+          >>> import re
+          >>> pattern = re.compile(_glob_to_regex('/hooks/*/v[12]/**') + '$')
+          >>> bool(pattern.match('/hooks/a/v1/b/c'))
+          True
+          >>> bool(pattern.match('/hooks/a/b/v1/c'))
+          False
+      
+    """
+    
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        char = pattern[i]
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[' and pattern.find(']', i + 1) > i + 1:
+            j = pattern.find(']', i + 1)
+            parts.append('[{0}]'.format(pattern[i + 1:j].replace('\\', '\\\\')))
+            i = j
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return ''.join(parts)
+
+class CSRFExemptions(object):
+    """Match requests against the routes and paths that are exempt from CSRF
+      validation, parsed once from the ``csrf.ignore_routes`` and
+      ``csrf.ignore_paths`` settings.
+      
+      Route names are looked up in a set. Paths are prefixes, looked up by
+      walking a character trie, so the cost of the check depends on the
+      length of the request path rather than the number of exemptions.
+      Routes and paths can also be glob patterns, which are compiled into a
+      single regular expression.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> exemptions = CSRFExemptions.from_settings({
+          ...     'csrf.ignore_routes': 'webhook api_*',
+          ...     'csrf.ignore_paths': '/hooks/ /api/v1/ /cb/*/notify',
+          ... })
+          >>> def make_request(path, route_name=None):
+          ...     request = Mock()
+          ...     request.path = path
+          ...     request.matched_route = None
+          ...     if route_name:
+          ...         request.matched_route = Mock()
+          ...         request.matched_route.name = route_name
+          ...     return request
+      
+      Matches route names and globs::
+      
+          >>> exemptions.matches(make_request('/a', 'webhook'))
+          True
+          >>> exemptions.matches(make_request('/a', 'api_users'))
+          True
+          >>> exemptions.matches(make_request('/a', 'users'))
+          False
+      
+      Matches path prefixes and globs::
+      
+          >>> exemptions.matches(make_request('/hooks/stripe'))
+          True
+          >>> exemptions.matches(make_request('/api/v1'))
+          False
+          >>> exemptions.matches(make_request('/cb/paypal/notify/123'))
+          True
+          >>> exemptions.matches(make_request('/cb/paypal/x/notify'))
+          False
+      
+    """
+    
+    def __init__(self, ignore_routes=None, ignore_paths=None):
+        self.routes = set()
+        self.route_pattern = None
+        self.trie = {}
+        self.path_pattern = None
+        route_globs = []
+        for name in ignore_routes or ():
+            if GLOB_CHARS.search(name):
+                route_globs.append(_glob_to_regex(name.replace('*', '**')))
+            else:
+                self.routes.add(name)
+        path_globs = []
+        for path in ignore_paths or ():
+            if GLOB_CHARS.search(path):
+                path_globs.append(_glob_to_regex(path))
+            else:
+                self._add_prefix(path)
+        if route_globs:
+            self.route_pattern = re.compile('(?:{0})$'.format('|'.join(route_globs)))
+        if path_globs:
+            self.path_pattern = re.compile('(?:{0})'.format('|'.join(path_globs)))
+    
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(ignore_routes=settings.get('csrf.ignore_routes', '').split(),
+                ignore_paths=settings.get('csrf.ignore_paths', '').split())
+    
+    def __nonzero__(self):
+        return bool(self.routes or self.route_pattern or self.trie or
+                self.path_pattern)
+    
+    __bool__ = __nonzero__
+    
+    def _add_prefix(self, path):
+        node = self.trie
+        for char in path:
+            node = node.setdefault(char, {})
+        node[None] = True
+    
+    def matches_route(self, name):
+        if name in self.routes:
+            return True
+        return bool(self.route_pattern and self.route_pattern.match(name))
+    
+    def matches_path(self, path):
+        node = self.trie
+        if node:
+            for char in path:
+                if None in node:
+                    return True
+                node = node.get(char)
+                if node is None:
+                    break
+            else:
+                if None in node:
+                    return True
+        return bool(self.path_pattern and self.path_pattern.match(path))
+    
+    def matches(self, request):
+        """Is the ``request`` exempt from CSRF validation?"""
+        
+        matched_route = request.matched_route
+        if matched_route and self.matches_route(matched_route.name):
+            return True
+        return self.matches_path(request.path)
+    
+
+
+class ICSRFExemptions(Interface):
+    """Marker interface for the registry's ``CSRFExemptions`` utility."""
+
+
+def get_csrf_exemptions(registry):
+    """Return the ``CSRFExemptions`` parsed from the registry's settings,
+      parsing them the first time and then registering them as a utility.
+      
+          >>> from pyramid.registry import Registry
+          >>> registry = Registry()
+          >>> registry.settings = {'csrf.ignore_paths': '/hooks/'}
+          >>> exemptions = get_csrf_exemptions(registry)
+          >>> exemptions.matches_path('/hooks/a')
+          True
+          >>> get_csrf_exemptions(registry) is exemptions
+          True
+          >>> registry.queryUtility(ICSRFExemptions) is exemptions
+          True
+      
+    """
+    
+    exemptions = registry.queryUtility(ICSRFExemptions)
+    if exemptions is None:
+        exemptions = CSRFExemptions.from_settings(registry.settings)
+        registry.registerUtility(exemptions, ICSRFExemptions)
+    return exemptions
+
 class CSRFValidator(object):
     """Validate a request against cross site request forgeries."""
     
@@ -49,14 +272,283 @@ class CSRFValidator(object):
     
 
 
-def validate_against_csrf(event, validator_cls=None):
-    """Event subscriber that uses the session to validate incoming requests."""
+def _to_bytes(value):
+    if isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+def _sign(secret, message):
+    digest = hmac.new(_to_bytes(secret), _to_bytes(message), hashlib.sha256)
+    return digest.hexdigest()
+
+def make_signed_token(secret, get_now=None, get_nonce=None):
+    """Return a token made from the current time and a random nonce, signed
+      with ``secret``.
+      
+          >>> token = make_signed_token('secret', get_now=lambda: 1000,
+          ...         get_nonce=lambda: 'abcd')
+          >>> token.split('.')[:2]
+          ['1000', 'abcd']
+          >>> len(token.split('.')[2])
+          64
+      
+    """
+    
+    if get_now is None:
+        get_now = time.time
+    if get_nonce is None:
+        get_nonce = lambda: binascii.hexlify(os.urandom(16)).decode('ascii')
+    
+    message = '{0}.{1}'.format(int(get_now()), get_nonce())
+    return '{0}.{1}'.format(message, _sign(secret, message))
+
+def verify_signed_token(secret, token, max_age=DEFAULT_MAX_AGE,
+        max_skew=DEFAULT_MAX_SKEW, get_now=None):
+    """Is ``token`` signed with ``secret`` and less than ``max_age`` seconds old?
+      Tokens from up to ``max_skew`` seconds in the future are accepted, as
+      the node that issued them may have a clock that's slightly ahead.
+      
+      Setup::
+      
+          >>> token = make_signed_token('secret', get_now=lambda: 1000)
+      
+      Valid tokens verify::
+      
+          >>> verify_signed_token('secret', token, get_now=lambda: 1060)
+          True
+          >>> verify_signed_token('secret', token, get_now=lambda: 990)
+          True
+      
+      Tokens that have been tampered with, were signed with another secret
+      or have expired don't::
+      
+          >>> verify_signed_token('secret', '2000' + token[4:],
+          ...         get_now=lambda: 1060)
+          False
+          >>> verify_signed_token('other', token, get_now=lambda: 1060)
+          False
+          >>> verify_signed_token('secret', token, max_age=30,
+          ...         get_now=lambda: 1060)
+          False
+          >>> verify_signed_token('secret', token, max_skew=5,
+          ...         get_now=lambda: 990)
+          False
+          >>> verify_signed_token('secret', 'garbage')
+          False
+      
+    """
+    
+    if get_now is None:
+        get_now = time.time
+    
+    try:
+        message, signature = token.rsplit('.', 1)
+        timestamp = int(message.split('.', 1)[0])
+    except (AttributeError, ValueError):
+        return False
+    expected = _sign(secret, message)
+    if not hmac.compare_digest(_to_bytes(expected), _to_bytes(signature)):
+        return False
+    return -max_skew <= get_now() - timestamp < max_age
+
+class SignedCSRFValidator(CSRFValidator):
+    """Validate a request against cross site request forgeries using a signed,
+      double submit token: the token submitted with the request must match
+      the one in the ``cookie_token`` and must have been signed with
+      ``secret`` less than ``max_age`` seconds ago.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> token = make_signed_token('secret')
+          >>> mock_request = Mock()
+          >>> mock_request.method = 'POST'
+          >>> mock_request.headers = {}
+      
+      Validates when the submitted token matches the cookie::
+      
+          >>> mock_request.params = {'_csrf': token}
+          >>> SignedCSRFValidator('secret', token).validate(mock_request)
+      
+      Fails when it doesn't, or when the token is forged::
+      
+          >>> other = make_signed_token('secret')
+          >>> SignedCSRFValidator('secret', other).validate(mock_request)
+          Traceback (most recent call last):
+          ...
+          CSRFError
+          >>> SignedCSRFValidator('forged', token).validate(mock_request)
+          Traceback (most recent call last):
+          ...
+          CSRFError
+      
+    """
+    
+    def __init__(self, secret, cookie_token, max_age=DEFAULT_MAX_AGE,
+            target_methods=METHODS_WITH_SIDE_EFFECTS, max_skew=DEFAULT_MAX_SKEW):
+        self._secret = secret
+        self._cookie_token = cookie_token
+        self._max_age = max_age
+        self._max_skew = max_skew
+        self._target_methods = target_methods
+    
+    def validate(self, request):
+        if not request.method.lower() in self._target_methods:
+            return
+        header_value = request.headers.get('X-CSRFToken', None)
+        token_value = request.params.get('_csrf', header_value)
+        if token_value is None or self._cookie_token is None:
+            raise CSRFError
+        if not hmac.compare_digest(_to_bytes(token_value),
+                _to_bytes(self._cookie_token)):
+            raise CSRFError
+        if not verify_signed_token(self._secret, token_value, self._max_age,
+                self._max_skew):
+            raise CSRFError
+    
+
+
+def validate_csrf_settings(settings):
+    """Check the CSRF settings once, at configuration time.
+      
+          >>> validate_csrf_settings({})
+          >>> validate_csrf_settings({'csrf.mode': 'signed', 'csrf.secret': 's'})
+          >>> validate_csrf_settings({'csrf.mode': 'signed'})
+          Traceback (most recent call last):
+          ...
+          ValueError: The signed CSRF mode requires a `csrf.secret`.
+      
+    """
+    
+    if settings.get('csrf.mode', 'session') != 'signed':
+        return
+    if not settings.get('csrf.secret'):
+        raise ValueError('The signed CSRF mode requires a `csrf.secret`.')
+
+def _get_signed_config(settings):
+    secret = settings['csrf.secret']
+    max_age = int(settings.get('csrf.max_age', DEFAULT_MAX_AGE))
+    max_skew = int(settings.get('csrf.max_skew', DEFAULT_MAX_SKEW))
+    cookie_name = settings.get('csrf.cookie_name', DEFAULT_COOKIE_NAME)
+    return secret, max_age, max_skew, cookie_name
+
+def get_csrf_token(request, make_token=None):
+    """Return the current CSRF token: by default, from the session. In the
+      signed mode, from the cookie, issuing a new token (and setting the
+      cookie) if it's missing, invalid or has expired.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_request = Mock()
+          >>> mock_request.session.get_csrf_token.return_value = 'token'
+      
+      Uses the session by default::
+      
+          >>> mock_request.registry.settings = {}
+          >>> get_csrf_token(mock_request)
+          'token'
+      
+      In the signed mode, uses a valid cookie::
+      
+          >>> mock_request.session.reset_mock()
+          >>> mock_request.registry.settings = {'csrf.mode': 'signed',
+          ...         'csrf.secret': 'secret'}
+          >>> token = make_signed_token('secret')
+          >>> mock_request.cookies = {'csrf_token': token}
+          >>> get_csrf_token(mock_request) == token
+          True
+          >>> mock_request.session.get_csrf_token.called
+          False
+      
+      Or issues a new one::
+      
+          >>> mock_request.cookies = {}
+          >>> get_csrf_token(mock_request, make_token=lambda secret: 'new')
+          'new'
+          >>> callback = mock_request.add_response_callback.call_args[0][0]
+          >>> mock_response = Mock()
+          >>> callback(mock_request, mock_response)
+          >>> mock_response.set_cookie.call_args[0]
+          ('csrf_token', 'new')
+      
+    """
+    
+    # Compose.
+    if make_token is None:
+        make_token = make_signed_token
+    
+    settings = request.registry.settings
+    if settings.get('csrf.mode', 'session') != 'signed':
+        return request.session.get_csrf_token()
+    
+    secret, max_age, max_skew, cookie_name = _get_signed_config(settings)
+    token = request.cookies.get(cookie_name)
+    if token and verify_signed_token(secret, token, max_age, max_skew):
+        return token
+    
+    token = make_token(secret)
+    def set_cookie(request, response):
+        response.set_cookie(cookie_name, token, max_age=max_age, path='/',
+                secure=request.scheme == 'https')
+    request.add_response_callback(set_cookie)
+    return token
+
+def validate_against_csrf(event, validator_cls=None, get_exemptions=None,
+        target_methods=METHODS_WITH_SIDE_EFFECTS, signed_validator_cls=None):
+    """Event subscriber that uses the session to validate incoming requests.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> from pyramid.registry import Registry
+          >>> mock_event = Mock()
+          >>> mock_event.request.registry = Registry()
+          >>> mock_event.request.registry.settings = {}
+          >>> mock_validator_cls = Mock()
+      
+      Requests with safe methods are let through without touching the session::
+      
+          >>> mock_event.request.method = 'GET'
+          >>> validate_against_csrf(mock_event, validator_cls=mock_validator_cls)
+          >>> mock_event.request.session.get_csrf_token.called
+          False
+      
+      Others are validated against the session token::
+      
+          >>> mock_event.request.method = 'POST'
+          >>> mock_event.request.path = '/'
+          >>> mock_event.request.session.get_csrf_token.return_value = 'token'
+          >>> validate_against_csrf(mock_event, validator_cls=mock_validator_cls)
+          >>> mock_validator_cls.assert_called_with('token',
+          ...         target_methods=METHODS_WITH_SIDE_EFFECTS)
+      
+      Or, in the signed mode, against the cookie, without using the session::
+      
+          >>> mock_event.request.session.reset_mock()
+          >>> mock_event.request.registry.settings = {'csrf.mode': 'signed',
+          ...         'csrf.secret': 'secret'}
+          >>> mock_event.request.cookies = {'csrf_token': 'cookie'}
+          >>> mock_signed_validator_cls = Mock()
+          >>> validate_against_csrf(mock_event,
+          ...         signed_validator_cls=mock_signed_validator_cls)
+          >>> mock_signed_validator_cls.assert_called_with('secret', 'cookie',
+          ...         max_age=86400, max_skew=30,
+          ...         target_methods=METHODS_WITH_SIDE_EFFECTS)
+          >>> mock_event.request.session.get_csrf_token.called
+          False
+      
+    """
     
     # logger.warn(('validate_against_csrf', event))
 
     # Compose.
     if validator_cls is None:
         validator_cls = CSRFValidator
+    if get_exemptions is None:
+        get_exemptions = get_csrf_exemptions
+    if signed_validator_cls is None:
+        signed_validator_cls = SignedCSRFValidator
     
     # Unpack.
     request = event.request
@@ -68,28 +560,29 @@ def validate_against_csrf(event, validator_cls=None):
     if not settings.get('csrf.validate', True):
         return
     
-    # logger.warn('B')
-    
-    # Ignore specified routes.
-    matched_route = request.matched_route
-    ignore_routes = settings.get('csrf.ignore_routes', None)
-    if matched_route and ignore_routes:
-        if matched_route.name in ignore_routes.split():
-            return
+    # Safe methods are never validated, so don't load the session (which can
+    # mean a round trip to the session backend) just to discard it.
+    if not request.method.lower() in target_methods:
+        return
     
-    # logger.warn('C')
+    # logger.warn('B')
     
-    # Ignore specified paths.
-    ignore_paths = settings.get('csrf.ignore_paths', None)
-    if ignore_paths:
-        for path in ignore_paths.split():
-            if request.path.startswith(path):
-                return
+    # Ignore specified routes and paths.
+    exemptions = get_exemptions(request.registry)
+    if exemptions and exemptions.matches(request):
+        return
     
     # logger.warn('D')
     
-    session_token = request.session.get_csrf_token()
-    csrf_validator = validator_cls(session_token)
+    if settings.get('csrf.mode', 'session') == 'signed':
+        secret, max_age, max_skew, cookie_name = _get_signed_config(settings)
+        csrf_validator = signed_validator_cls(secret,
+                request.cookies.get(cookie_name), max_age=max_age,
+                max_skew=max_skew, target_methods=target_methods)
+    else:
+        session_token = request.session.get_csrf_token()
+        csrf_validator = validator_cls(session_token,
+                target_methods=target_methods)
     
     # logger.warn(('session_token', session_token))
 
@@ -149,13 +642,65 @@ def validate_session_authenticated(event, unauth_userid=None, validate=None):
         validate(event)
 
 
-@panel_config('csrf-ajax-setup',
-        renderer='pyramid_weblayer:templates/csrf_ajax_setup.mako')
-def csrf_ajax_setup_panel(context, request):
-    """Pass the current CSRF token and target methods to the panel template."""
+@panel_config('csrf-ajax-setup', renderer=CSRF_AJAX_SETUP_TEMPLATE)
+def csrf_ajax_setup_panel(context, request, cache=None, render_template=None):
+    """Render the panel template with the current CSRF token and target
+      methods. The template is rendered once, with a placeholder in place of
+      the token, and memoized. The token (which, in the signed mode, is new
+      for most visitors) is then substituted into the cached output.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_request = Mock()
+          >>> mock_request.registry.settings = {}
+          >>> mock_request.csrf_token = 'token'
+          >>> mock_render = Mock()
+          >>> mock_render.side_effect = lambda spec, data, request=None: (
+          ...         u'<script>{0}</script>'.format(data['token']))
+          >>> cache = LRUCache()
+      
+      Renders the template the first time::
+      
+          >>> csrf_ajax_setup_panel(None, mock_request, cache=cache,
+          ...         render_template=mock_render)
+          u'<script>token</script>'
+          >>> mock_render.assert_called_with(CSRF_AJAX_SETUP_TEMPLATE,
+          ...         {'token': CSRF_TOKEN_PLACEHOLDER,
+          ...          'methods': ['DELETE', 'POST', 'PUT']},
+          ...         request=mock_request)
+      
+      And then uses the cache, whatever the token::
+      
+          >>> mock_request.csrf_token = 'other'
+          >>> csrf_ajax_setup_panel(None, mock_request, cache=cache,
+          ...         render_template=mock_render)
+          u'<script>other</script>'
+          >>> mock_render.call_count
+          1
+      
+    """
+    
+    # Compose.
+    if cache is None:
+        cache = csrf_ajax_setup_cache
+    if render_template is None:
+        render_template = render
+    
+    methods = UPPER_METHODS_WITH_SIDE_EFFECTS
+    def render_panel():
+        data = {
+            'token': CSRF_TOKEN_PLACEHOLDER,
+            'methods': methods,
+        }
+        return render_template(CSRF_AJAX_SETUP_TEMPLATE, data, request=request)
+    output = cache.get_or_set((CSRF_AJAX_SETUP_TEMPLATE, tuple(methods)),
+            render_panel)
+    
+    # Use the request's (reified) token, so a newly issued signed token is
+    # the same one that's embedded in forms and set in the cookie.
+    token = request.csrf_token
     
-    return {
-        'token': request.session.get_csrf_token(), 
-        'methods': [item.upper() for item in METHODS_WITH_SIDE_EFFECTS]
-    }
+    # Returning a string bypasses the panel renderer.
+    return output.replace(CSRF_TOKEN_PLACEHOLDER, token)
 
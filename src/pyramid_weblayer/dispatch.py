@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a ``TrackingDispatcher`` that buffers google analytics hits in
+  memory and sends them in batches from a single background thread over a
+  pooled, keep-alive http connection.
+
+  Tracking a hit is then just an append to a buffer: the cost of building the
+  ``__utm.gif`` request and sending it is paid by the dispatcher thread, and
+  the number of outbound connections no longer grows with page traffic.
+
+  Configure using the ``track.*`` settings, e.g.::
+
+      track.batch_size = 20
+      track.flush_interval = 1.0
+      track.max_buffer_size = 10000
+      track.endpoint = http://localhost:8080/__utm.gif
+
+  The ``track.endpoint`` setting overrides the google analytics endpoint,
+  e.g. to point at a local http stand-in when benchmarking.
+"""
+
+__all__ = [
+    'TrackingDispatcher',
+    'get_dispatcher',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import atexit
+import collections
+import threading
+import time
+
+import requests as requests_lib
+
+from pyga.requests import EventRequest
+from pyga.requests import PageViewRequest
+
+DEFAULTS = {
+    'track.batch_size': 20,
+    'track.flush_interval': 1.0,
+    'track.max_buffer_size': 10000,
+    'track.pool_size': 2,
+    'track.timeout': 5.0,
+    'track.endpoint': None,
+}
+
+# Headers pyga sets that requests works out for itself: ``Content-Length``
+# (which pyga sets as an int) and ``Host`` (which is wrong when the
+# ``endpoint`` is overridden).
+DROPPED_HEADERS = (
+    'content-length',
+    'host',
+)
+
+class TrackingDispatcher(object):
+    """Buffer pyga requests and send them in batches from a background thread.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_session = Mock()
+          >>> mock_hit = Mock()
+          >>> mock_hit.build_http_request.return_value.get_full_url.return_value = (
+          ...         'http://ga/__utm.gif?utmn=1')
+          >>> mock_hit.build_http_request.return_value.get_data.return_value = None
+          >>> mock_hit.build_http_request.return_value.header_items.return_value = [
+          ...         ('User-agent', 'ua')]
+          >>> dispatcher = TrackingDispatcher(batch_size=2, session=mock_session)
+
+      Enqueuing is just an append to the buffer::
+
+          >>> dispatcher.enqueue(mock_hit)
+          True
+          >>> len(dispatcher.buffer)
+          1
+          >>> mock_session.get.called
+          False
+
+      Hits are sent when the buffer is flushed::
+
+          >>> dispatcher.flush()
+          1
+          >>> mock_session.get.assert_called_with('http://ga/__utm.gif?utmn=1',
+          ...         headers={'User-agent': 'ua'}, timeout=5.0)
+          >>> dispatcher.stats()['sent']
+          1
+
+      The endpoint can be overriden, e.g.: to point to a local stand-in::
+
+          >>> dispatcher.endpoint = 'http://localhost:8080/__utm.gif'
+          >>> _ = dispatcher.enqueue(mock_hit)
+          >>> dispatcher.flush()
+          1
+          >>> mock_session.get.assert_called_with(
+          ...         'http://localhost:8080/__utm.gif?utmn=1',
+          ...         headers={'User-agent': 'ua'}, timeout=5.0)
+
+      When the buffer is full, hits are dropped::
+
+          >>> dispatcher.max_buffer_size = 1
+          >>> dispatcher.enqueue(mock_hit)
+          True
+          >>> dispatcher.enqueue(mock_hit)
+          False
+          >>> dispatcher.stats()['dropped']
+          1
+
+    """
+
+    def __init__(self, batch_size=20, flush_interval=1.0, max_buffer_size=10000,
+            pool_size=2, timeout=5.0, endpoint=None, session=None,
+            thread_cls=None):
+        """Initialise the buffer. The flush thread is started lazily."""
+
+        # Compose.
+        if session is None:
+            session = requests_lib.Session()
+            adapter = requests_lib.adapters.HTTPAdapter(pool_connections=pool_size,
+                    pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        if thread_cls is None:
+            thread_cls = threading.Thread
+
+        # Assign.
+        self.batch_size = int(batch_size)
+        self.flush_interval = float(flush_interval)
+        self.max_buffer_size = int(max_buffer_size)
+        self.timeout = float(timeout)
+        self.endpoint = endpoint
+        self.session = session
+        self.thread_cls = thread_cls
+
+        # Internal state.
+        self.buffer = collections.deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._is_running = False
+        self._sent = 0
+        self._failed = 0
+        self._dropped = 0
+
+    def track_event(self, tracker, event, session, visitor):
+        """Queue the equivalent of ``tracker.track_event(event, session, visitor)``."""
+
+        event.validate()
+        hit = EventRequest(config=tracker.config, tracker=tracker,
+                visitor=visitor, session=session, event=event)
+        return self.enqueue(hit)
+
+    def track_pageview(self, tracker, page, session, visitor):
+        """Queue the equivalent of ``tracker.track_pageview(page, session, visitor)``."""
+
+        hit = PageViewRequest(config=tracker.config, tracker=tracker,
+                visitor=visitor, session=session, page=page)
+        return self.enqueue(hit)
+
+    def enqueue(self, hit):
+        """Add a pyga request to the buffer. Returns ``False`` if it was dropped."""
+
+        with self._condition:
+            if len(self.buffer) >= self.max_buffer_size:
+                self._dropped += 1
+                return False
+            self.buffer.append(hit)
+            if len(self.buffer) >= self.batch_size:
+                self._condition.notify()
+        return True
+
+    def flush(self):
+        """Send everything that's currently buffered. Returns the number of
+          hits sent.
+        """
+
+        with self._condition:
+            batch = list(self.buffer)
+            self.buffer.clear()
+        sent = 0
+        for hit in batch:
+            if self.send(hit):
+                sent += 1
+        return sent
+
+    def send(self, hit):
+        """Build the http request for a single hit and send it over the pooled
+          session. Returns ``True`` if the hit was sent.
+        """
+
+        try:
+            http_request = hit.build_http_request()
+            url = http_request.get_full_url()
+            if self.endpoint:
+                url = self.endpoint + url[len(url.split('?')[0]):]
+            data = http_request.get_data()
+            headers = dict((k, v) for k, v in http_request.header_items()
+                    if k.lower() not in DROPPED_HEADERS)
+            if data is None:
+                r = self.session.get(url, headers=headers, timeout=self.timeout)
+            else:
+                r = self.session.post(url, data=data, headers=headers,
+                        timeout=self.timeout)
+            # Read the (tiny) response so the connection is returned to the pool.
+            r.content
+        except Exception as err:
+            logger.warn(err, exc_info=True)
+            with self._condition:
+                self._failed += 1
+            return False
+        with self._condition:
+            self._sent += 1
+        return True
+
+    def start(self):
+        """Start the background flush thread, unless already running."""
+
+        with self._condition:
+            if self._is_running:
+                return
+            self._is_running = True
+            self._thread = self.thread_cls(target=self._run)
+            self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the flush thread, sending whatever is still buffered."""
+
+        with self._condition:
+            if not self._is_running:
+                return
+            self._is_running = False
+            self._condition.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        """Return a dict of counters describing the dispatcher's activity."""
+
+        with self._condition:
+            return {
+                'buffered': len(self.buffer),
+                'sent': self._sent,
+                'failed': self._failed,
+                'dropped': self._dropped,
+            }
+
+    def _run(self):
+        """Flush when the buffer reaches ``batch_size`` or every
+          ``flush_interval`` seconds, whichever comes first.
+        """
+
+        while True:
+            deadline = time.time() + self.flush_interval
+            with self._condition:
+                while self._is_running and len(self.buffer) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                is_running = self._is_running
+            self.flush()
+            if not is_running:
+                break
+
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher(settings, factory=None):
+    """Return the process wide dispatcher, creating and starting one configured
+      from the ``track.*`` ``settings`` if necessary.
+
+          >>> from mock import Mock
+          >>> from pyramid_weblayer import dispatch
+          >>> _original = dispatch._dispatcher
+          >>> dispatch._dispatcher = None
+          >>> mock_factory = Mock()
+
+      Creates and starts the dispatcher once::
+
+          >>> dispatcher = get_dispatcher({'track.batch_size': '5'},
+          ...         factory=mock_factory)
+          >>> mock_factory.assert_called_with(batch_size=5, flush_interval=1.0,
+          ...         max_buffer_size=10000, pool_size=2, timeout=5.0,
+          ...         endpoint=None)
+          >>> dispatcher.start.called
+          True
+          >>> get_dispatcher({}, factory=mock_factory) is dispatcher
+          True
+          >>> mock_factory.call_count
+          1
+
+      Teardown::
+
+          >>> dispatch._dispatcher = _original
+
+    """
+
+    global _dispatcher
+
+    if factory is None:
+        factory = TrackingDispatcher
+
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            config = DEFAULTS.copy()
+            config.update(settings)
+            _dispatcher = factory(
+                batch_size=int(config['track.batch_size']),
+                flush_interval=float(config['track.flush_interval']),
+                max_buffer_size=int(config['track.max_buffer_size']),
+                pool_size=int(config['track.pool_size']),
+                timeout=float(config['track.timeout']),
+                endpoint=config['track.endpoint'],
+            )
+            _dispatcher.start()
+        return _dispatcher
+
+
+def _stop_at_exit():
+    """Send any buffered hits when the interpreter exits."""
+
+    if _dispatcher is not None:
+        _dispatcher.stop(timeout=5)
+
+atexit.register(_stop_at_exit)
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a process wide, bounded ``BackgroundExecutor`` that runs fire and
+  forget function calls on a fixed size pool of worker threads.
+
+  Jobs are held in a bounded queue. When the queue is full, the ``overflow``
+  policy decides what happens to new jobs:
+
+  - ``drop``: discard the job (and count it)
+  - ``block``: wait up to ``block_timeout`` seconds for a free slot, then drop
+  - ``inline``: run the job in the calling thread
+
+  Configure using the ``background.*`` settings, e.g.::
+
+      background.max_workers = 10
+      background.max_queue_size = 1000
+      background.overflow = drop
+"""
+
+__all__ = [
+    'BackgroundExecutor',
+    'configure_executor',
+    'get_executor',
+    'OVERFLOW_POLICIES',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import atexit
+import threading
+
+try: # py2
+    import Queue as queue_lib
+except ImportError: # py3
+    import queue as queue_lib
+
+DEFAULTS = {
+    'background.max_workers': 10,
+    'background.max_queue_size': 1000,
+    'background.overflow': 'drop',
+    'background.block_timeout': 1.0,
+}
+
+OVERFLOW_POLICIES = (
+    'block',
+    'drop',
+    'inline',
+)
+
+# Sentinel that tells a worker thread to exit.
+_STOP = object()
+
+class BackgroundExecutor(object):
+    """Run ``target(*args, **kwargs)`` calls on a bounded pool of daemon threads.
+
+      Setup::
+
+          >>> executor = BackgroundExecutor(max_workers=2, max_queue_size=10)
+          >>> results = []
+
+      Submitted jobs are run by the worker threads::
+
+          >>> executor.submit(results.append, args=('a',))
+          True
+          >>> executor.shutdown()
+          >>> results
+          ['a']
+
+      Once shutdown, jobs are refused::
+
+          >>> executor.submit(results.append, args=('c',))
+          False
+          >>> executor.stats()['dropped']
+          1
+
+      The overflow policy must be one of ``OVERFLOW_POLICIES``::
+
+          >>> BackgroundExecutor(overflow='explode')
+          Traceback (most recent call last):
+          ...
+          ValueError: Invalid overflow policy: explode
+
+    """
+
+    def __init__(self, max_workers=10, max_queue_size=1000, overflow='drop',
+            block_timeout=1.0, thread_cls=None, queue_cls=None):
+        """Initialise the queue and counters. Worker threads are started lazily."""
+
+        # Compose.
+        if thread_cls is None:
+            thread_cls = threading.Thread
+        if queue_cls is None:
+            queue_cls = queue_lib.Queue
+
+        # Validate.
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Invalid overflow policy: {0}'.format(overflow))
+
+        # Assign.
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue_size = int(max_queue_size)
+        self.overflow = overflow
+        self.block_timeout = float(block_timeout)
+        self.thread_cls = thread_cls
+        self.queue = queue_cls(self.max_queue_size)
+
+        # Internal state.
+        self._lock = threading.Lock()
+        self._submitted = threading.Condition(self._lock)
+        self._submitting = 0
+        self._workers = []
+        self._idle = 0
+        self._running = 0
+        self._completed = 0
+        self._dropped = 0
+        self._failed = 0
+        self._is_shutdown = False
+
+    def submit(self, target, args=None, kwargs=None):
+        """Queue ``target(*args, **kwargs)`` to be called in a worker thread.
+
+          Returns ``True`` if the job was queued or run inline and ``False``
+          if it was dropped.
+        """
+
+        if args is None:
+            args = ()
+        if kwargs is None:
+            kwargs = {}
+        job = (target, args, kwargs)
+
+        # Check for shutdown under the lock and count the job as being
+        # submitted until it's queued, so ``shutdown`` can't queue the stop
+        # sentinels (and the workers exit) before it.
+        with self._lock:
+            is_shutdown = self._is_shutdown
+            if not is_shutdown:
+                self._submitting += 1
+        if is_shutdown:
+            return self._drop(job)
+
+        is_full = False
+        try:
+            self._ensure_worker()
+            if self.overflow == 'block':
+                self.queue.put(job, True, self.block_timeout)
+            else:
+                self.queue.put_nowait(job)
+        except queue_lib.Full:
+            is_full = True
+        finally:
+            with self._lock:
+                self._submitting -= 1
+                self._submitted.notify_all()
+
+        if is_full:
+            if self.overflow == 'inline':
+                self._run(job)
+                return True
+            return self._drop(job)
+        return True
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stop accepting jobs and tell the workers to exit once they've drained
+          the queue. If ``wait`` is true, block until they have.
+        """
+
+        with self._lock:
+            if self._is_shutdown:
+                workers = []
+            else:
+                self._is_shutdown = True
+                # Let jobs that are part way through being submitted get
+                # queued ahead of the sentinels.
+                while self._submitting:
+                    self._submitted.wait()
+                workers = list(self._workers)
+
+        # Workers exit when they reach the sentinel, i.e.: after running
+        # the jobs that are already queued.
+        for _ in workers:
+            self.queue.put(_STOP)
+        if wait:
+            for worker in workers:
+                worker.join(timeout)
+
+    def stats(self):
+        """Return a dict of counters describing the executor's activity."""
+
+        with self._lock:
+            return {
+                'workers': len(self._workers),
+                'queued': self.queue.qsize(),
+                'running': self._running,
+                'completed': self._completed,
+                'failed': self._failed,
+                'dropped': self._dropped,
+            }
+
+    def _ensure_worker(self):
+        """Start a new worker thread iff there are at least as many queued jobs
+          as idle workers (i.e.: the job about to be queued wouldn't be picked
+          up straight away) and we have capacity for more.
+        """
+
+        with self._lock:
+            if len(self._workers) >= self.max_workers:
+                return
+            if self.queue.qsize() < self._idle:
+                return
+            worker = self.thread_cls(target=self._work)
+            worker.daemon = True
+            self._workers.append(worker)
+            self._idle += 1
+        worker.start()
+
+    def _work(self):
+        """Worker thread loop: run jobs until told to stop."""
+
+        while True:
+            job = self.queue.get()
+            if job is _STOP:
+                break
+            with self._lock:
+                self._idle -= 1
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    self._idle += 1
+
+    def _run(self, job):
+        """Call the job, keeping count and logging any errors."""
+
+        target, args, kwargs = job
+        with self._lock:
+            self._running += 1
+        try:
+            target(*args, **kwargs)
+        except Exception as err:
+            logger.warn(err, exc_info=True)
+            with self._lock:
+                self._failed += 1
+        else:
+            with self._lock:
+                self._completed += 1
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _drop(self, job):
+        """Discard the job."""
+
+        logger.warning('BackgroundExecutor dropped job %r', job[0])
+        with self._lock:
+            self._dropped += 1
+        return False
+
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor(factory=None):
+    """Return the process wide executor, creating one with the default
+      configuration if necessary.
+
+          >>> from mock import Mock
+          >>> from pyramid_weblayer import executor as executor_module
+          >>> _original = executor_module._executor
+          >>> executor_module._executor = None
+          >>> mock_factory = Mock()
+          >>> mock_factory.return_value = '<executor>'
+
+      Creates the executor once::
+
+          >>> get_executor(factory=mock_factory)
+          '<executor>'
+          >>> get_executor(factory=mock_factory)
+          '<executor>'
+          >>> mock_factory.call_count
+          1
+
+      Teardown::
+
+          >>> executor_module._executor = _original
+
+    """
+
+    global _executor
+
+    if factory is None:
+        factory = BackgroundExecutor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = factory()
+        return _executor
+
+def configure_executor(settings, factory=None):
+    """Replace the process wide executor with one configured from the
+      ``background.*`` ``settings``, draining the existing executor.
+
+          >>> from mock import Mock
+          >>> from pyramid_weblayer import executor as executor_module
+          >>> _original = executor_module._executor
+          >>> executor_module._executor = None
+          >>> mock_factory = Mock()
+
+      Uses the settings, falling back on the defaults::
+
+          >>> executor = configure_executor({'background.max_workers': '4'},
+          ...         factory=mock_factory)
+          >>> mock_factory.assert_called_with(max_workers=4, max_queue_size=1000,
+          ...         overflow='drop', block_timeout=1.0)
+          >>> executor is executor_module._executor
+          True
+
+      Drains the previous executor::
+
+          >>> executor = configure_executor({}, factory=mock_factory)
+          >>> mock_factory.return_value.shutdown.assert_called_with(wait=True)
+
+      Teardown::
+
+          >>> executor_module._executor = _original
+
+    """
+
+    global _executor
+
+    if factory is None:
+        factory = BackgroundExecutor
+
+    # Read the config.
+    config = DEFAULTS.copy()
+    config.update(settings)
+    kwargs = {
+        'max_workers': int(config['background.max_workers']),
+        'max_queue_size': int(config['background.max_queue_size']),
+        'overflow': config['background.overflow'].strip(),
+        'block_timeout': float(config['background.block_timeout']),
+    }
+
+    # Swap in the new executor.
+    with _executor_lock:
+        previous = _executor
+        _executor = factory(**kwargs)
+        current = _executor
+    if previous is not None:
+        previous.shutdown(wait=True)
+    return current
+
+
+def _shutdown_at_exit():
+    """Drain the process wide executor when the interpreter exits."""
+
+    if _executor is not None:
+        _executor.shutdown(wait=True, timeout=5)
+
+atexit.register(_shutdown_at_exit)
@@ -5,23 +5,30 @@
 __all__ = [
     'add_flat_string',
     'as_flat_string',
-    'flatten_breadcrumb'
+    'as_flat_strings',
+    'flatten_breadcrumb',
+    'flatten_breadcrumbs',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
-import html2text
+from .htmltext import get_engine
+from .htmltext import map_items
 
 def as_flat_string(markup, to_string=None):
-    """Convert html to text and replace all whitespace with single spaces."""
+    """Convert html to text and replace all whitespace with single spaces.
+      
+          >>> as_flat_string(u'<p>Hello</p>\\n<p><em>you</em></p>')
+          u'Hello _you_'
+          >>> as_flat_string(u'  no   markup ')
+          u'no markup'
+      
+    """
     
     # Compose.
     if to_string is None:
-        handler = html2text.HTML2Text()
-        handler.ignore_links = True
-        handler.ignore_images = True
-        to_string = handler.handle
+        to_string = get_engine().convert
     
     if not markup:
         return markup
@@ -43,8 +50,27 @@ def flatten_breadcrumb(markup, to_string=None):
     s = s.replace('* ', '').replace('/', '-')
     return s
 
+def as_flat_strings(markups, pool=None):
+    """Flatten a list of ``markups``, optionally fanning out across a ``pool``
+      (see ``pyramid_weblayer.htmltext.map_items``).
+      
+          >>> as_flat_strings([u'<p>a</p> <p>b</p>', u'c  d'])
+          [u'a b', u'c d']
+      
+    """
+    
+    return map_items(as_flat_string, markups, pool=pool)
+
+def flatten_breadcrumbs(markups, pool=None):
+    """Flatten a list of breadcrumb ``markups``."""
+    
+    return map_items(flatten_breadcrumb, markups, pool=pool)
+
 def add_flatten_functions(event, flat_string=None, flatten_crumb=None):
-    """Add ``flat_string`` & ``flatten_breadcrumb`` to the tempate namespace."""
+    """Add ``flat_string`` & ``flatten_breadcrumb``, and their bulk
+      ``flat_strings`` & ``flatten_breadcrumbs`` variants, to the tempate
+      namespace.
+    """
     
     if flat_string is None:
         flat_string = as_flat_string
@@ -53,4 +79,6 @@ def add_flatten_functions(event, flat_string=None, flatten_crumb=None):
     
     event['flat_string'] = flat_string
     event['flatten_breadcrumb'] = flatten_breadcrumb
+    event['flat_strings'] = as_flat_strings
+    event['flatten_breadcrumbs'] = flatten_breadcrumbs
 
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a shared, thread safe ``HTMLToText`` engine that converts html
+  to text using ``html2text``, used by the snip and flatten functions.
+  
+  Converted text is memoized in an LRU cache keyed by a hash of the html,
+  so listing pages that snip the same content over and over only convert
+  it once. Input that contains no markup skips ``html2text`` altogether.
+"""
+
+__all__ = [
+    'HTMLToText',
+    'get_engine',
+    'map_items',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import functools
+import hashlib
+
+import html2text
+
+from .cache import LRUCache
+
+# If the input has none of these, there's no markup to convert.
+MARKUP_CHARS = ('<', '&')
+
+# ``html2text`` writes non breaking spaces as this placeholder and replaces
+# them when the handler is closed.
+NBSP_PLACEHOLDER = '&nbsp_place_holder;'
+
+class HTMLToText(object):
+    """Convert html to text, memoizing the results.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_handler_cls = Mock()
+          >>> mock_handler_cls.return_value.handle.return_value = u'_text_'
+          >>> engine = HTMLToText(handler_cls=mock_handler_cls)
+      
+      Converts html using a new, configured ``html2text`` handler::
+      
+          >>> engine.convert(u'<em>text</em>')
+          u'_text_'
+          >>> mock_handler_cls.return_value.ignore_links
+          True
+      
+      The result is cached::
+      
+          >>> engine.convert(u'<em>text</em>')
+          u'_text_'
+          >>> mock_handler_cls.call_count
+          1
+      
+      Text without markup is returned as is::
+      
+          >>> engine.convert(u'just text')
+          u'just text'
+          >>> mock_handler_cls.call_count
+          1
+      
+      Works for real::
+      
+          >>> HTMLToText().convert('Hello <em>you</em> &amp; <a href="/">me</a>')
+          u'Hello _you_ & me\\n\\n'
+      
+    """
+    
+    def __init__(self, ignore_links=True, ignore_images=True, cache_size=2048,
+            handler_cls=None):
+        if handler_cls is None:
+            handler_cls = html2text.HTML2Text
+        self.ignore_links = ignore_links
+        self.ignore_images = ignore_images
+        self.handler_cls = handler_cls
+        self.cache = LRUCache(max_size=cache_size)
+    
+    def convert(self, html):
+        """Return ``html`` converted to text."""
+        
+        if not html:
+            return html
+        if not [char for char in MARKUP_CHARS if char in html]:
+            return html
+        data = html.encode('utf-8') if isinstance(html, type(u'')) else html
+        key = hashlib.sha1(data).digest()
+        text = self.cache.get(key)
+        if text is None:
+            text = self._convert(html)
+            self.cache.set(key, text)
+        return text
+    
+    def convert_prefix(self, html, n, chunk_size=2048):
+        """Return the start of ``html`` converted to text, containing at least
+          ``n`` non whitespace characters (or all of it, if it's shorter).
+          
+          The html is fed to the parser in chunks and parsing stops as soon
+          as enough text has been produced, so the cost depends on ``n``
+          rather than the size of the document.
+          
+              >>> engine = HTMLToText()
+              >>> html = u'<p>Hello <em>you</em>.</p>' * 10000
+              >>> text = engine.convert_prefix(html, 20, chunk_size=100)
+              >>> text.split()[:4]
+              [u'Hello', u'_you_.', u'Hello', u'_you_.']
+              >>> len(text) < 1000
+              True
+          
+        """
+        
+        if not html:
+            return html
+        if not [char for char in MARKUP_CHARS if char in html]:
+            return html
+        data = html.encode('utf-8') if isinstance(html, type(u'')) else html
+        key = (hashlib.sha1(data).digest(), n)
+        text = self.cache.get(key)
+        if text is None:
+            text = self._convert_prefix(html, n, chunk_size)
+            self.cache.set(key, text)
+        return text
+    
+    def _convert_prefix(self, html, n, chunk_size):
+        handler = self._get_handler()
+        
+        # Count the text as it's written, via the handler's public ``out``
+        # hook, rather than reading its internal buffer.
+        state = {'count': 0}
+        write = handler.out
+        def out(piece):
+            state['count'] += len(''.join(piece.replace(NBSP_PLACEHOLDER,
+                    ' ').split()))
+            write(piece)
+        handler.out = out
+        
+        start = 0
+        while start < len(html) and state['count'] < n:
+            # End chunks at the end of a tag, as ``html2text`` treats text
+            # that's split across feeds as separate words.
+            end = html.find('>', start + chunk_size - 1) + 1 or len(html)
+            handler.feed(html[start:end])
+            start = end
+        handler.feed('')
+        # ``html2text`` >= 2020 returns the text from ``finish()`` (its
+        # ``close()`` returns ``None``), older versions from ``close()``.
+        finish = getattr(handler, 'finish', None) or handler.close
+        return handler.optwrap(finish())
+    
+    def _get_handler(self):
+        # ``html2text`` handlers are stateful and can't be reused, so each
+        # conversion gets its own.
+        handler = self.handler_cls()
+        handler.ignore_links = self.ignore_links
+        handler.ignore_images = self.ignore_images
+        return handler
+    
+    def _convert(self, html):
+        return self._get_handler().handle(html)
+    
+
+
+_engine = HTMLToText()
+
+def get_engine():
+    """Return the process wide ``HTMLToText`` engine."""
+    
+    return _engine
+
+
+def map_items(func, items, pool=None, min_pool_items=100, **kwargs):
+    """Return ``[func(item, **kwargs) for item in items]``, using ``pool.map``
+      (e.g.: a ``multiprocessing.Pool`` or ``multiprocessing.pool.ThreadPool``)
+      if provided and there are at least ``min_pool_items`` items. Used by
+      the bulk snip and flatten functions.
+      
+      Process pools need ``func`` to be a module level function.
+      
+          >>> from mock import Mock
+          >>> mock_pool = Mock()
+          >>> map_items(len, ['a', 'bb'], pool=mock_pool)
+          [1, 2]
+          >>> mock_pool.map.called
+          False
+          >>> _ = map_items(len, ['a', 'bb'], pool=mock_pool, min_pool_items=2)
+          >>> mock_pool.map.called
+          True
+      
+    """
+    
+    items = list(items)
+    if pool is not None and len(items) >= min_pool_items:
+        if kwargs:
+            func = functools.partial(func, **kwargs)
+        return pool.map(func, items)
+    return [func(item, **kwargs) for item in items]
@@ -4,9 +4,21 @@
 """Provides an ``add_underscore_translation`` ``pyramid.events.BeforeRender``
   subscriber that adds a ``_`` translation function to the template global
   namespace.
+  
+  Translated strings are memoized in a process wide, bounded LRU cache,
+  keyed by locale, domain and message id. Cache entries are tied to the
+  localizer's translations, so they're ignored when the catalog is
+  reloaded. Call ``clear_translation_cache()`` to empty the cache.
 """
 
-from pyramid.i18n import get_localizer, TranslationStringFactory
+from pyramid.i18n import get_localizer, TranslationString, TranslationStringFactory
+
+from .cache import LRUCache
+
+translation_cache = LRUCache(max_size=10000)
+
+def clear_translation_cache():
+    translation_cache.clear()
 
 class TranslationAdapter(object):
     """Adapt a ``request`` to provide ``self.translate(message_string)``, e.g.::
@@ -19,18 +31,55 @@ class TranslationAdapter(object):
       
       Example usage::
           
-          >>> translator = TranslationAdapter(mock_request)
+          >>> translator = TranslationAdapter(mock_request, cache=LRUCache())
+          >>> translator.translate('eat everything')
+          'manger de tout'
+      
+      Repeat lookups are cached::
+      
           >>> translator.translate('eat everything')
           'manger de tout'
+          >>> mock_request.localizer.translate.call_count
+          1
+      
+      Until the catalog is reloaded::
+      
+          >>> mock_request.localizer.translations = Mock()
+          >>> translator.translate('eat everything')
+          'manger de tout'
+          >>> mock_request.localizer.translate.call_count
+          2
+      
+      Translation strings, which may have a mapping, aren't cached::
+      
+          >>> message = TranslationString('eat ${food}', mapping={'food': 'x'})
+          >>> translator.translate(message)
+          'manger de tout'
+          >>> mock_request.localizer.translate.call_count
+          3
       
     """
     
-    def __init__(self, request, domain=None):
+    def __init__(self, request, domain=None, cache=None):
+        if cache is None:
+            cache = translation_cache
         self.localizer = get_localizer(request)
         self.factory = TranslationStringFactory(domain)
+        self.domain = domain
+        self.cache = cache
     
     def translate(self, message_string):
-        return self.localizer.translate(self.factory(message_string))
+        localizer = self.localizer
+        if isinstance(message_string, TranslationString):
+            return localizer.translate(message_string)
+        key = (localizer.locale_name, self.domain, message_string)
+        translations = localizer.translations
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] is translations:
+            return entry[1]
+        translated = localizer.translate(self.factory(message_string))
+        self.cache.set(key, (translations, translated))
+        return translated
     
 
 
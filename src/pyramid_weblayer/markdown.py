@@ -1,18 +1,378 @@
 # -*- coding: utf-8 -*-
 
-"""Provides a function to render markdown as html."""
+"""Provides a function to render markdown as html.
+
+  Rendering goes through a process wide ``MarkdownRenderer``, which reuses a
+  configured ``markdown2.Markdown`` instance per thread and caches the
+  rendered html in a bounded LRU cache, keyed by a digest of the content
+  and the extras. Configure it using the ``markdown.*`` settings, e.g.::
+  
+      markdown.extras = tables fenced-code-blocks
+      markdown.cache_size = 1024
+  
+  To share rendered html between processes, set ``markdown.redis_url`` (and
+  optionally ``markdown.redis_ttl``, in seconds) to also store it in redis.
+  
+  To take rendering off the request thread, pre-render content when it's
+  saved. The source is rendered in the background, after the current
+  transaction commits, and the cache is warmed. Pass a ``content_key`` that
+  identifies the content (e.g.: ``'post:123:body'``) so the html rendered
+  from its previous source is evicted when it changes::
+  
+      request.prerender_markdown(post.body, content_key='post:123:body')
+  
+  Or evict it explicitly, e.g.: when the content is deleted::
+  
+      request.invalidate_markdown('post:123:body')
+"""
+
+__all__ = [
+    'MarkdownRenderer',
+    'RedisBackend',
+    'get_renderer',
+    'invalidate_markdown',
+    'markdown_to_html',
+    'prerender_markdown',
+]
 
 import logging
 logger = logging.getLogger(__name__)
 
+import hashlib
+import threading
+
 import markdown2
 
+from .cache import LRUCache
+from .tx import call_in_background
+
+DEFAULTS = {
+    'markdown.extras': '',
+    'markdown.cache_size': 1024,
+    'markdown.redis_url': None,
+    'markdown.redis_ttl': 60 * 60 * 24,
+}
+
+class RedisBackend(object):
+    """Store rendered html in redis, so it's shared between processes.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_redis = Mock()
+          >>> backend = RedisBackend(mock_redis, ttl=60)
+      
+      Gets and sets prefixed keys::
+      
+          >>> mock_redis.get.return_value = b'<p>a</p>'
+          >>> backend.get('k')
+          u'<p>a</p>'
+          >>> mock_redis.get.assert_called_with('markdown:k')
+          >>> backend.set('k', u'<p>a</p>')
+          >>> mock_redis.setex.assert_called_with('markdown:k', 60, b'<p>a</p>')
+          >>> backend.delete('k')
+          >>> mock_redis.delete.assert_called_with('markdown:k')
+      
+      Treats errors as misses::
+      
+          >>> mock_redis.get.side_effect = IOError
+          >>> backend.get('k') is None
+          True
+      
+    """
+    
+    def __init__(self, redis_client, prefix='markdown:', ttl=60 * 60 * 24):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.ttl = int(ttl)
+    
+    def get(self, key):
+        try:
+            value = self.redis.get(self.prefix + key)
+        except Exception as err:
+            logger.warn(err, exc_info=True)
+            return None
+        if value is None:
+            return None
+        return value.decode('utf-8')
+    
+    def set(self, key, html):
+        try:
+            self.redis.setex(self.prefix + key, self.ttl, html.encode('utf-8'))
+        except Exception as err:
+            logger.warn(err, exc_info=True)
+    
+    def delete(self, key):
+        try:
+            self.redis.delete(self.prefix + key)
+        except Exception as err:
+            logger.warn(err, exc_info=True)
+    
+
+
+class MarkdownRenderer(object):
+    """Render markdown as html, memoizing the output.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_markdown_cls = Mock()
+          >>> mock_markdown_cls.return_value.convert.return_value = u'<p>a</p>'
+          >>> renderer = MarkdownRenderer(extras=['tables'],
+          ...         markdown_cls=mock_markdown_cls)
+      
+      Renders using a configured ``Markdown`` instance::
+      
+          >>> renderer.render(u'a')
+          u'<p>a</p>'
+          >>> mock_markdown_cls.assert_called_with(extras=['tables'])
+      
+      Caches the output, reusing the instance when it does render::
+      
+          >>> renderer.render(u'a')
+          u'<p>a</p>'
+          >>> mock_markdown_cls.return_value.convert.call_count
+          1
+          >>> _ = renderer.render(u'b')
+          >>> mock_markdown_cls.call_count
+          1
+      
+      Coerces ``None`` to ``u''``::
+      
+          >>> _ = renderer.render(None)
+          >>> mock_markdown_cls.return_value.convert.assert_called_with(u'')
+      
+      Uses the shared ``backend``, if provided::
+      
+          >>> mock_backend = Mock()
+          >>> mock_backend.get.return_value = u'<p>shared</p>'
+          >>> renderer = MarkdownRenderer(backend=mock_backend,
+          ...         markdown_cls=mock_markdown_cls)
+          >>> renderer.render(u'c')
+          u'<p>shared</p>'
+          >>> mock_backend.get.assert_called_with(renderer.get_key(u'c'))
+      
+      Works for real::
+      
+          >>> MarkdownRenderer().render(u'*a*')
+          u'<p><em>a</em></p>\\n'
+      
+    """
+    
+    def __init__(self, extras=None, cache_size=1024, backend=None,
+            markdown_cls=None):
+        if markdown_cls is None:
+            markdown_cls = markdown2.Markdown
+        self.extras = list(extras or [])
+        self.cache = LRUCache(max_size=cache_size)
+        self.backend = backend
+        self.markdown_cls = markdown_cls
+        self._local = threading.local()
+        self._extras_key = u' '.join(sorted(self.extras))
+        self.content_keys = LRUCache(max_size=cache_size)
+    
+    def coerce(self, markdown_str):
+        """Coerce ``None`` to ``u''`` and decode utf-8 encoded byte strings.
+          
+              >>> renderer = MarkdownRenderer()
+              >>> renderer.coerce(None)
+              u''
+              >>> renderer.coerce(u'caf\\xe9'.encode('utf-8'))
+              u'caf\\xe9'
+          
+        """
+        
+        if markdown_str is None:
+            return u''
+        if isinstance(markdown_str, bytes):
+            return markdown_str.decode('utf-8')
+        return markdown_str
+    
+    def get_key(self, markdown_str):
+        """Return the cache key for ``markdown_str``: a digest of the content
+          and the extras.
+          
+              >>> renderer = MarkdownRenderer(extras=['tables'])
+              >>> renderer.get_key(u'a') == renderer.get_key(u'a')
+              True
+              >>> renderer.get_key(u'a') == MarkdownRenderer().get_key(u'a')
+              False
+          
+        """
+        
+        markdown_str = self.coerce(markdown_str)
+        data = u'{0}\n{1}'.format(self._extras_key, markdown_str)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+    
+    def render(self, markdown_str):
+        """Render ``markdown_str`` as html."""
+        
+        markdown_str = self.coerce(markdown_str)
+        key = self.get_key(markdown_str)
+        html = self.cache.get(key)
+        if html is not None:
+            return html
+        if self.backend is not None:
+            html = self.backend.get(key)
+        if html is None:
+            html = self.convert(markdown_str)
+            if self.backend is not None:
+                self.backend.set(key, html)
+        self.cache.set(key, html)
+        return html
+    
+    def warm(self, markdown_str, content_key=None):
+        """Render ``markdown_str`` into the caches, unless already there. If
+          provided, record that it's the current source of ``content_key``,
+          evicting the html rendered from its previous source.
+          
+          Setup::
+          
+              >>> from mock import Mock
+              >>> mock_markdown_cls = Mock()
+              >>> mock_markdown_cls.return_value.convert.side_effect = (
+              ...         lambda s: u'<p>{0}</p>'.format(s))
+              >>> renderer = MarkdownRenderer(markdown_cls=mock_markdown_cls)
+          
+          Warms the cache::
+          
+              >>> renderer.warm(u'a', content_key='post:1')
+              >>> renderer.get_key(u'a') in renderer.cache
+              True
+              >>> renderer.render(u'a')
+              u'<p>a</p>'
+              >>> mock_markdown_cls.return_value.convert.call_count
+              1
+          
+          Evicts the previous version when the source changes::
+          
+              >>> renderer.warm(u'b', content_key='post:1')
+              >>> renderer.get_key(u'a') in renderer.cache
+              False
+          
+        """
+        
+        key = self.get_key(markdown_str)
+        if key not in self.cache:
+            self.render(markdown_str)
+        if content_key is not None:
+            previous = self.content_keys.get(content_key)
+            self.content_keys.set(content_key, key)
+            if previous is not None and previous != key:
+                self.evict(previous)
+    
+    def invalidate(self, content_key):
+        """Evict the html rendered from the current source of ``content_key``.
+          
+              >>> renderer = MarkdownRenderer()
+              >>> renderer.warm(u'a', content_key='post:1')
+              >>> renderer.invalidate('post:1')
+              >>> renderer.get_key(u'a') in renderer.cache
+              False
+          
+        """
+        
+        key = self.content_keys.get(content_key)
+        if key is not None:
+            self.content_keys.delete(content_key)
+            self.evict(key)
+    
+    def evict(self, key):
+        """Remove the html cached under the digest ``key``."""
+        
+        self.cache.delete(key)
+        if self.backend is not None:
+            self.backend.delete(key)
+    
+    def convert(self, markdown_str):
+        """Render ``markdown_str``, bypassing the caches."""
+        
+        instance = getattr(self._local, 'instance', None)
+        if instance is None:
+            instance = self.markdown_cls(extras=self.extras)
+            self._local.instance = instance
+        return instance.convert(markdown_str)
+    
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+def get_renderer(settings, factory=None, redis_factory=None):
+    """Return the process wide renderer, creating one configured from the
+      ``markdown.*`` ``settings`` if necessary.
+      
+          >>> from mock import Mock
+          >>> from pyramid_weblayer import markdown
+          >>> _original = markdown._renderer
+          >>> markdown._renderer = None
+          >>> mock_factory = Mock()
+          >>> mock_redis_factory = Mock()
+      
+      Creates the renderer once::
+      
+          >>> renderer = get_renderer({'markdown.extras': 'tables',
+          ...         'markdown.redis_url': 'redis://localhost'},
+          ...         factory=mock_factory, redis_factory=mock_redis_factory)
+          >>> mock_redis_factory.assert_called_with('redis://localhost')
+          >>> kwargs = mock_factory.call_args[1]
+          >>> kwargs['extras'], kwargs['cache_size'], kwargs['backend'].ttl
+          (['tables'], 1024, 86400)
+          >>> get_renderer({}, factory=mock_factory) is renderer
+          True
+      
+      Teardown::
+      
+          >>> markdown._renderer = _original
+      
+    """
+    
+    global _renderer
+    
+    if factory is None:
+        factory = MarkdownRenderer
+    
+    with _renderer_lock:
+        if _renderer is None:
+            config = DEFAULTS.copy()
+            config.update(settings)
+            backend = None
+            if config['markdown.redis_url']:
+                if redis_factory is None:
+                    import redis
+                    redis_factory = redis.StrictRedis.from_url
+                redis_client = redis_factory(config['markdown.redis_url'])
+                backend = RedisBackend(redis_client,
+                        ttl=int(config['markdown.redis_ttl']))
+            _renderer = factory(
+                extras=config['markdown.extras'].split(),
+                cache_size=int(config['markdown.cache_size']),
+                backend=backend,
+            )
+        return _renderer
+
+
 def markdown_to_html(request, to_html=None):
-    """Return a function that renders markdown as html."""
+    """Return a function that renders markdown as html.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_to_html = Mock()
+          >>> mock_to_html.return_value = u'<p>a</p>'
+      
+      Coerces ``None`` to ``u''``::
+      
+          >>> render = markdown_to_html(None, to_html=mock_to_html)
+          >>> render(None)
+          u'<p>a</p>'
+          >>> mock_to_html.assert_called_with(u'')
+      
+    """
     
     # Compose.
     if to_html is None:
-        to_html = markdown2.markdown
+        to_html = get_renderer(request.registry.settings).render
     
     # If ``None`` return ''
     def render_as_html(markdown_str):
@@ -26,3 +386,40 @@ def markdown_to_html(request, to_html=None):
     
     return render_as_html
 
+def prerender_markdown(request, markdown_str, content_key=None, renderer=None,
+        call_in_bg=None):
+    """Render ``markdown_str`` in the background, after the current transaction
+      commits, warming the cache used by ``request.markdown_to_html``.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_renderer = Mock()
+          >>> mock_call_in_bg = Mock()
+      
+      Test::
+      
+          >>> prerender_markdown(None, u'*a*', content_key='post:1',
+          ...         renderer=mock_renderer, call_in_bg=mock_call_in_bg)
+          >>> mock_call_in_bg.assert_called_with(mock_renderer.warm,
+          ...         args=(u'*a*',), kwargs={'content_key': 'post:1'})
+      
+    """
+    
+    # Compose.
+    if renderer is None:
+        renderer = get_renderer(request.registry.settings)
+    if call_in_bg is None:
+        call_in_bg = call_in_background
+    
+    call_in_bg(renderer.warm, args=(markdown_str,),
+            kwargs={'content_key': content_key})
+
+def invalidate_markdown(request, content_key, renderer=None):
+    """Evict the html rendered from the current source of ``content_key``."""
+    
+    # Compose.
+    if renderer is None:
+        renderer = get_renderer(request.registry.settings)
+    
+    renderer.invalidate(content_key)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""Provides pluggable metrics sinks, used to instrument e.g. the
+  ``QueueProcessor``. A sink records three kinds of metric:
+
+  - ``incr(name, value=1)``: a counter
+  - ``timing(name, ms)``: a duration, in milliseconds
+  - ``gauge(name, value)``: a sampled value
+
+  Use a ``StatsdSink`` to send them to statsd over UDP, a ``RegistrySink``
+  to aggregate them in process or a ``CallbackSink`` to hand them to your
+  own function.
+"""
+
+__all__ = [
+    'CallbackSink',
+    'NullSink',
+    'RegistrySink',
+    'StatsdSink',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import bisect
+import collections
+import socket
+import threading
+import time
+
+# Upper bounds, in milliseconds, of the ``RegistrySink`` histogram buckets.
+DEFAULT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Seconds over which ``RegistrySink.rate`` is measured.
+DEFAULT_WINDOW = 60
+
+class NullSink(object):
+    """Discard all metrics.
+
+          >>> sink = NullSink()
+          >>> sink.incr('a')
+          >>> sink.timing('b', 1.5)
+          >>> sink.gauge('c', 2)
+
+    """
+
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, ms):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+
+
+class CallbackSink(NullSink):
+    """Pass each metric to ``callback(kind, name, value)``.
+
+          >>> calls = []
+          >>> sink = CallbackSink(lambda *args: calls.append(args))
+          >>> sink.incr('a')
+          >>> sink.timing('b', 1.5)
+          >>> sink.gauge('c', 2)
+          >>> calls
+          [('counter', 'a', 1), ('timing', 'b', 1.5), ('gauge', 'c', 2)]
+
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def incr(self, name, value=1):
+        self.callback('counter', name, value)
+
+    def timing(self, name, ms):
+        self.callback('timing', name, ms)
+
+    def gauge(self, name, value):
+        self.callback('gauge', name, value)
+
+
+
+class StatsdSink(NullSink):
+    """Send metrics to statsd using its plain text UDP protocol.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_sock = Mock()
+          >>> sink = StatsdSink(prefix='myapp', sock=mock_sock)
+
+      Sends fire and forget datagrams::
+
+          >>> sink.incr('queue.messages', 3)
+          >>> mock_sock.sendto.assert_called_with(b'myapp.queue.messages:3|c',
+          ...         ('127.0.0.1', 8125))
+          >>> sink.timing('queue.handler', 12.5)
+          >>> mock_sock.sendto.assert_called_with(b'myapp.queue.handler:12.5|ms',
+          ...         ('127.0.0.1', 8125))
+          >>> sink.gauge('queue.length.c', 7)
+          >>> mock_sock.sendto.assert_called_with(b'myapp.queue.length.c:7|g',
+          ...         ('127.0.0.1', 8125))
+
+      Never raises::
+
+          >>> mock_sock.sendto.side_effect = socket.error
+          >>> sink.incr('a')
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix=None, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.sock = sock
+
+    def incr(self, name, value=1):
+        self._send(name, value, 'c')
+
+    def timing(self, name, ms):
+        self._send(name, ms, 'ms')
+
+    def gauge(self, name, value):
+        self._send(name, value, 'g')
+
+    def _send(self, name, value, kind):
+        if self.prefix:
+            name = '{0}.{1}'.format(self.prefix, name)
+        data = '{0}:{1}|{2}'.format(name, value, kind).encode('utf-8')
+        try:
+            self.sock.sendto(data, self.address)
+        except (IOError, socket.error) as err:
+            logger.debug(err)
+
+
+
+class RegistrySink(NullSink):
+    """Aggregate metrics in process: counters are summed, timings are
+      bucketed into a histogram and gauges keep their last value.
+
+      Setup::
+
+          >>> now = [100.0]
+          >>> sink = RegistrySink(get_now=lambda: now[0], window=60)
+
+      Counters can be read as a total or as a rate per second over the last
+      ``window`` seconds::
+
+          >>> sink.incr('messages', 10)
+          >>> sink.incr('messages', 20)
+          >>> now[0] = 110.0
+          >>> sink.counter('messages')
+          30
+          >>> sink.rate('messages')
+          3.0
+
+      Counts older than the window no longer affect the rate::
+
+          >>> now[0] = 200.0
+          >>> sink.incr('messages', 120)
+          >>> now[0] = 230.0
+          >>> sink.counter('messages')
+          150
+          >>> sink.rate('messages')
+          2.0
+
+      Timings are bucketed by their upper bound in milliseconds::
+
+          >>> for ms in (0.5, 3, 3, 40, 20000):
+          ...     sink.timing('handler', ms)
+          >>> histogram = sink.histogram('handler')
+          >>> histogram['count'], histogram['max']
+          (5, 20000)
+          >>> histogram['buckets'][1], histogram['buckets'][5], histogram['buckets'][50]
+          (1, 2, 1)
+          >>> histogram['buckets']['+Inf']
+          1
+
+      Gauges keep the last value::
+
+          >>> sink.gauge('length', 3)
+          >>> sink.gauge('length', 4)
+          >>> sink.snapshot()['gauges']
+          {'length': 4}
+
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, get_now=None,
+            window=DEFAULT_WINDOW):
+        if get_now is None:
+            get_now = time.time
+        self.buckets = tuple(sorted(buckets))
+        self.get_now = get_now
+        self.window = window
+        self.started = get_now()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._per_second = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def incr(self, name, value=1):
+        second = int(self.get_now())
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+            counts = self._per_second.get(name)
+            if counts is None:
+                counts = self._per_second[name] = collections.deque()
+            if counts and counts[-1][0] == second:
+                counts[-1][1] += value
+            else:
+                counts.append([second, value])
+            self._expire(counts, second)
+
+    def timing(self, name, ms):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = {'counts': [0] * (len(self.buckets) + 1),
+                        'count': 0, 'sum': 0, 'max': 0}
+                self._histograms[name] = histogram
+            histogram['counts'][bisect.bisect_left(self.buckets, ms)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += ms
+            histogram['max'] = max(histogram['max'], ms)
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def counter(self, name):
+        """Return the total for the counter ``name``."""
+
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def rate(self, name):
+        """Return the per second rate of the counter ``name`` over the last
+          ``window`` seconds (or since the sink was created, if sooner).
+        """
+
+        now = self.get_now()
+        span = min(self.window, now - self.started)
+        if span <= 0:
+            return 0.0
+        with self._lock:
+            counts = self._per_second.get(name)
+            if not counts:
+                return 0.0
+            self._expire(counts, int(now))
+            total = sum(value for second, value in counts)
+        return total / float(span)
+
+    def histogram(self, name):
+        """Return a dict of ``count``, ``sum``, ``max`` and the count of
+          timings per bucket (keyed by its upper bound), for ``name``.
+        """
+
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                return None
+            bounds = list(self.buckets) + ['+Inf']
+            return {
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'max': histogram['max'],
+                'buckets': dict(zip(bounds, histogram['counts'])),
+            }
+
+    def _expire(self, counts, second):
+        """Drop the per second counts that are older than the window."""
+
+        while counts and counts[0][0] <= second - self.window:
+            counts.popleft()
+
+    def snapshot(self):
+        """Return all the metrics as a dict."""
+
+        with self._lock:
+            names = list(self._histograms.keys())
+            data = {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+            }
+        data['histograms'] = dict((name, self.histogram(name)) for name in names)
+        return data
+
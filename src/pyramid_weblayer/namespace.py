@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""Provides an ``add_template_namespace`` ``pyramid.events.BeforeRender``
+  subscriber that adds the ``_``, ``localizer``, ``is_active``, flatten and
+  snip functions to the template global namespace.
+  
+  It replaces registering ``add_underscore_translation``,
+  ``add_is_active_function``, ``add_flatten_functions`` and
+  ``add_snip_functions`` as separate subscribers. The request adapters are
+  wrapped in lazy proxies, so they're only built if and when the template
+  uses them, and nothing is added for non template (e.g.: ``json``)
+  renderers.
+  
+  Note that, as a result, ``localizer`` in the template namespace is a proxy
+  to the request's ``pyramid.i18n.Localizer``, rather than the localizer
+  itself. It forwards attribute access and passes ``isinstance`` checks, but
+  isn't the same object, so code that needs the real localizer (e.g.: to
+  compare it by identity) should use ``request.localizer``.
+"""
+
+__all__ = [
+    'LazyAdapter',
+    'add_template_namespace',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+from .flat import as_flat_string
+from .flat import as_flat_strings
+from .flat import flatten_breadcrumb
+from .flat import flatten_breadcrumbs
+from .i18n import TranslationAdapter
+from .nav import ActiveNavigationAdapter
+from .snip import snip_html
+from .snip import snip_htmls
+from .snip import snip_text
+from .snip import snip_texts
+
+NON_TEMPLATE_RENDERERS = (
+    'json',
+    'jsonp',
+    'string',
+)
+
+class LazyAdapter(object):
+    """Adapt ``request`` using ``adapter_cls`` the first time it's needed.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_adapter_cls = Mock()
+          >>> mock_adapter_cls.return_value.translate.return_value = 'traduit'
+          >>> lazy = LazyAdapter(mock_adapter_cls, 'request')
+      
+      Doesn't build the adapter until a method is called::
+      
+          >>> translate = lazy.method('translate')
+          >>> mock_adapter_cls.called
+          False
+          >>> translate('translated')
+          'traduit'
+          >>> mock_adapter_cls.assert_called_once_with('request')
+      
+      And then only builds it once::
+      
+          >>> _ = translate('translated')
+          >>> _ = lazy.attr('localizer').pluralize
+          >>> mock_adapter_cls.call_count
+          1
+      
+    """
+    
+    def __init__(self, adapter_cls, request):
+        self.adapter_cls = adapter_cls
+        self.request = request
+        self._adapter = None
+    
+    def get(self):
+        if self._adapter is None:
+            self._adapter = self.adapter_cls(self.request)
+        return self._adapter
+    
+    def method(self, name):
+        """Return a function that calls the adapter's ``name`` method."""
+        
+        def call(*args, **kwargs):
+            return getattr(self.get(), name)(*args, **kwargs)
+        return call
+    
+    def attr(self, name):
+        """Return a proxy to the adapter's ``name`` attribute."""
+        
+        return LazyAttribute(self, name)
+    
+
+
+class LazyAttribute(object):
+    """Proxy attribute access to ``getattr(lazy.get(), name)``, resolving it
+      on first use.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> from pyramid.i18n import Localizer
+          >>> mock_adapter_cls = Mock()
+          >>> localizer = Localizer('fr', None)
+          >>> mock_adapter_cls.return_value.localizer = localizer
+          >>> proxy = LazyAdapter(mock_adapter_cls, 'request').attr('localizer')
+      
+      Forwards attribute access and ``isinstance`` checks to the real object::
+      
+          >>> mock_adapter_cls.called
+          False
+          >>> proxy.locale_name
+          'fr'
+          >>> isinstance(proxy, Localizer)
+          True
+          >>> proxy.resolve() is localizer
+          True
+      
+    """
+    
+    def __init__(self, lazy, name):
+        self._lazy = lazy
+        self._name = name
+    
+    def resolve(self):
+        """Return the real object."""
+        
+        return getattr(self._lazy.get(), self._name)
+    
+    @property
+    def __class__(self):
+        return self.resolve().__class__
+    
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+    
+    def __repr__(self):
+        return repr(self.resolve())
+    
+
+
+def add_template_namespace(event, translation_cls=None, nav_cls=None):
+    """Add the template global namespace functions, lazily.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_translation_cls = Mock()
+          >>> mock_translation_cls.return_value.translate.return_value = 'traduit'
+          >>> mock_nav_cls = Mock()
+          >>> mock_nav_cls.return_value.is_active.return_value = 'active'
+          >>> event = {'request': 'request'}
+      
+      Adds the functions without building the adapters::
+      
+          >>> add_template_namespace(event, translation_cls=mock_translation_cls,
+          ...         nav_cls=mock_nav_cls)
+          >>> sorted(event.keys())
+          ['_', 'flat_string', 'flat_strings', 'flatten_breadcrumb', 'flatten_breadcrumbs', 'is_active', 'localizer', 'request', 'snip_html', 'snip_htmls', 'snip_text', 'snip_texts']
+          >>> mock_translation_cls.called or mock_nav_cls.called
+          False
+      
+      Until they're used::
+      
+          >>> event['_']('translated')
+          'traduit'
+          >>> event['is_active']('/')
+          'active'
+          >>> mock_nav_cls.assert_called_once_with('request')
+      
+      Skips non template renderers::
+      
+          >>> mock_renderer_info = Mock()
+          >>> mock_renderer_info.type = 'json'
+          >>> event = {'request': 'request', 'renderer_info': mock_renderer_info}
+          >>> add_template_namespace(event)
+          >>> sorted(event.keys())
+          ['renderer_info', 'request']
+      
+    """
+    
+    # Compose.
+    if translation_cls is None:
+        translation_cls = TranslationAdapter
+    if nav_cls is None:
+        nav_cls = ActiveNavigationAdapter
+    
+    renderer_info = event.get('renderer_info')
+    if getattr(renderer_info, 'type', None) in NON_TEMPLATE_RENDERERS:
+        return
+    
+    request = event['request']
+    translator = LazyAdapter(translation_cls, request)
+    nav = LazyAdapter(nav_cls, request)
+    
+    event['_'] = translator.method('translate')
+    event['localizer'] = translator.attr('localizer')
+    event['is_active'] = nav.method('is_active')
+    event['flat_string'] = as_flat_string
+    event['flatten_breadcrumb'] = flatten_breadcrumb
+    event['flat_strings'] = as_flat_strings
+    event['flatten_breadcrumbs'] = flatten_breadcrumbs
+    event['snip_text'] = snip_text
+    event['snip_html'] = snip_html
+    event['snip_texts'] = snip_texts
+    event['snip_htmls'] = snip_htmls
+
@@ -8,13 +8,106 @@
 import logging
 logger = logging.getLogger(__name__)
 
+from zope.interface import Interface
+
+from .cache import LRUCache
+
+class INavigationMatcher(Interface):
+    """Marker interface for the registry's ``NavigationMatcher`` utility."""
+
+
+class NavigationMatcher(object):
+    """Precompile the site's navigation paths into a character trie, so the
+      set of nav paths that are active for a request path can be found in a
+      single pass over the request path, rather than by testing every nav
+      item. The active set for each request path is memoized.
+      
+      As with ``ActiveNavigationAdapter.is_active``, a path is active if it
+      prefixes the request path, apart from ``'/'``, which must match exactly.
+      
+          >>> matcher = NavigationMatcher(['/', '/foo', '/foo/bar', '/baz'])
+          >>> sorted(matcher.match('/foo/bar/1'))
+          ['/foo', '/foo/bar']
+          >>> sorted(matcher.match('/'))
+          ['/']
+          >>> sorted(matcher.match('/qux'))
+          []
+          >>> '/foo' in matcher
+          True
+      
+    """
+    
+    def __init__(self, paths, cache_size=1024):
+        self.paths = frozenset(paths)
+        self.cache = LRUCache(max_size=cache_size)
+        self.trie = {}
+        for path in self.paths:
+            if path == '/':
+                continue
+            node = self.trie
+            for char in path:
+                node = node.setdefault(char, {})
+            node[None] = path
+    
+    def __contains__(self, path):
+        return path in self.paths
+    
+    def match(self, request_path):
+        """Return the set of nav paths that are active for ``request_path``."""
+        
+        active = self.cache.get(request_path)
+        if active is None:
+            active = self._match(request_path)
+            self.cache.set(request_path, active)
+        return active
+    
+    def _match(self, request_path):
+        active = set()
+        if request_path == '/' and '/' in self.paths:
+            active.add('/')
+        node = self.trie
+        for char in request_path:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                active.add(node[None])
+        return frozenset(active)
+    
+
+
+def register_navigation(config, paths):
+    """Config directive that registers the site's navigation ``paths`` so
+      ``is_active`` can use a precompiled ``NavigationMatcher``, e.g.::
+      
+          config.register_navigation(['/', '/about', '/products', ...])
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> from pyramid.registry import Registry
+          >>> mock_config = Mock()
+          >>> mock_config.registry = Registry()
+      
+      Registers a matcher as a utility::
+      
+          >>> register_navigation(mock_config, ['/foo'])
+          >>> '/foo' in mock_config.registry.queryUtility(INavigationMatcher)
+          True
+      
+    """
+    
+    config.registry.registerUtility(NavigationMatcher(paths), INavigationMatcher)
+
 class ActiveNavigationAdapter(object):
     """Adapt a ``request`` to provide ``self.is_active(path)``.
       
       Setup::
       
           >>> from mock import Mock
+          >>> from pyramid.registry import Registry
           >>> mock_request = Mock()
+          >>> mock_request.registry = Registry()
           >>> mock_request.path = '/foo/bar'
       
       Returns the string ``'active'`` if True, otherwise returns an empty string::
@@ -50,18 +143,71 @@ class ActiveNavigationAdapter(object):
           >>> nav.is_active('/')
           'active'
       
+      Each path is matched on its own terms, so '/' doesn't make the other
+      paths exact, or vice versa (previously, the first path decided for all
+      of them)::
+      
+          >>> mock_request.path = '/foo/bar'
+          >>> nav = ActiveNavigationAdapter(mock_request)
+          >>> nav.is_active('/', '/foo'), nav.is_active('/bar', '/')
+          ('active', '')
+      
+      Unless ``exact`` is passed explicitly::
+      
+          >>> nav.is_active('/', '/foo', exact=True)
+          ''
+      
+      When the nav paths have been registered with a ``NavigationMatcher``,
+      the active ones are looked up once per request::
+      
+          >>> matcher = NavigationMatcher(['/', '/foo', '/foo/baz'])
+          >>> mock_request.registry.registerUtility(matcher, INavigationMatcher)
+          >>> mock_request.path = '/foo/bar'
+          >>> nav = ActiveNavigationAdapter(mock_request)
+          >>> nav.matcher is matcher
+          True
+          >>> nav.is_active('/foo'), nav.is_active('/foo/baz'), nav.is_active('/')
+          ('active', '', '')
+          >>> nav.active
+          frozenset(['/foo'])
+      
+      Unregistered paths fall back to being tested one by one::
+      
+          >>> nav.is_active('/foo/b')
+          'active'
+      
     """
     
-    def __init__(self, request):
+    def __init__(self, request, matcher=None):
+        if matcher is None:
+            registry = getattr(request, 'registry', None)
+            if registry is not None:
+                matcher = registry.queryUtility(INavigationMatcher)
         self.request = request
+        self.matcher = matcher
+        self._active = None
+    
+    @property
+    def active(self):
+        """The set of registered nav paths that are active for the request."""
+        
+        if self._active is None:
+            self._active = self.matcher.match(self.request.path)
+        return self._active
     
     def is_active(self, *args, **kwargs):
         exact = kwargs.get('exact')
+        matcher = self.matcher
+        if matcher is not None and exact is None:
+            if all([path in matcher for path in args]):
+                active = self.active
+                for path in args:
+                    if path in active:
+                        return 'active'
+                return ''
         for path in args:
-            if exact is None:
-                exact = path == '/'
-            active = False
-            if exact:
+            is_exact = path == '/' if exact is None else exact
+            if is_exact:
                 active = self.request.path == path
             else:
                 active = self.request.path.startswith(path)
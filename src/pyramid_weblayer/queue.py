@@ -14,27 +14,242 @@
   
   Run in a background thread::
       
-      >>> # processor.start(async=True)
+      >>> # processor.start(in_thread=True)
       
   If running in a background thread, call ``stop()`` to exit::
   
       >>> # processor.stop()
   
-  If you want jobs to be requeued (at the back of the queue)
+  If you want jobs to be requeued (at the back of the queue) when
+  the handler raises an exception, pass ``should_requeue=True``.
+  
+  To drain up to ``n`` messages per round trip to redis, pass
+  ``batch_size=n`` and, optionally, a ``handle_batch`` callable that
+  accepts a list of message bodies::
+  
+      >>> processor = QueueProcessor(redis_client, input_channels, handle_data,
+      ...         batch_size=50)
+  
+  To run the handler concurrently, pass ``concurrency=n`` to use a pool of
+  ``n`` worker threads (or ``pool_type='process'`` for worker processes, in
+  which case the handlers must be picklable). Messages are only popped when
+  a worker is free::
+  
+      >>> processor = QueueProcessor(redis_client, input_channels, handle_data,
+      ...         concurrency=8)
+  
+  In the default mode, a message is lost if the process dies while
+  handling it. Pass ``reliable=True`` to instead atomically move each
+  message (with ``brpoplpush``) onto a per worker processing list, where
+  it stays until it's been handled and acknowledged. Each worker records
+  a heartbeat from a background thread (so it stays alive while its
+  handlers are busy, however long they take) and periodically reaps the
+  processing lists of workers that haven't been seen for
+  ``visibility_timeout`` seconds, re-enqueueing their in flight messages.
+  Messages are at least once delivered: if a worker dies mid handler, its
+  message is handled again. Note that reliable mode consumes from the
+  *tail* of the list, so producers should ``lpush`` to keep FIFO order::
+  
+      >>> processor = QueueProcessor(redis_client, input_channels, handle_data,
+      ...         reliable=True, visibility_timeout=300)
+  
+  To schedule a job to run later, add it to the channel's delayed set::
+  
+      >>> # schedule(redis_client, 'channel1', 'data', delay=60)
+  
+  Delayed jobs are moved onto the channel, in bulk, once they're due by a
+  processor started with ``promote_delayed=True``. Pass ``retry_backoff=n``
+  to schedule failed messages (when ``should_requeue``) to be retried after
+  ``n``, ``2n``, ``4n``, ... seconds, so a failing dependency isn't hammered.
+  The attempt count travels with each retried message (handlers still see
+  the original body), so identical messages have their own retry budgets.
+  After ``max_retries`` attempts, messages are moved to ``<channel>:dead``::
+  
+      >>> processor = QueueProcessor(redis_client, input_channels, handle_data,
+      ...         should_requeue=True, promote_delayed=True, retry_backoff=1,
+      ...         max_retries=10)
+  
+  By default, ``blpop`` always drains the first non-empty channel, so a
+  busy channel can starve the ones after it. Pass ``weights`` to share
+  pops between channels in proportion to their weight (using smooth
+  weighted round robin) and ``channel_concurrency`` to cap the number of
+  each channel's messages in flight at once, e.g.: so a bulk backfill
+  can't hog the workers that handle interactive jobs::
+  
+      >>> processor = QueueProcessor(redis_client, ['interactive', 'bulk'],
+      ...         handle_data, concurrency=8,
+      ...         weights={'interactive': 5, 'bulk': 1},
+      ...         channel_concurrency={'bulk': 2})
+  
+  To see how the processor is performing, pass a ``metrics`` sink from
+  ``pyramid_weblayer.metrics``. The processor records:
+  
+  - ``queue.messages``: count of messages popped (i.e.: read as a rate)
+  - ``queue.pop_wait``: time spent waiting for messages, in ms
+  - ``queue.handler``: handler latency, in ms
+  - ``queue.errors``, ``queue.requeued`` and ``queue.pop_errors`` counts
+  - ``queue.length.<channel>``: the length of each channel, sampled using
+    ``llen`` every ``sample_interval`` seconds
+  
+  E.g.: to send them to statsd::
+  
+      >>> from pyramid_weblayer.metrics import StatsdSink
+      >>> processor = QueueProcessor(redis_client, input_channels, handle_data,
+      ...         metrics=StatsdSink(prefix='myapp'))
+  
   This provides a very simple inter-process messaging and / or background
   task processing mechanism.  Queued messages / jobs are explictly passed
   as string messages.  
   
   Pro: you're always in control of your code execution environment.
   Con: you have to deal with potentially tedious message parsing.
+  
+  On Python 3.5+, an ``AsyncQueueProcessor`` with the same contract runs on
+  an ``asyncio`` event loop, using an async redis client -- see
+  ``pyramid_weblayer._async_queue``.
 """
 
 import logging
 logger = logging.getLogger(__name__)
 
 import json
+import multiprocessing
+import os
+import socket
+import sys
 import threading
 import time
+import uuid
+import warnings
+
+from .executor import BackgroundExecutor
+from .metrics import NullSink
+
+POOL_TYPES = (
+    'process',
+    'thread',
+)
+
+def _call_handler(handler, arg):
+    """Call ``handler(arg)`` in a pool process, returning ``None`` on success
+      or a string describing the error on failure.
+      
+          >>> _call_handler(int, '1') is None
+          True
+          >>> _call_handler(int, 'a')
+          "ValueError: invalid literal for int() with base 10: 'a'"
+      
+    """
+    
+    try:
+        handler(arg)
+    except Exception as err:
+        return '{0}: {1}'.format(err.__class__.__name__, err)
+
+# Atomically move up to ``ARGV[2]`` jobs that are due by ``ARGV[1]`` from the
+# delayed sorted set ``KEYS[1]`` onto the list ``KEYS[2]``, using the push
+# command ``ARGV[3]``. Members are stored as ``<unique id>|<body>``.
+PROMOTE_SCRIPT = """
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for i, member in ipairs(due) do
+  local sep = string.find(member, '|', 1, true)
+  redis.call(ARGV[3], KEYS[2], string.sub(member, sep + 1))
+end
+if #due > 0 then
+  redis.call('zrem', KEYS[1], unpack(due))
+end
+return #due
+"""
+
+def get_delayed_key(channel):
+    """Return the name of the sorted set that holds the delayed jobs for
+      ``channel``, scored by the time they're due.
+      
+          >>> get_delayed_key('c')
+          'c:delayed'
+      
+    """
+    
+    return '{0}:delayed'.format(channel)
+
+def schedule(redis_client, channel, body, delay=0, at=None, get_now=None):
+    """Schedule ``body`` to be pushed onto ``channel`` after ``delay`` seconds
+      (or at the unix timestamp ``at``). The job is moved onto the channel
+      by a ``QueueProcessor`` consuming it with ``promote_delayed=True``.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_redis = Mock()
+      
+      Adds the job to the channel's delayed set, scored by when it's due::
+      
+          >>> schedule(mock_redis, 'c', 'body', delay=30, get_now=lambda: 1000)
+          >>> args = mock_redis.zadd.call_args[0]
+          >>> args[0], args[1].values()
+          ('c:delayed', [1030])
+          >>> args[1].keys()[0].split('|')[1]
+          'body'
+      
+      Can be passed a pipeline in place of the client::
+      
+          >>> schedule(mock_redis.pipeline(), 'c', 'body', at=2000)
+          >>> mock_redis.pipeline.return_value.zadd.call_args[0][1].values()
+          [2000]
+      
+    """
+    
+    if get_now is None:
+        get_now = time.time
+    
+    if at is None:
+        at = get_now() + delay
+    # Prefix the body with a unique id, so identical bodies can be scheduled
+    # more than once.
+    token = uuid.uuid4().hex
+    if isinstance(body, bytes) and not isinstance(token, bytes): # py3
+        member = token.encode('ascii') + b'|' + body
+    else:
+        member = '{0}|{1}'.format(token, body)
+    redis_client.zadd(get_delayed_key(channel), {member: at})
+
+# Prefix of retried messages, which are stored as ``<prefix><attempts>|<body>``.
+RETRY_PREFIX = '\x00retry:'
+
+def add_attempts(body, attempts):
+    """Return ``body`` marked as having failed ``attempts`` times.
+      
+          >>> add_attempts('body', 2)
+          '\\x00retry:2|body'
+      
+    """
+    
+    parts = (RETRY_PREFIX, str(attempts), '|')
+    if isinstance(body, bytes) and not isinstance(RETRY_PREFIX, bytes): # py3
+        parts = [item.encode('ascii') for item in parts]
+    return parts[0] + parts[1] + parts[2] + body
+
+def split_attempts(message):
+    """Return ``(attempts, body)`` for a (possibly retried) ``message``.
+      
+          >>> split_attempts('body')
+          (0, 'body')
+          >>> split_attempts(add_attempts('a|b', 3))
+          (3, 'a|b')
+          >>> split_attempts(add_attempts(u'a', 1))
+          (1, u'a')
+      
+    """
+    
+    prefix, sep = RETRY_PREFIX, '|'
+    if isinstance(message, bytes) and not isinstance(prefix, bytes): # py3
+        prefix, sep = prefix.encode('ascii'), sep.encode('ascii')
+    elif not isinstance(message, (bytes, type(u''))):
+        return 0, message
+    if not message.startswith(prefix):
+        return 0, message
+    attempts, _, body = message[len(prefix):].partition(sep)
+    return int(attempts), body
 
 class QueueProcessor(object):
     """Consume data from a redis queue.  When it arrives, pass it to
@@ -59,51 +274,957 @@ class QueueProcessor(object):
         logger.info(self.channels)
         
         self.running = True
-        while self.running:
-            logger.debug(('QueueProcessor reconnecting', self.channels))
+        self._start_pool()
+        self._start_heartbeat()
+        try:
+            while self.running:
+                # Apply backpressure: don't pop until a worker is free.
+                if self.slots is not None:
+                    self.slots.acquire()
+                logger.debug(('QueueProcessor reconnecting', self.channels))
+                self._sample()
+                if self.promote_delayed:
+                    self._maybe_promote()
+                started = time.time()
+                try:
+                    channel, bodies = self._pop()
+                except Exception as err:
+                    self._release()
+                    logger.warn(err, exc_info=True)
+                    self._incr('pop_errors')
+                    time.sleep(self.timeout)
+                else:
+                    logger.debug(('QueueProcessor return value obtained', self.channels))
+                    self._timing('pop_wait', started)
+                    if bodies:
+                        self._incr('messages', len(bodies))
+                        self._dispatch(channel, bodies)
+                    else:
+                        self._release()
+                    # Only pause if the queue has been drained.
+                    if self.reconnect_delay and len(bodies) < self.batch_size:
+                        time.sleep(self.reconnect_delay)
+        finally:
+            self._stop_heartbeat()
+            self._stop_pool()
+    
+    def _pop(self):
+        """Block until a message arrives and then, in batch mode, drain up to
+          ``batch_size - 1`` more from the same channel in a single pipelined
+          round trip. Returns ``(channel, bodies)``.
+          
+          Setup::
+          
+              >>> from mock import Mock
+              >>> mock_redis = Mock()
+              >>> mock_pipe = mock_redis.pipeline.return_value
+              >>> processor = QueueProcessor(mock_redis, ['c1', 'c2'], None,
+              ...         batch_size=3)
+          
+          Returns an empty list if the blocking pop times out::
+          
+              >>> mock_redis.blpop.return_value = None
+              >>> processor._pop()
+              (None, [])
+          
+          Otherwise pipelines ``lpop``s to drain the rest of the batch::
+          
+              >>> mock_redis.blpop.return_value = ('c2', 'a')
+              >>> mock_pipe.execute.return_value = ['b', None]
+              >>> processor._pop()
+              ('c2', ['a', 'b'])
+              >>> mock_pipe.lpop.call_count
+              2
+              >>> mock_pipe.lpop.assert_called_with('c2')
+          
+        """
+        
+        channels = self._order_channels()
+        if not channels:
+            # Every channel is at its concurrency cap.
+            self._wait_for_capacity()
+            return None, []
+        if self.reliable:
+            channel, bodies = self._pop_reliable(channels)
+        else:
+            channel, bodies = None, []
+            return_value = self.redis.blpop(channels, timeout=self.pop_timeout)
+            if return_value is not None:
+                channel, body = return_value
+                bodies = [body]
+                size = self._get_batch_size(channel)
+                if size > 1:
+                    pipe = self.redis.pipeline(transaction=False)
+                    for i in range(size - 1):
+                        pipe.lpop(channel)
+                    bodies.extend([item for item in pipe.execute()
+                            if item is not None])
+        if channels is not self.channels:
+            self._account(channels, channel, len(bodies))
+        return channel, bodies
+    
+    def _pop_reliable(self, channels=None):
+        """Atomically move messages from the tail of a channel onto the head
+          of this worker's processing list, where they stay until acknowledged.
+          
+          Setup::
+          
+              >>> from mock import Mock
+              >>> mock_redis = Mock()
+              >>> mock_pipe = mock_redis.pipeline.return_value
+              >>> mock_redis.zrangebyscore.return_value = []
+              >>> processor = QueueProcessor(mock_redis, ['c1', 'c2'], None,
+              ...         reliable=True, worker_id='w1', batch_size=2)
+          
+          Tries each channel in turn without blocking::
+          
+              >>> mock_redis.rpoplpush.side_effect = [None, 'a']
+              >>> mock_pipe.execute.return_value = [None]
+              >>> processor._pop_reliable()
+              ('c2', ['a'])
+              >>> mock_redis.rpoplpush.assert_called_with('c2', 'c2:processing:w1')
+          
+          Then blocks on the first channel::
+          
+              >>> mock_redis.rpoplpush.side_effect = [None, None]
+              >>> mock_redis.brpoplpush.return_value = 'b'
+              >>> processor._pop_reliable()
+              ('c1', ['b'])
+              >>> mock_redis.brpoplpush.assert_called_with('c1', 'c1:processing:w1',
+              ...         timeout=1)
+          
+          Draining the rest of the batch in a pipelined round trip::
+          
+              >>> mock_redis.rpoplpush.side_effect = [None, None]
+              >>> mock_pipe.execute.return_value = ['c']
+              >>> processor._pop_reliable()
+              ('c1', ['b', 'c'])
+          
+        """
+        
+        if channels is None:
+            channels = self.channels
+        
+        self._keep_alive()
+        
+        # If there's only one channel, block on it. Otherwise, as redis can't
+        # block on more than one source list, try each channel in turn and
+        # then block on the first one for a short time.
+        channel, body = None, None
+        if len(channels) == 1:
+            channel = channels[0]
+            body = self.redis.brpoplpush(channel, self.get_processing_list(channel),
+                    timeout=self.pop_timeout)
+        else:
+            for item in channels:
+                body = self.redis.rpoplpush(item, self.get_processing_list(item))
+                if body is not None:
+                    channel = item
+                    break
+            if body is None:
+                channel = channels[0]
+                body = self.redis.brpoplpush(channel,
+                        self.get_processing_list(channel),
+                        timeout=min(self.pop_timeout, 1))
+        if body is None:
+            return None, []
+        bodies = [body]
+        size = self._get_batch_size(channel)
+        if size > 1:
+            processing = self.get_processing_list(channel)
+            pipe = self.redis.pipeline(transaction=False)
+            for i in range(size - 1):
+                pipe.rpoplpush(channel, processing)
+            bodies.extend([item for item in pipe.execute() if item is not None])
+        return channel, bodies
+    
+    def _order_channels(self):
+        """Return the channels to pop from, in order of preference: those at
+          their ``channel_concurrency`` cap are left out and, with
+          ``weights``, the channel with the most credit goes first.
+          
+          Setup::
+          
+              >>> processor = QueueProcessor(None, ['a', 'b'], None,
+              ...         weights={'a': 2, 'b': 1}, channel_concurrency={'b': 1})
+          
+          Shares pops in proportion to the weights::
+          
+              >>> popped = []
+              >>> for i in range(6):
+              ...     channels = processor._order_channels()
+              ...     processor._account(channels, channels[0], 1)
+              ...     processor._finish(channels[0], 1)
+              ...     popped.append(channels[0])
+              >>> popped
+              ['a', 'b', 'a', 'a', 'b', 'a']
+          
+          Skips channels at their cap::
+          
+              >>> processor._account(['a', 'b'], 'b', 1)
+              >>> processor._order_channels()
+              ['a']
+              >>> processor._finish('b', 1)
+              >>> processor._order_channels()
+              ['a', 'b']
+          
+          Without weights or caps, the channels are used as given::
+          
+              >>> processor = QueueProcessor(None, ['a', 'b'], None)
+              >>> processor._order_channels() is processor.channels
+              True
+          
+        """
+        
+        if not self.weights and not self.channel_concurrency:
+            return self.channels
+        with self._capacity:
+            channels = [item for item in self.channels if self._has_capacity(item)]
+            if self.weights:
+                # Stable, so ties keep the configured order.
+                channels.sort(key=lambda item: self._credits.get(item, 0) +
+                        self._get_weight(item), reverse=True)
+            return channels
+    
+    def _account(self, channels, channel, count):
+        """Record that ``count`` messages were popped from ``channel``, having
+          tried the ``channels`` in order.
+          
+          Channels tried before ``channel`` were empty, so their credit is
+          reset, rather than letting them build up credit they'd later use
+          to starve the others. The rest are credited with their weight and
+          ``channel`` is charged the total, as per smooth weighted round robin.
+        """
+        
+        with self._capacity:
+            if channel is None:
+                index = len(channels)
+            else:
+                index = channels.index(channel)
+            for item in channels[:index]:
+                self._credits[item] = 0
+            active = channels[index:]
+            if self.weights and active:
+                total = sum([self._get_weight(item) for item in active])
+                for i in range(count):
+                    for item in active:
+                        self._credits[item] = (self._credits.get(item, 0) +
+                                self._get_weight(item))
+                    self._credits[channel] -= total
+            if count:
+                self._in_flight[channel] = self._in_flight.get(channel, 0) + count
+    
+    def _finish(self, channel, count):
+        """Record that ``count`` messages from ``channel`` have been handled."""
+        
+        if not self.weights and not self.channel_concurrency:
+            return
+        with self._capacity:
+            self._in_flight[channel] = self._in_flight.get(channel, 0) - count
+            self._capacity.notify_all()
+    
+    def _has_capacity(self, channel):
+        if not self.channel_concurrency:
+            return True
+        limit = self.channel_concurrency.get(channel)
+        return limit is None or self._in_flight.get(channel, 0) < limit
+    
+    def _wait_for_capacity(self):
+        with self._capacity:
+            if not [item for item in self.channels if self._has_capacity(item)]:
+                self._capacity.wait(min(self.pop_timeout, 1))
+    
+    def _get_weight(self, channel):
+        return self.weights.get(channel, 1) if self.weights else 1
+    
+    def _get_batch_size(self, channel):
+        """Don't drain more messages from ``channel`` than its cap allows."""
+        
+        if not self.channel_concurrency:
+            return self.batch_size
+        limit = self.channel_concurrency.get(channel)
+        if limit is None:
+            return self.batch_size
+        with self._capacity:
+            remaining = limit - self._in_flight.get(channel, 0)
+        return max(1, min(self.batch_size, remaining))
+    
+    def _dispatch(self, channel, bodies):
+        """Handle the ``bodies`` in the current thread or, if running with a
+          worker pool, submit them to the pool. The caller has already
+          acquired one worker slot: one more is acquired for each additional
+          job, blocking until a worker is free.
+          
+          Setup::
+          
+              >>> from mock import Mock
+              >>> mock_redis = Mock()
+              >>> handled = []
+              >>> processor = QueueProcessor(mock_redis, ['c'], handled.append,
+              ...         concurrency=2)
+              >>> processor._start_pool()
+          
+          Each message is handled by a pool worker::
+          
+              >>> slots = processor.slots
+              >>> slots.acquire()
+              True
+              >>> processor._dispatch('c', ['a', 'b'])
+              >>> processor._stop_pool()
+              >>> sorted(handled)
+              ['a', 'b']
+          
+          Freeing the worker slots once done::
+          
+              >>> slots.acquire(False) and slots.acquire(False)
+              True
+          
+        """
+        
+        if self.pool is None:
+            try:
+                return self._handle(channel, bodies)
+            finally:
+                self._finish(channel, len(bodies))
+        if self.handle_batch is not None:
+            return self._submit(self.handle_batch, channel, bodies)
+        for i, body in enumerate(bodies):
+            if i > 0:
+                self.slots.acquire()
+            self._submit(self.handle_function, channel, [body])
+    
+    def _submit(self, handler, channel, bodies):
+        """Submit a job to the pool, releasing its worker slot when done."""
+        
+        if self.pool_type == 'process':
+            plain = [split_attempts(body)[1] for body in bodies]
+            arg = plain if handler is self.handle_batch else plain[0]
+            started = time.time()
+            def callback(error):
+                try:
+                    self._timing('handler', started)
+                    if error is not None:
+                        logger.warn(error)
+                        logger.warn((channel, bodies))
+                        self._incr('errors')
+                    self._settle(channel, bodies, error is not None)
+                finally:
+                    self._finish(channel, len(bodies))
+                    self._release()
+            self.pool.apply_async(_call_handler, (handler, arg), callback=callback)
+        else:
+            def job():
+                try:
+                    self._handle(channel, bodies)
+                finally:
+                    self._finish(channel, len(bodies))
+                    self._release()
+            self.pool.submit(job)
+    
+    def _release(self):
+        if self.slots is not None:
+            self.slots.release()
+    
+    def _start_pool(self):
+        """Start the worker pool, if configured with a ``concurrency``."""
+        
+        if not self.concurrency:
+            return
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        if self.pool_type == 'process':
+            self.pool = multiprocessing.Pool(self.concurrency)
+        else:
+            # The slots guarantee there's always a free worker, so the
+            # queue never overflows.
+            self.pool = BackgroundExecutor(max_workers=self.concurrency,
+                    max_queue_size=self.concurrency, overflow='block')
+    
+    def _stop_pool(self):
+        """Wait for in flight jobs to finish and stop the worker pool."""
+        
+        if self.pool is None:
+            return
+        if self.pool_type == 'process':
+            self.pool.close()
+            self.pool.join()
+        else:
+            self.pool.shutdown(wait=True)
+        self.pool = None
+        self.slots = None
+    
+    def _handle(self, channel, bodies):
+        """Pass the ``bodies`` to ``self.handle_batch``, if provided, or to
+          ``self.handle_function`` one at a time, requeueing on error if
+          ``self.should_requeue``.
+          
+          Setup::
+          
+              >>> from mock import Mock
+              >>> mock_redis = Mock()
+              >>> handled = []
+              >>> def handle(body):
+              ...     if body == 'bad':
+              ...         raise ValueError(body)
+              ...     handled.append(body)
+              >>> processor = QueueProcessor(mock_redis, ['c'], handle,
+              ...         should_requeue=True)
+          
+          Handles each message, requeueing the failures::
+          
+              >>> processor._handle('c', ['a', 'bad', 'b'])
+              >>> handled
+              ['a', 'b']
+              >>> mock_redis.rpush.assert_called_once_with('c', 'bad')
+          
+          Or hands the whole batch to ``handle_batch``::
+          
+              >>> mock_handle_batch = Mock()
+              >>> processor.handle_batch = mock_handle_batch
+              >>> processor._handle('c', ['a', 'b'])
+              >>> mock_handle_batch.assert_called_with(['a', 'b'])
+          
+          Requeueing the whole batch if it fails::
+          
+              >>> mock_handle_batch.side_effect = ValueError
+              >>> processor._handle('c', ['a', 'b'])
+              >>> mock_redis.rpush.assert_called_with('c', 'a', 'b')
+          
+        """
+        
+        if self.handle_batch is not None:
+            failed = False
+            started = time.time()
             try:
-                return_value = self.redis.blpop(self.channels, timeout=self.timeout)
+                self.handle_batch([split_attempts(body)[1] for body in bodies])
             except Exception as err:
                 logger.warn(err, exc_info=True)
-                time.sleep(self.timeout)
-            else:
-                logger.debug(('QueueProcessor return value obtained', self.channels))
-                if return_value is not None:
-                    channel, body = return_value
-                    try:
-                        self.handle_function(body)
-                    except Exception as err:
-                        logger.warn(err, exc_info=True)
-                        logger.warn(return_value)
-                        if self.should_requeue:
-                            self.redis.rpush(channel, body)
-                if self.reconnect_delay:
-                    time.sleep(self.reconnect_delay)
-    
-    def start(self, async=False):
-        """Either start running or start running in a thread."""
+                logger.warn((channel, bodies))
+                self._incr('errors')
+                failed = True
+            self._timing('handler', started)
+            self._settle(channel, bodies, failed)
+            return
+        for body in bodies:
+            failed = False
+            started = time.time()
+            try:
+                self.handle_function(split_attempts(body)[1])
+            except Exception as err:
+                logger.warn(err, exc_info=True)
+                logger.warn((channel, body))
+                self._incr('errors')
+                failed = True
+            self._timing('handler', started)
+            self._settle(channel, [body], failed)
+    
+    def _settle(self, channel, bodies, failed):
+        """Requeue the ``bodies`` if they ``failed`` and ``self.should_requeue``.
+          In reliable mode, also acknowledge them by removing them from this
+          worker's processing list, in the same transaction.
+          
+          Setup::
+          
+              >>> from mock import Mock
+              >>> mock_redis = Mock()
+              >>> mock_pipe = mock_redis.pipeline.return_value
+              >>> processor = QueueProcessor(mock_redis, ['c'], None,
+              ...         should_requeue=True, reliable=True, worker_id='w1')
+          
+          Acknowledges handled messages::
+          
+              >>> processor._settle('c', ['a'], False)
+              >>> mock_pipe.lrem.assert_called_with('c:processing:w1', 1, 'a')
+              >>> mock_pipe.lpush.called
+              False
+          
+          Requeues failed messages to the back of the queue::
+          
+              >>> processor._settle('c', ['b'], True)
+              >>> mock_pipe.lpush.assert_called_with('c', 'b')
+              >>> mock_pipe.lrem.assert_called_with('c:processing:w1', 1, 'b')
+          
+          Or, with a ``retry_backoff``, schedules them to be retried later,
+          counting the attempt::
+          
+              >>> processor.retry_backoff = 1
+              >>> mock_pipe.reset_mock()
+              >>> processor._settle('c', ['b'], True)
+              >>> key, mapping = mock_pipe.zadd.call_args[0]
+              >>> key, split_attempts(mapping.keys()[0].split('|', 1)[1])
+              ('c:delayed', (1, 'b'))
+              >>> mock_pipe.lpush.called
+              False
+          
+        """
+        
+        should_requeue = failed and self.should_requeue
+        should_delay = should_requeue and self.retry_backoff
+        if should_requeue:
+            self._incr('requeued', len(bodies))
+        if not self.reliable and not should_delay:
+            if should_requeue:
+                self.redis.rpush(channel, *bodies)
+            return
+        pipe = self.redis.pipeline()
+        if should_delay:
+            for message in bodies:
+                attempts, body = split_attempts(message)
+                attempts += 1
+                delay = self.get_retry_delay(attempts)
+                if delay is None:
+                    logger.warn(('QueueProcessor giving up on', channel, body))
+                    self._incr('dead')
+                    pipe.rpush(self.get_dead_list(channel), body)
+                else:
+                    schedule(pipe, channel, add_attempts(body, attempts),
+                            delay=delay)
+        elif should_requeue:
+            pipe.lpush(channel, *bodies)
+        if self.reliable:
+            processing = self.get_processing_list(channel)
+            for body in bodies:
+                pipe.lrem(processing, 1, body)
+        pipe.execute()
+    
+    def get_processing_list(self, channel, worker_id=None):
+        """Return the name of the list that holds the messages from ``channel``
+          that the worker is processing.
+          
+              >>> processor = QueueProcessor(None, ['c'], None, worker_id='w1')
+              >>> processor.get_processing_list('c')
+              'c:processing:w1'
+              >>> processor.get_processing_list('c', worker_id='w2')
+              'c:processing:w2'
+          
+        """
+        
+        if worker_id is None:
+            worker_id = self.worker_id
+        return '{0}:processing:{1}'.format(channel, worker_id)
+    
+    def get_workers_key(self, channel):
+        """Return the name of the sorted set that records when each worker
+          consuming ``channel`` was last seen.
+        """
+        
+        return '{0}:workers'.format(channel)
+    
+    def heartbeat(self, get_now=None):
+        """Record that this worker is alive, for each channel.
+          
+              >>> from mock import Mock
+              >>> mock_redis = Mock()
+              >>> mock_pipe = mock_redis.pipeline.return_value
+              >>> processor = QueueProcessor(mock_redis, ['c'], None,
+              ...         worker_id='w1')
+              >>> processor.heartbeat(get_now=lambda: 1000)
+              >>> mock_pipe.zadd.assert_called_with('c:workers', {'w1': 1000})
+          
+        """
+        
+        if get_now is None:
+            get_now = time.time
+        
+        now = get_now()
+        pipe = self.redis.pipeline(transaction=False)
+        for channel in self.channels:
+            pipe.zadd(self.get_workers_key(channel), {self.worker_id: now})
+        pipe.execute()
+        self._last_heartbeat = now
+    
+    def reap(self, get_now=None):
+        """Re-enqueue the in flight messages of any worker that hasn't been
+          seen for ``self.visibility_timeout`` seconds, i.e.: that has died.
+          Returns the number of messages re-enqueued.
+          
+          Setup::
+          
+              >>> from mock import Mock
+              >>> mock_redis = Mock()
+              >>> mock_redis.zrangebyscore.return_value = ['w2']
+              >>> mock_redis.rpoplpush.side_effect = ['a', 'b', None]
+              >>> mock_redis.zrem.return_value = 1
+              >>> processor = QueueProcessor(mock_redis, ['c'], None,
+              ...         worker_id='w1', visibility_timeout=60)
+          
+          Moves the stale worker's messages back onto the channel::
+          
+              >>> processor.reap(get_now=lambda: 1000)
+              2
+              >>> mock_redis.zrangebyscore.assert_called_with('c:workers', 0, 940)
+              >>> mock_redis.rpoplpush.assert_called_with('c:processing:w2', 'c')
+              >>> mock_redis.zrem.assert_called_with('c:workers', 'w2')
+          
+        """
+        
+        if get_now is None:
+            get_now = time.time
+        
+        now = get_now()
+        count = 0
+        for channel in self.channels:
+            workers_key = self.get_workers_key(channel)
+            cutoff = now - self.visibility_timeout
+            for worker_id in self.redis.zrangebyscore(workers_key, 0, cutoff):
+                if worker_id == self.worker_id:
+                    continue
+                # Only one reaper gets to remove the worker, so only it
+                # re-enqueues the messages.
+                if not self.redis.zrem(workers_key, worker_id):
+                    continue
+                processing = self.get_processing_list(channel, worker_id=worker_id)
+                while self.redis.rpoplpush(processing, channel) is not None:
+                    count += 1
+                logger.warn(('QueueProcessor reaped', worker_id, channel))
+        self._last_reap = now
+        return count
+    
+    def _keep_alive(self, get_now=None):
+        """Reap, if due. (Heartbeats are sent by the heartbeat thread, so they
+          don't depend on how often we pop.)
+        """
+        
+        if get_now is None:
+            get_now = time.time
+        
+        now = get_now()
+        if now - self._last_reap >= self.visibility_timeout / 2.0:
+            self.reap()
+    
+    def _start_heartbeat(self):
+        """In reliable mode, start a thread that heartbeats every quarter of
+          the ``visibility_timeout``.
+        """
+        
+        if not self.reliable:
+            return
+        self._stopping = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._run_heartbeat,
+                args=(self._stopping,))
+        self._heartbeat_thread.daemon = True
+        self._heartbeat_thread.start()
+    
+    def _stop_heartbeat(self):
+        if self._heartbeat_thread is None:
+            return
+        self._stopping.set()
+        self._heartbeat_thread.join()
+        self._heartbeat_thread = None
+    
+    def _run_heartbeat(self, stopping):
+        interval = self.visibility_timeout / 4.0
+        while not stopping.is_set():
+            try:
+                self.heartbeat()
+            except Exception as err:
+                logger.warn(err, exc_info=True)
+            stopping.wait(interval)
+    
+    @property
+    def pop_timeout(self):
+        """Don't block for longer than the promote interval, so delayed jobs
+          are promoted on time even when the queue is empty.
+        """
+        
+        if self.promote_delayed:
+            return min(self.timeout, max(1, int(self.promote_interval)))
+        return self.timeout
+    
+    def _maybe_promote(self):
+        if time.time() - self._last_promote < self.promote_interval:
+            return
+        try:
+            self.promote()
+        except Exception as err:
+            logger.warn(err, exc_info=True)
+    
+    def promote(self, get_now=None):
+        """Move the delayed jobs that are due onto their channels, in bulk.
+          Returns the number of jobs promoted.
+          
+          Setup::
+          
+              >>> from mock import Mock
+              >>> mock_redis = Mock()
+              >>> mock_script = mock_redis.register_script.return_value
+              >>> mock_script.side_effect = [2, 0]
+              >>> processor = QueueProcessor(mock_redis, ['c1', 'c2'], None,
+              ...         promote_delayed=True, promote_limit=50)
+          
+          Runs the promote script for each channel::
+          
+              >>> processor.promote(get_now=lambda: 1000)
+              2
+              >>> mock_script.assert_any_call(keys=['c1:delayed', 'c1'],
+              ...         args=[1000, 50, 'rpush'])
+              >>> mock_script.assert_any_call(keys=['c2:delayed', 'c2'],
+              ...         args=[1000, 50, 'rpush'])
+          
+        """
+        
+        if get_now is None:
+            get_now = time.time
+        
+        if self._promote_script is None:
+            self._promote_script = self.redis.register_script(PROMOTE_SCRIPT)
+        
+        # In reliable mode, messages are consumed from the tail, so push
+        # promoted jobs onto the head, i.e.: the back of the queue.
+        command = 'lpush' if self.reliable else 'rpush'
+        now = get_now()
+        count = 0
+        for channel in self.channels:
+            keys = [get_delayed_key(channel), channel]
+            count += self._promote_script(keys=keys,
+                    args=[now, self.promote_limit, command])
+        self._last_promote = now
+        if count:
+            self._incr('promoted', count)
+        return count
+    
+    def get_retry_delay(self, attempts):
+        """Return how long to wait before retrying a message that has failed
+          ``attempts`` times: ``retry_backoff * 2 ** (attempts - 1)`` seconds,
+          capped at ``retry_max_delay``. Or ``None`` if it has failed more
+          than ``max_retries`` times.
+          
+              >>> processor = QueueProcessor(None, ['c'], None,
+              ...         promote_delayed=True, retry_backoff=2,
+              ...         retry_max_delay=60, max_retries=5)
+          
+          Backs off exponentially::
+          
+              >>> [processor.get_retry_delay(n) for n in (1, 3, 6)]
+              [2, 8, None]
+          
+          Up to the max delay::
+          
+              >>> processor.get_retry_delay(5)
+              32
+              >>> processor.max_retries = None
+              >>> processor.get_retry_delay(50)
+              60
+          
+        """
+        
+        if self.max_retries is not None and attempts > self.max_retries:
+            return None
+        delay = self.retry_backoff * 2 ** min(attempts - 1, 32)
+        return min(delay, self.retry_max_delay)
+    
+    def get_dead_list(self, channel):
+        """Return the name of the list that holds messages from ``channel``
+          that have failed more than ``max_retries`` times.
+        """
+        
+        return '{0}:dead'.format(channel)
+    
+    def _incr(self, name, value=1):
+        self.metrics.incr('{0}.{1}'.format(self.metrics_prefix, name), value)
+    
+    def _timing(self, name, started):
+        ms = (time.time() - started) * 1000
+        self.metrics.timing('{0}.{1}'.format(self.metrics_prefix, name), ms)
+    
+    def _sample(self, get_now=None):
+        """Sample the length of each channel, at most every
+          ``self.sample_interval`` seconds.
+          
+          Setup::
+          
+              >>> from mock import Mock
+              >>> mock_redis = Mock()
+              >>> mock_redis.pipeline.return_value.execute.return_value = [3, 0]
+              >>> mock_metrics = Mock()
+              >>> processor = QueueProcessor(mock_redis, ['c1', 'c2'], None,
+              ...         metrics=mock_metrics, sample_interval=10)
+          
+          Records a gauge per channel::
+          
+              >>> processor._sample(get_now=lambda: 100)
+              >>> mock_metrics.gauge.assert_any_call('queue.length.c1', 3)
+              >>> mock_metrics.gauge.assert_any_call('queue.length.c2', 0)
+          
+          Unless sampled within the interval::
+          
+              >>> mock_metrics.reset_mock()
+              >>> processor._sample(get_now=lambda: 105)
+              >>> mock_metrics.gauge.called
+              False
+          
+          Doesn't query redis when the metrics are discarded::
+          
+              >>> mock_redis.reset_mock()
+              >>> processor = QueueProcessor(mock_redis, ['c1', 'c2'], None)
+              >>> processor._sample(get_now=lambda: 100)
+              >>> mock_redis.pipeline.called
+              False
+          
+        """
+        
+        if get_now is None:
+            get_now = time.time
+        
+        if not self.sample_interval or type(self.metrics) is NullSink:
+            return
+        now = get_now()
+        if now - self._last_sample < self.sample_interval:
+            return
+        self._last_sample = now
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for channel in self.channels:
+                pipe.llen(channel)
+            lengths = pipe.execute()
+        except Exception as err:
+            logger.warn(err, exc_info=True)
+            return
+        for channel, length in zip(self.channels, lengths):
+            name = '{0}.length.{1}'.format(self.metrics_prefix, channel)
+            self.metrics.gauge(name, length)
+    
+    def start(self, in_thread=False, **kwargs):
+        """Either start running or start running in a thread.
+          
+          ``async=True`` is still accepted as a deprecated alias for
+          ``in_thread=True`` (``async`` being a reserved word in Python 3.7+).
+        """
+        
+        if 'async' in kwargs:
+            warnings.warn('start(async=...) is deprecated, use in_thread',
+                    DeprecationWarning, stacklevel=2)
+            in_thread = kwargs.pop('async')
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: {0}'.format(
+                    ', '.join(sorted(kwargs))))
         
         if self.running:
             return
         
-        if async:
+        if in_thread:
             threading.Thread(target=self._start).start()
         else:
             self._start()
     
     def __init__(self, redis_client, channels, handle_function, timeout=20,
-            reconnect_delay=0.005, should_requeue=False):
+            reconnect_delay=0.005, should_requeue=False, batch_size=1,
+            handle_batch=None, concurrency=None, pool_type='thread',
+            reliable=False, worker_id=None, visibility_timeout=300,
+            metrics=None, metrics_prefix='queue', sample_interval=10,
+            promote_delayed=False, promote_interval=1, promote_limit=100,
+            retry_backoff=None, retry_max_delay=3600, max_retries=None,
+            weights=None, channel_concurrency=None):
         """Instantiate a queue processor::
           
               >>> processor = QueueProcessor(None, None, None)
           
+          Pass ``batch_size`` to consume up to that many messages per round
+          trip to redis, and optionally ``handle_batch`` to handle them all
+          in one call (rather than passing each to ``handle_function``)::
+          
+              >>> processor = QueueProcessor(None, None, None, batch_size=100,
+              ...         handle_batch=lambda bodies: None)
+          
+          Pass ``concurrency`` to run the handler on a pool of that many
+          ``thread`` or ``process`` workers::
+          
+              >>> processor = QueueProcessor(None, None, None, concurrency=4,
+              ...         pool_type='process')
+              >>> processor = QueueProcessor(None, None, None, concurrency=4,
+              ...         pool_type='fibre')
+              Traceback (most recent call last):
+              ...
+              ValueError: Invalid pool type: fibre
+          
+          Pass ``reliable=True`` to keep messages in a per worker processing
+          list until they've been handled (see the module docs)::
+          
+              >>> processor = QueueProcessor(None, ['c'], None, reliable=True,
+              ...         visibility_timeout=120)
+              >>> processor.worker_id.count(':')
+              2
+          
+          Pass a ``metrics`` sink (see ``pyramid_weblayer.metrics``) to record
+          throughput, latency, error and queue length metrics::
+          
+              >>> from pyramid_weblayer.metrics import RegistrySink
+              >>> processor = QueueProcessor(None, ['c'], None,
+              ...         metrics=RegistrySink(), sample_interval=30)
+          
+          Pass ``promote_delayed=True`` to move due jobs from the channels'
+          delayed sets (see ``schedule()``) onto the channels, and a
+          ``retry_backoff`` to retry failed messages after an exponentially
+          increasing delay (rather than immediately)::
+          
+              >>> processor = QueueProcessor(None, ['c'], None,
+              ...         should_requeue=True, promote_delayed=True,
+              ...         retry_backoff=5, max_retries=8)
+          
+          As the retries are delayed jobs, a ``retry_backoff`` requires
+          ``promote_delayed``::
+          
+              >>> processor = QueueProcessor(None, ['c'], None, retry_backoff=5)
+              Traceback (most recent call last):
+              ...
+              ValueError: retry_backoff requires promote_delayed=True
+          
+          Pass ``weights`` and / or ``channel_concurrency`` dicts, keyed by
+          channel, to schedule fairly between channels (see the module docs)::
+          
+              >>> processor = QueueProcessor(None, ['a', 'b'], None,
+              ...         concurrency=4, weights={'a': 3, 'b': 1},
+              ...         channel_concurrency={'b': 1})
+          
         """
         
+        if pool_type not in POOL_TYPES:
+            raise ValueError('Invalid pool type: {0}'.format(pool_type))
+        if retry_backoff and not promote_delayed:
+            raise ValueError('retry_backoff requires promote_delayed=True')
+        
         self.redis = redis_client
         self.channels = channels
         self.handle_function = handle_function
         self.timeout = timeout
         self.reconnect_delay = reconnect_delay
         self.should_requeue = should_requeue
+        self.batch_size = max(1, batch_size)
+        self.handle_batch = handle_batch
+        self.concurrency = concurrency
+        self.pool_type = pool_type
+        self.pool = None
+        self.slots = None
+        self.reliable = reliable
+        if worker_id is None:
+            worker_id = '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(),
+                    uuid.uuid4().hex[:8])
+        self.worker_id = worker_id
+        self.visibility_timeout = visibility_timeout
+        self._last_heartbeat = 0
+        self._last_reap = 0
+        self._stopping = None
+        self._heartbeat_thread = None
+        if metrics is None:
+            metrics = NullSink()
+        self.metrics = metrics
+        self.metrics_prefix = metrics_prefix
+        self.sample_interval = sample_interval
+        self._last_sample = 0
+        self.promote_delayed = promote_delayed
+        self.promote_interval = promote_interval
+        self.promote_limit = promote_limit
+        self.retry_backoff = retry_backoff
+        self.retry_max_delay = retry_max_delay
+        self.max_retries = max_retries
+        self._last_promote = 0
+        self._promote_script = None
+        self.weights = weights
+        self.channel_concurrency = channel_concurrency
+        self._capacity = threading.Condition()
+        self._credits = {}
+        self._in_flight = {}
     
 
+
+if sys.version_info >= (3, 5): # pragma: no cover
+    from ._async_queue import AsyncQueueProcessor
@@ -8,19 +8,29 @@ The user needs a policy on AWS that allows it to PUT to DynamoDB.
 You can ignore body of the requests by controlling the regexes set by env var:
 - REQUEST_LOGGER_MIMETYPE_IGNORE_REGEX
 - REQUEST_LOGGER_PATH_IGNORE_REGEX
+Rows are written in the background by a single ``BatchWriter`` thread per
+registry, in batches of up to 25 items. Buffered rows are written when the
+interpreter exits. Its buffer size is set by env var:
+- REQUEST_LOGGER_MAX_BUFFER_SIZE
 """
 
 import logging
 logger = logging.getLogger(__name__)
 
+import atexit
+import collections
 import threading
+import time
 import os
 
 
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
 from boto.dynamodb2.fields import HashKey
 from boto.dynamodb2.table import Table
 from boto import dynamodb2
 
+from zope.interface import Interface
+
 import re
 
 import datetime
@@ -30,6 +40,7 @@ DEFAULTS = {
     'request_logger.path_ignore_regex': os.environ.get('REQUEST_LOGGER_PATH_IGNORE_REGEX', '.*/auth/.*'),
     'request_logger.mimetype_ignore_regex': os.environ.get('REQUEST_LOGGER_MIMETYPE_IGNORE_REGEX', '.*multipart.*'),
     'request_logger.request_id_header_name': os.environ.get('REQUEST_LOGGER_REQUEST_ID_HEADER_NAME', 'X_REQUEST_ID'),
+    'request_logger.max_buffer_size': os.environ.get('REQUEST_LOGGER_MAX_BUFFER_SIZE', 1000),
 }
 
 # 20 KB.
@@ -41,6 +52,10 @@ IGNORE_MIMETYPE_VALIDATOR = re.compile('{0}'.format(DEFAULTS['request_logger.mim
 WRITE_METHODS = ('POST', 'PUT', 'DELETE', 'PATCH')
 REQUEST_ID_HEADER_NAME = DEFAULTS['request_logger.request_id_header_name']
 
+# DynamoDB accepts at most 25 items per batch write.
+BATCH_SIZE = 25
+MAX_BUFFER_SIZE = int(DEFAULTS['request_logger.max_buffer_size'])
+
 def client_factory():
     """Return an AmazonDB client that provides a
       ``put_item(data=data)`` method.
@@ -52,21 +67,353 @@ def client_factory():
         connection=dynamodb2.connect_to_region('eu-west-1')
     )
 
+class MemoryClient(object):
+    """In memory stand-in for the DynamoDB ``Table`` client, so the request
+      logger can be used and tested offline.
+
+          >>> client = MemoryClient()
+          >>> client.put_item(data={'request_id': 'a'})
+          >>> with client.batch_write() as batch:
+          ...     batch.put_item(data={'request_id': 'b'})
+          ...     batch.put_item(data={'request_id': 'c'})
+          >>> [item['request_id'] for item in client.items]
+          ['a', 'b', 'c']
+          >>> client.batch_calls
+          1
+
+      Can be told to throttle the next ``n`` batch writes::
+
+          >>> client.throttle = 1
+          >>> with client.batch_write() as batch: # doctest: +ELLIPSIS
+          ...     batch.put_item(data={'request_id': 'd'})
+          Traceback (most recent call last):
+          ...
+          ProvisionedThroughputExceededException: ...
+          >>> len(client.items)
+          3
+
+    """
+
+    def __init__(self, throttle=0):
+        self.items = []
+        self.batch_calls = 0
+        self.throttle = throttle
+
+    def put_item(self, data, overwrite=False):
+        self.items.append(data)
+
+    def batch_write(self):
+        return MemoryBatch(self)
+
+
+
+class MemoryBatch(object):
+    """Context manager returned by ``MemoryClient.batch_write()``."""
+
+    def __init__(self, client):
+        self.client = client
+        self.to_put = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            return False
+        self.client.batch_calls += 1
+        if self.client.throttle:
+            self.client.throttle -= 1
+            raise ProvisionedThroughputExceededException(400, 'Throttled')
+        self.client.items.extend(self.to_put)
+
+    def put_item(self, data, overwrite=False):
+        self.to_put.append(data)
+
+
+
+class BatchWriter(object):
+    """Write items to DynamoDB in batches from a single background thread.
+
+      Items are held in a bounded ring buffer: when it's full, the oldest
+      item is shed to make room for the newest.
+
+      Setup::
+
+          >>> client = MemoryClient()
+          >>> writer = BatchWriter(client, max_buffer_size=3, sleep=lambda s: None)
+
+      Putting an item just adds it to the buffer::
+
+          >>> for i in range(4):
+          ...     writer.put({'request_id': i})
+          >>> client.items
+          []
+          >>> writer.stats()['dropped']
+          1
+
+      Flushing writes the buffered items in batches::
+
+          >>> writer.flush()
+          3
+          >>> [item['request_id'] for item in client.items]
+          [1, 2, 3]
+          >>> client.batch_calls
+          1
+
+      Throttled batches are retried with exponential backoff::
+
+          >>> client.throttle = 2
+          >>> writer.put({'request_id': 4})
+          >>> writer.flush()
+          1
+          >>> client.batch_calls
+          4
+          >>> writer.stats()['retries']
+          2
+
+      Until ``max_retries`` is exhausted::
+
+          >>> client.throttle = 10
+          >>> writer.put({'request_id': 5})
+          >>> writer.flush()
+          0
+          >>> writer.stats()['failed']
+          1
+
+      Stopping writes whatever is still buffered::
+
+          >>> writer.start()
+          >>> writer.put({'request_id': 6})
+          >>> writer.stop()
+          >>> client.items[-1]
+          {'request_id': 6}
+
+    """
+
+    def __init__(self, client, batch_size=BATCH_SIZE, max_buffer_size=MAX_BUFFER_SIZE,
+            flush_interval=1.0, max_retries=5, backoff=0.1, sleep=None,
+            thread_cls=None):
+        """Initialise the buffer. The writer thread is started lazily."""
+
+        # Compose.
+        if sleep is None:
+            sleep = time.sleep
+        if thread_cls is None:
+            thread_cls = threading.Thread
+
+        # Assign.
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.thread_cls = thread_cls
+
+        # Internal state.
+        self.buffer = collections.deque(maxlen=max_buffer_size)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._is_running = False
+        self._written = 0
+        self._dropped = 0
+        self._failed = 0
+        self._retries = 0
+
+    def put(self, data):
+        """Add an item to the buffer, shedding the oldest item if it's full."""
+
+        with self._condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self._dropped += 1
+            self.buffer.append(data)
+            if len(self.buffer) >= self.batch_size:
+                self._condition.notify()
+
+    def start(self):
+        """Start the writer thread, unless already running."""
+
+        with self._condition:
+            if self._is_running:
+                return
+            self._is_running = True
+            self._thread = self.thread_cls(target=self._run)
+            self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the writer thread, writing whatever is still buffered."""
+
+        with self._condition:
+            if not self._is_running:
+                return
+            self._is_running = False
+            self._condition.notify()
+        self._thread.join(timeout)
+
+    def flush(self):
+        """Write everything that's currently buffered. Returns the number of
+          items written.
+        """
+
+        written = 0
+        while True:
+            with self._condition:
+                batch = []
+                while self.buffer and len(batch) < self.batch_size:
+                    batch.append(self.buffer.popleft())
+            if not batch:
+                break
+            written += self.write(batch)
+        return written
+
+    def write(self, batch):
+        """Write a batch, retrying with backoff when throttled. Returns the
+          number of items written.
+        """
+
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.client.batch_write() as table_batch:
+                    for data in batch:
+                        table_batch.put_item(data=data)
+            except ProvisionedThroughputExceededException as err:
+                if attempt == self.max_retries:
+                    logger.warn(err, exc_info=True)
+                    break
+                with self._condition:
+                    self._retries += 1
+                self.sleep(delay)
+                delay *= 2
+            except UnicodeDecodeError:
+                # Fall back on writing the items one at a time, so only the
+                # offending items have their body replaced.
+                return self._write_each(batch)
+            except Exception as err:
+                logger.warn(err, exc_info=True)
+                break
+            else:
+                with self._condition:
+                    self._written += len(batch)
+                return len(batch)
+        with self._condition:
+            self._failed += len(batch)
+        return 0
+
+    def stats(self):
+        """Return a dict of counters describing the writer's activity."""
+
+        with self._condition:
+            return {
+                'buffered': len(self.buffer),
+                'written': self._written,
+                'dropped': self._dropped,
+                'failed': self._failed,
+                'retries': self._retries,
+            }
+
+    def _write_each(self, batch):
+        written = 0
+        for data in batch:
+            try:
+                put_to_dynamodb(self.client, data)
+            except Exception as err:
+                logger.warn(err, exc_info=True)
+                with self._condition:
+                    self._failed += 1
+            else:
+                written += 1
+                with self._condition:
+                    self._written += 1
+        return written
+
+    def _run(self):
+        """Flush when a batch is full or every ``flush_interval`` seconds."""
+
+        while True:
+            with self._condition:
+                if self._is_running and len(self.buffer) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                is_running = self._is_running
+            self.flush()
+            if not is_running:
+                break
+
+
+
+class IRequestLoggerWriter(Interface):
+    """Marker interface for the registry's ``BatchWriter`` utility."""
+
+
+_writers = []
+_writers_lock = threading.Lock()
+
+def get_writer(registry, client, factory=None):
+    """Return the ``registry``'s started writer, creating one that writes to
+      ``client`` if necessary.
+
+          >>> from mock import Mock
+          >>> from pyramid.registry import Registry
+          >>> registry = Registry()
+          >>> mock_factory = Mock()
+          >>> writer = get_writer(registry, '<client>', factory=mock_factory)
+          >>> mock_factory.assert_called_with('<client>')
+          >>> writer.start.called
+          True
+          >>> get_writer(registry, '<client>', factory=mock_factory) is writer
+          True
+          >>> mock_factory.call_count
+          1
+          >>> _writers.remove(writer)
+
+    """
+
+    if factory is None:
+        factory = BatchWriter
+
+    with _writers_lock:
+        writer = registry.queryUtility(IRequestLoggerWriter)
+        if writer is None:
+            writer = factory(client)
+            writer.start()
+            registry.registerUtility(writer, IRequestLoggerWriter)
+            _writers.append(writer)
+        return writer
+
+def _stop_at_exit():
+    """Write any buffered rows when the interpreter exits."""
+
+    for writer in list(_writers):
+        writer.stop(timeout=5)
+
+atexit.register(_stop_at_exit)
+
+def put_to_dynamodb(client, data):
+    """Make a PUT request to dynamodb2 and insert the data"""
+
+    try:
+        client.put_item(data=data)
+    except UnicodeDecodeError:
+        data['body'] = 'Unicode error when parsing'
+        client.put_item(data=data)
+
 class RequestLoggerTweenFactory(object):
     """Simple pyramid tween to log all of our requests by Heroku request id."""
 
-    def __init__(self, handler, registry, client=None):
+    def __init__(self, handler, registry, client=None, writer_factory=None):
         self.handler = handler
         self.registry = registry
         self.settings = registry.settings
         self.client = client
         if not self.client:
-            # If we are testing and haven't supplied a client, mock it out.
+            # If we are testing and haven't supplied a client, use an
+            # in memory stand-in.
             if self.settings.get('mode') == 'testing':
-                from mock import Mock
-                self.client = Mock()
+                self.client = MemoryClient()
             else:
                 self.client = client_factory()
+        self.writer = get_writer(registry, self.client, factory=writer_factory)
 
     def __call__(self, request):
         """Request logger pyramid tween, logs requests that have errored and
@@ -91,8 +438,8 @@ class RequestLoggerTweenFactory(object):
             raise
 
         # Then if the request was interesting and resulted in
-        # an error response, then spawn a green thread to log
-        # the request data in the background.
+        # an error response, then queue the request data to be
+        # logged in the background.
         if should_log_exc and response.status_int > 399:
             body = self.get_body(request)
             self.log_request(request_id, path, headers, body)
@@ -124,11 +471,7 @@ class RequestLoggerTweenFactory(object):
     def put_to_dynamodb(self, data):
         """Make a PUT request to dynamodb2 and insert the data"""
 
-        try:
-            self.client.put_item(data=data)
-        except UnicodeDecodeError:
-            data['body'] = 'Unicode error when parsing'
-            self.client.put_item(data=data)
+        put_to_dynamodb(self.client, data)
 
     def log_request(self, key, path, headers, body):
         """Log the path, headers and body of the HTTP request on a
@@ -144,6 +487,5 @@ class RequestLoggerTweenFactory(object):
         for k, v in headers.items():
             data[k] = v
 
-        # Fire and forget.
-        t = threading.Thread(target=self.put_to_dynamodb, args=(data,))
-        t.start()
+        # Hand off to the background writer.
+        self.writer.put(data)
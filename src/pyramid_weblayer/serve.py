@@ -6,41 +6,424 @@
       # E.g. in a view callable
       return request.serve_spec('mypkg:foo/bar.js')
   
-  Note that the implementation gets the file using its static url, so
-  this is only really useful as a way to *obfuscate* the actual url
-  that a file is downloaded from, i.e.: if you want to proxy a
-  download so as not to expose the actual url to the file.
+  Note that, unless the spec resolves to a file on disk, the implementation
+  gets the file using its static url, so this is only really useful as a
+  way to *obfuscate* the actual url that a file is downloaded from, i.e.:
+  if you want to proxy a download so as not to expose the actual url to
+  the file.
   
   Note also that this obfuscation is only itself useful if the downloaded
   file is served over HTTPS and has an unguessable file path.
+  
+  Files in locally installed packages, under a registered static view, are
+  served straight from disk with a ``FileResponse`` (which uses the server's
+  ``wsgi.file_wrapper`` when it has one), rather than making an HTTP request
+  to the app itself or its CDN. Other files are streamed from upstream in
+  ``chunk_size`` chunks, so serving it uses constant memory and the client
+  gets the first byte as soon as the upstream does. As the body is passed
+  through undecoded, the client's ``Accept-Encoding`` is passed upstream (or
+  ``identity``, if it sent none), as are ``Range`` and conditional request
+  headers, and the ``Content-Encoding``, ``Content-Length``,
+  ``Content-Range``, ``ETag`` and ``Last-Modified`` response headers are
+  passed back.
+  
+  Downloads share a process wide, connection pooled ``requests`` session,
+  configured by the ``serve.*`` settings in ``DEFAULTS``, so proxying
+  reuses keep-alive connections to the static file host rather than
+  paying for a new TCP and TLS handshake per download.
 """
 
 import logging
 logger = logging.getLogger(__name__)
 
 import mimetypes
+import os
+import posixpath
+import threading
+try: # py2
+    from cookielib import DefaultCookiePolicy
+except ImportError: # py3
+    from http.cookiejar import DefaultCookiePolicy
+
+from pkg_resources import resource_filename
+
 import requests as requests_lib
-from cStringIO import StringIO
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from pyramid.httpexceptions import HTTPNotFound
-from pyramid.response import FileIter
+from pyramid.interfaces import IPackageOverrides
+from pyramid.interfaces import IStaticURLInfo
+from pyramid.response import FileResponse
 from pyramid.response import Response
+from pyramid.static import resolve_asset_spec
+
+CHUNK_SIZE = 64 * 1024
+
+# Request headers passed upstream.
+FORWARD_REQUEST_HEADERS = (
+    'Accept-Encoding',
+    'If-Modified-Since',
+    'If-None-Match',
+    'If-Range',
+    'Range',
+)
+
+# Response headers passed back to the client.
+FORWARD_RESPONSE_HEADERS = (
+    'Accept-Ranges',
+    'Content-Encoding',
+    'Content-Length',
+    'Content-Range',
+    'ETag',
+    'Last-Modified',
+)
+
+# Upstream statuses that are passed through, rather than treated as errors.
+PASS_THROUGH_STATUSES = (200, 206, 304, 416)
+
+# Upstream statuses that are retried.
+RETRY_STATUSES = (502, 503, 504)
+
+DEFAULTS = {
+    'serve.pool_size': 10,
+    'serve.connect_timeout': 3.05,
+    'serve.read_timeout': 30.0,
+    'serve.retries': 2,
+}
+
+class PooledSession(requests_lib.Session):
+    """A ``requests`` session with a connection pool of ``pool_size`` per
+      host, that retries connection errors and gateway errors ``retries``
+      times and applies a default ``(connect, read)`` timeout.
+      
+      As the session is shared between requests, it never stores cookies.
+      
+          >>> session = PooledSession(pool_size=4, retries=1, timeout=(1, 2))
+          >>> adapter = session.get_adapter('https://cdn.com/foo.js')
+          >>> adapter._pool_maxsize, adapter.max_retries.total
+          (4, 1)
+          >>> session.timeout
+          (1, 2)
+          >>> session.cookies._policy.allowed_domains()
+          ()
+      
+    """
+    
+    def __init__(self, pool_size=10, retries=2, timeout=(3.05, 30.0)):
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=()))
+        max_retries = Retry(total=retries, backoff_factor=0.1,
+                status_forcelist=RETRY_STATUSES, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                pool_maxsize=pool_size, max_retries=max_retries)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+    
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(PooledSession, self).request(method, url, **kwargs)
+    
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(settings, factory=None):
+    """Return the process wide session, creating one configured from the
+      ``serve.*`` ``settings`` if necessary.
+      
+          >>> from mock import Mock
+          >>> from pyramid_weblayer import serve
+          >>> _original = serve._session
+          >>> serve._session = None
+          >>> mock_factory = Mock()
+      
+      Creates the session once::
+      
+          >>> session = get_session({'serve.pool_size': '20'},
+          ...         factory=mock_factory)
+          >>> mock_factory.assert_called_with(pool_size=20, retries=2,
+          ...         timeout=(3.05, 30.0))
+          >>> get_session({}, factory=mock_factory) is session
+          True
+          >>> mock_factory.call_count
+          1
+      
+      Teardown::
+      
+          >>> serve._session = _original
+      
+    """
+    
+    global _session
+    
+    if factory is None:
+        factory = PooledSession
+    
+    with _session_lock:
+        if _session is None:
+            config = DEFAULTS.copy()
+            config.update(settings or {})
+            _session = factory(
+                pool_size=int(config['serve.pool_size']),
+                retries=int(config['serve.retries']),
+                timeout=(float(config['serve.connect_timeout']),
+                        float(config['serve.read_timeout'])),
+            )
+        return _session
+
+class UpstreamIter(object):
+    """Iterate over an upstream ``requests`` response in ``chunk_size``
+      chunks, as received (i.e.: without decoding any content encoding),
+      closing it when the WSGI server closes the app iter.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_response = Mock()
+          >>> mock_response.raw.stream.return_value = iter([b'a', b'b'])
+      
+      Test::
+      
+          >>> app_iter = UpstreamIter(mock_response, chunk_size=1)
+          >>> list(app_iter)
+          ['a', 'b']
+          >>> mock_response.raw.stream.assert_called_with(1, decode_content=False)
+          >>> app_iter.close()
+          >>> mock_response.close.called
+          True
+      
+    """
+    
+    def __init__(self, response, chunk_size=CHUNK_SIZE):
+        self.response = response
+        self.chunk_size = chunk_size
+    
+    def __iter__(self):
+        return iter(self.response.raw.stream(self.chunk_size,
+                decode_content=False))
+    
+    def close(self):
+        self.response.close()
+    
+
 
-def get_serve_spec(request, requests=None, buf_cls=None, iter_cls=None,
-        response_cls=None, not_found=None):
-    """Return a function that serves an asset specification as a static file."""
+def get_static_root(registry, spec):
+    """Return the asset spec of the static view that serves ``spec``, or
+      ``None`` if it isn't under one.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_registry = Mock()
+          >>> mock_info = mock_registry.queryUtility.return_value
+          >>> mock_info.registrations = [
+          ...     ('https://cdn.com/', 'mypkg:static/', None),
+          ...     (None, 'otherpkg:', 'static/'),
+          ... ]
+      
+      Test::
+      
+          >>> get_static_root(mock_registry, 'mypkg:static/foo.js')
+          'mypkg:static/'
+          >>> get_static_root(mock_registry, 'otherpkg:foo.js')
+          'otherpkg:'
+          >>> get_static_root(mock_registry, 'mypkg:setup.py')
+          >>> mock_registry.queryUtility.return_value = None
+          >>> get_static_root(mock_registry, 'mypkg:static/foo.js')
+      
+    """
+    
+    info = registry.queryUtility(IStaticURLInfo)
+    for url, root, route_name in getattr(info, 'registrations', ()):
+        if spec.startswith(root):
+            return root
+    return None
+
+def get_local_path(request, spec, get_root=None, isfile=None):
+    """Return the absolute path of the file that the package asset ``spec``
+      resolves to, or ``None`` if it isn't a file on disk that's served by a
+      registered static view.
+      
+      As with Pyramid's static view, the path is normalised, asset overrides
+      are applied and anything outside the static view's directory is
+      rejected.
+      
+      Setup::
+      
+          >>> import os
+          >>> from mock import Mock
+          >>> from pyramid.testing import DummyRequest
+          >>> mock_get_root = Mock()
+          >>> mock_get_root.return_value = 'pyramid_weblayer:templates/'
+          >>> request = DummyRequest()
+          >>> kwargs = dict(get_root=mock_get_root)
+          >>> templates = os.path.join(os.path.dirname(__file__), 'templates')
+      
+      Returns the path of files in local packages::
+      
+          >>> path = get_local_path(request, 'pyramid_weblayer:templates/form.mako',
+          ...         **kwargs)
+          >>> path == os.path.join(templates, 'form.mako')
+          True
+      
+      Ignores urls and specs without a package::
+      
+          >>> get_local_path(request, 'https://cdn.com/foo/bar.txt', **kwargs)
+          >>> get_local_path(request, 'foo/bar.txt', **kwargs)
+      
+      Paths that escape the static view's directory::
+      
+          >>> get_local_path(request, 'pyramid_weblayer:templates/../serve.py',
+          ...         **kwargs)
+          >>> get_local_path(request, 'pyramid_weblayer:templates/../../setup.py',
+          ...         **kwargs)
+      
+      Specs that aren't served by a static view::
+      
+          >>> mock_get_root.return_value = None
+          >>> get_local_path(request, 'pyramid_weblayer:templates/form.mako',
+          ...         **kwargs)
+      
+      And files that don't exist or packages that aren't installed::
+      
+          >>> mock_get_root.return_value = 'nopkg:'
+          >>> get_local_path(request, 'nopkg:foo/bar.txt', **kwargs)
+          >>> mock_get_root.return_value = 'pyramid_weblayer:templates/'
+          >>> get_local_path(request, 'pyramid_weblayer:templates/missing.mako',
+          ...         **kwargs)
+      
+    """
     
     # Compose.
-    if requests is None:
-        requests = requests_lib
-    if buf_cls is None:
-        buf_cls = StringIO
+    if get_root is None:
+        get_root = get_static_root
+    if isfile is None:
+        isfile = os.path.isfile
+    
+    if ':' not in spec or '://' in spec:
+        return None
+    root = get_root(request.registry, spec)
+    if root is None or ':' not in root:
+        return None
+    
+    # Normalise the path, rejecting anything outside the static view's
+    # directory.
+    package_name, resource_name = resolve_asset_spec(spec)
+    root_name = resolve_asset_spec(root)[1].rstrip('/')
+    resource_name = posixpath.normpath(resource_name)
+    if resource_name.startswith('/') or resource_name.split('/')[0] == '..':
+        return None
+    if root_name and not resource_name.startswith(root_name + '/'):
+        return None
+    
+    # Apply any asset overrides, then fall back on the package itself.
+    path = None
+    overrides = request.registry.queryUtility(IPackageOverrides,
+            name=package_name)
+    if overrides is not None:
+        path = overrides.get_filename(resource_name)
+    if path is None:
+        try:
+            path = resource_filename(package_name, resource_name)
+        except ImportError:
+            return None
+    if not isfile(path):
+        return None
+    return os.path.abspath(path)
+
+
+def get_serve_spec(request, session=None, iter_cls=None, response_cls=None,
+        not_found=None, chunk_size=CHUNK_SIZE, get_local=None,
+        file_response_cls=None):
+    """Return a function that serves an asset specification as a static file.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_request = Mock()
+          >>> mock_request.static_url.return_value = '//cdn.com/foo/bar.txt'
+          >>> mock_request.headers = {'Range': 'bytes=0-9', 'Cookie': 'a=b'}
+          >>> mock_session = Mock()
+          >>> mock_upstream = mock_session.get.return_value
+          >>> mock_upstream.status_code = 206
+          >>> mock_upstream.headers = {'Content-Length': '10',
+          ...         'Content-Range': 'bytes 0-9/100', 'ETag': '"abc"',
+          ...         'Set-Cookie': 'c=d'}
+          >>> mock_upstream.raw.stream.return_value = iter([b'0123456789'])
+          >>> mock_get_local = Mock()
+          >>> mock_get_local.return_value = None
+          >>> serve = get_serve_spec(mock_request, session=mock_session,
+          ...         get_local=mock_get_local)
+      
+      Streams the upstream response, passing the range through::
+      
+          >>> response = serve('mypkg:foo/bar.txt')
+          >>> mock_session.get.assert_called_with('https://cdn.com/foo/bar.txt',
+          ...         headers={'Accept-Encoding': 'identity',
+          ...         'Range': 'bytes=0-9'}, stream=True)
+          >>> response.status_int, response.body
+          (206, '0123456789')
+          >>> response.headers['Content-Range'], response.headers['ETag']
+          ('bytes 0-9/100', '"abc"')
+          >>> response.content_type, response.headers['Content-Disposition']
+          ('text/plain', 'attachment; filename="bar.txt"')
+          >>> 'Set-Cookie' in response.headers
+          False
+      
+      Returns a 404 if the file can't be downloaded::
+      
+          >>> mock_upstream.status_code = 500
+          >>> serve('mypkg:foo/bar.txt').status_int
+          404
+          >>> mock_upstream.close.called
+          True
+      
+      Or if the download fails::
+      
+          >>> mock_session.get.side_effect = requests_lib.ConnectionError
+          >>> serve('mypkg:foo/bar.txt').status_int
+          404
+      
+      Or if the path climbs out of its directory::
+      
+          >>> serve('mypkg:foo/../../setup.py').status_int
+          404
+      
+      Files on disk are served without an HTTP request::
+      
+          >>> mock_session.reset_mock()
+          >>> mock_get_local.return_value = '/var/mypkg/foo/bar.txt'
+          >>> mock_file_response_cls = Mock()
+          >>> mock_file_response_cls.return_value.headers = {}
+          >>> serve = get_serve_spec(mock_request, session=mock_session,
+          ...         get_local=mock_get_local,
+          ...         file_response_cls=mock_file_response_cls)
+          >>> response = serve('mypkg:foo/bar.txt')
+          >>> mock_file_response_cls.assert_called_with('/var/mypkg/foo/bar.txt',
+          ...         request=mock_request, content_type='text/plain')
+          >>> response.headers['Content-Disposition']
+          'attachment; filename="bar.txt"'
+          >>> mock_session.get.called
+          False
+      
+    """
+    
+    # Compose.
+    if session is None:
+        session = get_session(request.registry.settings)
     if iter_cls is None:
-        iter_cls = FileIter
+        iter_cls = UpstreamIter
     if response_cls is None:
         response_cls = Response
     if not_found is None:
         not_found = HTTPNotFound
+    if get_local is None:
+        get_local = get_local_path
+    if file_response_cls is None:
+        file_response_cls = FileResponse
     
     # Prepare.
     not_found_msg = u'The static file could not be found.'
@@ -53,24 +436,57 @@ def get_serve_spec(request, requests=None, buf_cls=None, iter_cls=None,
           a 404.
         """
         
-        # Resolve the spec to a url.
-        url = request.static_url(spec)
+        filename = spec.split(':')[-1].split('/')[-1]
+        disposition = 'attachment; filename="{0}"'.format(filename)
+        mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        
+        # Refuse paths that climb out of their directory.
+        resource_name = spec.split(':')[-1]
+        if resource_name.startswith('/') or '..' in resource_name.split('/'):
+            return not_found(explanation=not_found_msg)
+        
+        # If the spec resolves to a file on disk, serve it directly.
+        path = get_local(request, spec)
+        if path is not None:
+            response = file_response_cls(path, request=request,
+                    content_type=mime_type)
+            response.headers['Content-Disposition'] = disposition
+            return response
+        
+        # Otherwise resolve the spec to a url.
+        try:
+            url = request.static_url(spec)
+        except ValueError:
+            return not_found(explanation=not_found_msg)
         if url.startswith('//'):
             url = 'https:' + url
         
-        # Download the url.
-        r = requests.get(url)
-        if r.status_code != requests.codes.ok:
+        # Start downloading the url.
+        headers = {}
+        for name in FORWARD_REQUEST_HEADERS:
+            value = request.headers.get(name)
+            if value is not None:
+                headers[name] = value
+        # Stop ``requests`` asking for an encoding the client can't decode.
+        headers.setdefault('Accept-Encoding', 'identity')
+        try:
+            r = session.get(url, headers=headers, stream=True)
+        except requests_lib.RequestException as err:
+            logger.warning(err, exc_info=True)
+            return not_found(explanation=err_message)
+        if r.status_code not in PASS_THROUGH_STATUSES:
+            r.close()
             msg = not_found_msg if r.status_code == 404 else err_message
             return not_found(explanation=msg)
         
-        # Return the file response.
-        filename = spec.split('/')[-1]
-        disposition = 'attachment; filename="{0}"'.format(filename)
-        mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-        response = Response(content_type=mime_type)
+        # Return a file response that streams the download.
+        response = response_cls(status=r.status_code, content_type=mime_type,
+                app_iter=iter_cls(r, chunk_size=chunk_size))
         response.headers['Content-Disposition'] = disposition
-        response.body = r.content
+        for name in FORWARD_RESPONSE_HEADERS:
+            value = r.headers.get(name)
+            if value is not None:
+                response.headers[name] = value
         return response
     
     
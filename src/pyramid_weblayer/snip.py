@@ -5,7 +5,12 @@
 import logging
 logger = logging.getLogger(__name__)
 
-import html2text
+import re
+
+from .htmltext import get_engine
+from .htmltext import map_items
+
+WORD = re.compile(r'\S+', re.UNICODE)
 
 def snip_text(text, n=140):
     """Snip text at word boundary. Defaults to 140 characters.
@@ -31,9 +36,12 @@ def snip_text(text, n=140):
     if len(text) < n:
         return text
     
+    # Scan word by word, stopping at the cut off, rather than splitting the
+    # whole text.
     i = 0
     words = []
-    for item in text.split():
+    for match in WORD.finditer(text):
+        item = match.group()
         l = len(item)
         if i + l < n:
             words.append(item)
@@ -43,7 +51,8 @@ def snip_text(text, n=140):
     return u'{0} …'.format(u' '.join(words))
 
 def snip_html(html, n=140, handler=None, snip=None):
-    """Snip html => raw text at word boundary.
+    """Snip html => raw text at word boundary. Only as much of the html as is
+      needed to produce ``n`` characters of text is parsed.
       
           >>> html = 'Hello <em>is it me</em> you are looking for? ' * 10
           >>> snip_html(html)
@@ -54,22 +63,45 @@ def snip_html(html, n=140, handler=None, snip=None):
     """
     
     # Test jig.
-    if handler is None:
-        handler = html2text.HTML2Text()
-        handler.ignore_links = True
-        handler.ignore_images = True
     if snip is None:
        snip = snip_text
     
-    # Turn the html into plain text.
-    text = handler.handle(html)
+    # Turn (the start of) the html into plain text.
+    if handler is None:
+        text = get_engine().convert_prefix(html, n)
+    else:
+        text = handler.handle(html)
     
     # Run it through the snip text function.
     return snip(text, n=n)
 
 
+def snip_texts(texts, n=140, pool=None):
+    """Snip a list of ``texts``, optionally fanning out across a ``pool``
+      (see ``pyramid_weblayer.htmltext.map_items``).
+      
+          >>> snip_texts([u'lorum ipsum dolores', None], n=8)
+          [u'lorum \u2026', u'']
+      
+    """
+    
+    return map_items(snip_text, texts, pool=pool, n=n)
+
+def snip_htmls(htmls, n=140, pool=None):
+    """Snip a list of ``htmls``, optionally fanning out across a ``pool``.
+      Repeated items are only converted once.
+      
+          >>> snip_htmls([u'<em>is it me</em>', u'you are looking for?'], n=8)
+          [u'_is it \u2026', u'you are \u2026']
+      
+    """
+    
+    return map_items(snip_html, htmls, pool=pool, n=n)
+
+
 def add_snip_functions(event):
-    """Add ``snip_text`` and ``snip_html`` functions to the template namespace.
+    """Add the ``snip_text`` and ``snip_html`` functions, and their bulk
+      ``snip_texts`` and ``snip_htmls`` variants, to the template namespace.
       
           >>> event = {}
           >>> add_snip_functions(event)
@@ -77,9 +109,15 @@ def add_snip_functions(event):
           True
           >>> event['snip_html'] == snip_html
           True
+          >>> event['snip_texts'] == snip_texts
+          True
+          >>> event['snip_htmls'] == snip_htmls
+          True
       
     """
     
     event['snip_text'] = snip_text
     event['snip_html'] = snip_html
+    event['snip_texts'] = snip_texts
+    event['snip_htmls'] = snip_htmls
 
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for `pyramid_weblayer._async_queue`.
+
+  The module under test is Python 3.5+ only, so the tests are skipped on
+  older versions. They're written without ``async`` syntax (the fake redis
+  returns futures) so this module still imports on Python 2.
+"""
+
+import sys
+import unittest
+
+IS_SUPPORTED = sys.version_info >= (3, 5)
+
+if IS_SUPPORTED: # pragma: no cover
+    import asyncio
+
+class FakeAsyncRedis(object):
+    """In memory stand-in for the async redis list commands."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.lists = {}
+        self.waiters = []
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+        self._wake()
+        return self._resolved(len(self.lists[key]))
+
+    def blpop(self, keys, timeout=0):
+        future = self.loop.create_future()
+        self.waiters.append((future, keys))
+        self.loop.call_later(timeout, self._expire, future)
+        self._wake()
+        return future
+
+    def _resolved(self, value):
+        future = self.loop.create_future()
+        future.set_result(value)
+        return future
+
+    def _expire(self, future):
+        if not future.done():
+            future.set_result(None)
+
+    def _wake(self):
+        for future, keys in list(self.waiters):
+            if future.done():
+                self.waiters.remove((future, keys))
+                continue
+            for key in keys:
+                if self.lists.get(key):
+                    self.waiters.remove((future, keys))
+                    future.set_result((key, self.lists[key].pop(0)))
+                    break
+
+
+@unittest.skipUnless(IS_SUPPORTED, 'Requires Python 3.5+')
+class TestAsyncQueueProcessor(unittest.TestCase):
+    """Test the logic of py:class:`~pyramid_weblayer._async_queue.AsyncQueueProcessor`."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.redis = FakeAsyncRedis(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def makeOne(self, handler, **kwargs):
+        from .._async_queue import AsyncQueueProcessor
+        kwargs.setdefault('timeout', 0.05)
+        return AsyncQueueProcessor(self.redis, ['c'], handler, **kwargs)
+
+    def run_until(self, processor, done, limit=5):
+        processor.start()
+        try:
+            self.loop.run_until_complete(asyncio.wait_for(done, limit))
+        finally:
+            self.loop.run_until_complete(processor.stop(timeout=limit))
+
+    def test_plain_handler(self):
+        """Plain functions are called with each message."""
+
+        handled = []
+        done = self.loop.create_future()
+        def handle(body):
+            handled.append(body)
+            if len(handled) == 3 and not done.done():
+                done.set_result(None)
+        self.redis.rpush('c', 'a', 'b', 'c')
+        self.run_until(self.makeOne(handle), done)
+        self.assertEqual(handled, ['a', 'b', 'c'])
+
+    def test_concurrency(self):
+        """Awaitable handlers run concurrently, never exceeding the
+          concurrency, and in flight handlers finish when stopped.
+        """
+
+        state = {'active': 0, 'peak': 0, 'done': 0}
+        done = self.loop.create_future()
+        def finish(future):
+            state['active'] -= 1
+            state['done'] += 1
+            future.set_result(None)
+            if state['done'] == 10 and not done.done():
+                done.set_result(None)
+        def handle(body):
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+            future = self.loop.create_future()
+            self.loop.call_later(0.01, finish, future)
+            return future
+        self.redis.rpush('c', *range(10))
+        self.run_until(self.makeOne(handle, concurrency=3), done)
+        self.assertEqual(state['done'], 10)
+        self.assertEqual(state['peak'], 3)
+
+    def test_requeues(self):
+        """Failed messages are requeued when ``should_requeue``."""
+
+        calls = []
+        done = self.loop.create_future()
+        def handle(body):
+            calls.append(body)
+            if len(calls) == 1:
+                raise ValueError(body)
+            if not done.done():
+                done.set_result(None)
+        self.redis.rpush('c', 'bad')
+        self.run_until(self.makeOne(handle, should_requeue=True), done)
+        self.assertEqual(calls, ['bad', 'bad'])
+
+    def test_stop_cancels_blocking_pop(self):
+        """Stopping doesn't wait for a blocking pop to time out."""
+
+        processor = self.makeOne(None, timeout=60)
+        processor.start()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        started = self.loop.time()
+        self.loop.run_until_complete(processor.stop())
+        self.assertTrue(self.loop.time() - started < 1)
+        self.assertFalse(processor.running)
+
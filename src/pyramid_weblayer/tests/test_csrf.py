@@ -3,6 +3,7 @@
 
 """Unit tests for `pyramid_weblayer.csrf`."""
 
+import time
 import unittest
 
 try: # pragma: no cover
@@ -10,6 +11,14 @@ try: # pragma: no cover
 except: # pragma: no cover
     pass
 
+def make_registry(settings):
+    """Return a real (empty) registry with ``settings``."""
+    
+    from pyramid.registry import Registry
+    registry = Registry()
+    registry.settings = settings
+    return registry
+
 class TestCSRFValidator(unittest.TestCase):
     """Test the logic of py:class:`~pyramid_weblayer.csrf.CSRFValidator`."""
     
@@ -165,6 +174,50 @@ class TestCSRFValidator(unittest.TestCase):
     
 
 
+class TestCSRFExemptions(unittest.TestCase):
+    """Test the logic of py:class:`~pyramid_weblayer.csrf.CSRFExemptions`."""
+    
+    def makeOne(self, **settings):
+        from ..csrf import CSRFExemptions
+        return CSRFExemptions.from_settings(settings)
+    
+    def test_empty(self):
+        """No exemptions match nothing."""
+        
+        exemptions = self.makeOne()
+        self.assertFalse(exemptions)
+        self.assertFalse(exemptions.matches_path('/'))
+        self.assertFalse(exemptions.matches_route('home'))
+    
+    def test_longest_and_shortest_prefixes(self):
+        """Any matching prefix exempts the path, however many there are."""
+        
+        paths = ' '.join(['/api/v{0}/'.format(i) for i in range(500)])
+        exemptions = self.makeOne(**{'csrf.ignore_paths': paths + ' /ab'})
+        self.assertTrue(exemptions.matches_path('/api/v499/users'))
+        self.assertTrue(exemptions.matches_path('/api/v12/'))
+        self.assertTrue(exemptions.matches_path('/ab'))
+        self.assertTrue(exemptions.matches_path('/about'))
+        self.assertFalse(exemptions.matches_path('/a'))
+        self.assertFalse(exemptions.matches_path('/api/v500/users'))
+        self.assertFalse(exemptions.matches_path('/api/v1'))
+        self.assertFalse(exemptions.matches_path('/'))
+    
+    def test_globs(self):
+        """Paths and routes can be glob patterns."""
+        
+        exemptions = self.makeOne(**{
+            'csrf.ignore_routes': 'hooks.*',
+            'csrf.ignore_paths': '/shops/*/webhooks/ /static/**.json',
+        })
+        self.assertTrue(exemptions.matches_route('hooks.stripe.charge'))
+        self.assertFalse(exemptions.matches_route('hook'))
+        self.assertTrue(exemptions.matches_path('/shops/1/webhooks/x'))
+        self.assertFalse(exemptions.matches_path('/shops/1/2/webhooks/x'))
+        self.assertTrue(exemptions.matches_path('/static/a/b/c.json'))
+    
+
+
 class TestCSRFSubscriber(unittest.TestCase):
     """Test the logic of ``pyramid_weblayer.csrf.validate_against_csrf``."""
     
@@ -174,14 +227,16 @@ class TestCSRFSubscriber(unittest.TestCase):
         from ..csrf import validate_against_csrf
         
         mock_request = Mock()
-        mock_request.registry.settings = {}
+        mock_request.method = 'POST'
+        mock_request.path = '/'
+        mock_request.registry = make_registry({})
         mock_validator = Mock()
         mock_validator_factory = Mock()
         mock_validator_factory.return_value = mock_validator
         mock_event = Mock()
         mock_event.request = mock_request
         
-        validate_against_csrf(mock_event, Validator=mock_validator_factory)
+        validate_against_csrf(mock_event, validator_cls=mock_validator_factory)
         mock_validator.validate.assert_called_with(mock_request)
     
     def test_doesnt_validate_the_request(self):
@@ -192,14 +247,14 @@ class TestCSRFSubscriber(unittest.TestCase):
         from ..csrf import validate_against_csrf
         
         mock_request = Mock()
-        mock_request.registry.settings = {'csrf.validate': False}
+        mock_request.registry = make_registry({'csrf.validate': False})
         mock_validator = Mock()
         mock_validator_factory = Mock()
         mock_validator_factory.return_value = mock_validator
         mock_event = Mock()
         mock_event.request = mock_request
         
-        validate_against_csrf(mock_event, Validator=mock_validator_factory)
+        validate_against_csrf(mock_event, validator_cls=mock_validator_factory)
         self.assertRaises(
             AssertionError,
             mock_validator.validate.assert_called_with,
@@ -216,7 +271,9 @@ class TestCSRFSubscriber(unittest.TestCase):
             raise CSRFError
         
         mock_request = Mock()
-        mock_request.registry.settings = {}
+        mock_request.method = 'POST'
+        mock_request.path = '/'
+        mock_request.registry = make_registry({})
         mock_validator = Mock()
         mock_validator_factory = Mock()
         mock_validator_factory.return_value = mock_validator
@@ -228,7 +285,137 @@ class TestCSRFSubscriber(unittest.TestCase):
             HTTPUnauthorized,
             validate_against_csrf,
             mock_event, 
-            Validator=mock_validator_factory
+            validator_cls=mock_validator_factory
         )
     
 
+    
+    def test_safe_methods_dont_load_the_session(self):
+        """GET and HEAD requests never touch the session backend, whereas
+          requests with side effects load it once.
+        """
+        
+        from ..csrf import validate_against_csrf
+        
+        class CountingSession(object):
+            """Count the calls that would hit the session backend."""
+            
+            calls = 0
+            
+            def get_csrf_token(self):
+                self.calls += 1
+                return 'token'
+            
+        
+        session = CountingSession()
+        def make_event(method):
+            mock_event = Mock()
+            mock_event.request.method = method
+            mock_event.request.path = '/'
+            mock_event.request.params = {'_csrf': 'token'}
+            mock_event.request.registry = make_registry({})
+            mock_event.request.session = session
+            return mock_event
+        
+        for i in range(1000):
+            validate_against_csrf(make_event('GET'))
+            validate_against_csrf(make_event('HEAD'))
+        self.assertEqual(session.calls, 0)
+        
+        for i in range(1000):
+            validate_against_csrf(make_event('POST'))
+        self.assertEqual(session.calls, 1000)
+    
+
+
+class TestSignedCSRF(unittest.TestCase):
+    """Test ``validate_against_csrf`` in the stateless, signed token mode."""
+    
+    def make_event(self, cookie_token, submitted_token, **settings):
+        settings.setdefault('csrf.mode', 'signed')
+        settings.setdefault('csrf.secret', 'secret')
+        mock_event = Mock()
+        mock_event.request.method = 'POST'
+        mock_event.request.path = '/'
+        mock_event.request.headers = {'X-CSRFToken': submitted_token}
+        mock_event.request.params = {}
+        mock_event.request.cookies = {'csrf_token': cookie_token}
+        mock_event.request.registry = make_registry(settings)
+        mock_event.request.session.get_csrf_token.side_effect = AssertionError
+        return mock_event
+    
+    def test_valid_token(self):
+        """A signed token echoed from the cookie validates without the session."""
+        
+        from ..csrf import make_signed_token, validate_against_csrf
+        
+        token = make_signed_token('secret')
+        self.assertTrue(validate_against_csrf(self.make_event(token, token)) is None)
+    
+    def test_invalid_tokens(self):
+        """Mismatched, forged and expired tokens are rejected."""
+        
+        from pyramid.httpexceptions import HTTPUnauthorized
+        from ..csrf import make_signed_token, validate_against_csrf
+        
+        token = make_signed_token('secret')
+        other = make_signed_token('secret')
+        forged = make_signed_token('forged')
+        expired = make_signed_token('secret', get_now=lambda: time.time() - 120)
+        events = (
+            self.make_event(token, other),
+            self.make_event(token, None),
+            self.make_event(forged, forged),
+            self.make_event(expired, expired, **{'csrf.max_age': '60'}),
+        )
+        for event in events:
+            self.assertRaises(HTTPUnauthorized, validate_against_csrf, event)
+    
+    def test_clock_skew(self):
+        """Tokens issued by a node whose clock is slightly ahead validate, up
+          to ``csrf.max_skew`` seconds.
+        """
+        
+        from pyramid.httpexceptions import HTTPUnauthorized
+        from ..csrf import make_signed_token, validate_against_csrf
+        
+        ahead = make_signed_token('secret', get_now=lambda: time.time() + 5)
+        self.assertTrue(validate_against_csrf(self.make_event(ahead, ahead)) is None)
+        event = self.make_event(ahead, ahead, **{'csrf.max_skew': '0'})
+        self.assertRaises(HTTPUnauthorized, validate_against_csrf, event)
+        future = make_signed_token('secret', get_now=lambda: time.time() + 600)
+        event = self.make_event(future, future)
+        self.assertRaises(HTTPUnauthorized, validate_against_csrf, event)
+    
+    def test_requires_secret(self):
+        """The signed mode can't be configured without a secret."""
+        
+        from ..csrf import validate_csrf_settings
+        
+        settings = {'csrf.mode': 'signed', 'csrf.secret': ''}
+        self.assertRaises(ValueError, validate_csrf_settings, settings)
+    
+    def test_panel_uses_the_request_token(self):
+        """On a first visit, the ajax setup panel and the forms embed the
+          same newly issued token, which is the one set in the cookie.
+        """
+        
+        from pyramid.request import Request
+        from pyramid.response import Response
+        from ..cache import LRUCache
+        from ..csrf import csrf_ajax_setup_panel, get_csrf_token
+        
+        request = Request.blank('/')
+        request.registry = make_registry({'csrf.mode': 'signed',
+                'csrf.secret': 'secret'})
+        request.set_property(get_csrf_token, 'csrf_token', reify=True)
+        render = lambda spec, data, request=None: data['token']
+        panel_token = csrf_ajax_setup_panel(None, request, cache=LRUCache(),
+                render_template=render)
+        self.assertEqual(panel_token, request.csrf_token)
+        response = Response()
+        request._process_response_callbacks(response)
+        cookies = response.headers.getall('Set-Cookie')
+        self.assertEqual(len(cookies), 1)
+        self.assertTrue(cookies[0].startswith('csrf_token=' + panel_token))
+    
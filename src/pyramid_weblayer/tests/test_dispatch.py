@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Functional tests for `pyramid_weblayer.dispatch` against a local http
+  stand-in for the google analytics endpoint.
+"""
+
+import threading
+import time
+import unittest
+
+try: # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError: # py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Count hits and connections, responding with keep-alive."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        self.respond()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length'))
+        self.server.posts.append((self.path, self.rfile.read(length),
+                self.headers.get('Host')))
+        self.respond()
+
+    def respond(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/gif')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = 0
+        self.hits = []
+        self.posts = []
+
+
+class TestTrackingDispatcher(unittest.TestCase):
+    """Test the logic of py:class:`~pyramid_weblayer.dispatch.TrackingDispatcher`."""
+
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        host, port = self.server.server_address
+        self.endpoint = 'http://{0}:{1}/__utm.gif'.format(host, port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def makeOne(self, **kwargs):
+        from ..dispatch import TrackingDispatcher
+        return TrackingDispatcher(endpoint=self.endpoint, **kwargs)
+
+    def track(self, dispatcher, n, label=None):
+        from pyga.entities import Event, Session, Visitor
+        from pyga.requests import Tracker
+        tracker = Tracker('UA-12345-1', 'example.com')
+        session = Session()
+        visitor = Visitor()
+        for i in range(n):
+            event = Event(category='cat', action='act{0}'.format(i),
+                    label=label)
+            dispatcher.track_event(tracker, event, session, visitor)
+
+    def test_batches_reuse_connection(self):
+        """Hits are sent over a single keep-alive connection."""
+
+        dispatcher = self.makeOne(batch_size=10, flush_interval=60)
+        flushes = []
+        flush = dispatcher.flush
+        dispatcher.flush = lambda: flushes.append(flush())
+        dispatcher.start()
+        self.track(dispatcher, 50)
+        dispatcher.stop()
+        self.assertEqual(len(self.server.hits), 50)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(dispatcher.stats()['sent'], 50)
+        self.assertTrue(all(item.startswith('/__utm.gif?') for item in self.server.hits))
+        # The hits were sent in a handful of batches, not one flush per hit.
+        self.assertEqual(sum(flushes), 50)
+        self.assertTrue(len([n for n in flushes if n]) <= 6, flushes)
+
+    def test_long_hits_are_posted(self):
+        """Hits with a long query string are POSTed to the endpoint."""
+
+        dispatcher = self.makeOne(batch_size=100, flush_interval=60)
+        self.track(dispatcher, 2, label='x' * 2100)
+        self.assertEqual(dispatcher.flush(), 2)
+        self.assertEqual(dispatcher.stats()['failed'], 0)
+        self.assertEqual(len(self.server.posts), 2)
+        path, body, host = self.server.posts[0]
+        self.assertEqual(path, '/__utm.gif')
+        self.assertTrue('x' * 2100 in body)
+        self.assertEqual(host, self.endpoint.split('/')[2])
+
+    def test_flushes_on_interval(self):
+        """Hits are sent after ``flush_interval`` even if the batch isn't full."""
+
+        dispatcher = self.makeOne(batch_size=100, flush_interval=0.05)
+        dispatcher.start()
+        self.track(dispatcher, 3)
+        for _ in range(100):
+            if len(self.server.hits) == 3:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(self.server.hits), 3)
+        dispatcher.stop()
+
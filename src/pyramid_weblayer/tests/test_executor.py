@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for `pyramid_weblayer.executor`."""
+
+import threading
+import time
+import unittest
+
+class TestBackgroundExecutor(unittest.TestCase):
+    """Test the logic of py:class:`~pyramid_weblayer.executor.BackgroundExecutor`."""
+
+    def makeOne(self, **kwargs):
+        from ..executor import BackgroundExecutor
+        return BackgroundExecutor(**kwargs)
+
+    def test_burst_reaches_max_workers(self):
+        """A burst of jobs runs ``max_workers`` at a time, rather than being
+          queued behind the first worker.
+        """
+
+        executor = self.makeOne(max_workers=4, max_queue_size=100)
+        lock = threading.Lock()
+        release = threading.Event()
+        state = {'active': 0, 'peak': 0}
+        def job():
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            release.wait(5)
+            with lock:
+                state['active'] -= 1
+        for i in range(8):
+            executor.submit(job)
+        deadline = time.time() + 5
+        while state['peak'] < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        executor.shutdown(wait=True, timeout=5)
+        self.assertEqual(state['peak'], 4)
+        self.assertEqual(executor.stats()['workers'], 4)
+        self.assertEqual(executor.stats()['completed'], 8)
+
+    def test_idle_workers_are_reused(self):
+        """Sequential jobs don't start more workers than they need."""
+
+        executor = self.makeOne(max_workers=4)
+        done = threading.Event()
+        for i in range(3):
+            done.clear()
+            executor.submit(done.set)
+            done.wait(5)
+            while executor._idle < 1:
+                time.sleep(0.001)
+        executor.shutdown(wait=True, timeout=5)
+        self.assertEqual(executor.stats()['workers'], 1)
+
+
+    def test_shutdown_waits_for_jobs_being_submitted(self):
+        """A job submitted as the executor shuts down is run, rather than
+          being queued behind the workers' stop sentinels.
+        """
+
+        from ..executor import queue_lib
+        entered = threading.Event()
+        release = threading.Event()
+        class StallingQueue(queue_lib.Queue):
+            def put_nowait(self, item):
+                entered.set()
+                release.wait(5)
+                return queue_lib.Queue.put_nowait(self, item)
+
+        executor = self.makeOne(max_workers=1, queue_cls=StallingQueue)
+        ran = []
+        submitter = threading.Thread(target=executor.submit,
+                args=(ran.append, (1,)))
+        submitter.start()
+        entered.wait(5)
+        stopper = threading.Thread(target=executor.shutdown,
+                kwargs={'wait': True, 'timeout': 5})
+        stopper.start()
+        time.sleep(0.05)
+        self.assertTrue(stopper.is_alive())
+        release.set()
+        submitter.join(5)
+        stopper.join(5)
+        self.assertEqual(ran, [1])
+        self.assertFalse(executor.submit(ran.append, (2,)))
+        self.assertEqual(ran, [1])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for `pyramid_weblayer.i18n`."""
+
+import unittest
+
+class FakeTranslations(object):
+    """Counts lookups and prefixes each message with ``prefix``."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.calls = 0
+
+    def ugettext(self, msgid):
+        self.calls += 1
+        return self.prefix + msgid
+
+    def dugettext(self, domain, msgid):
+        return self.ugettext(msgid)
+
+    gettext = ugettext
+    dgettext = dugettext
+
+class TestTranslationCache(unittest.TestCase):
+    """Test the memoization in py:class:`~pyramid_weblayer.i18n.TranslationAdapter`."""
+
+    def setUp(self):
+        from ..cache import LRUCache
+        self.cache = LRUCache(max_size=100)
+
+    def make_request(self, locale_name='fr', translations=None):
+        from pyramid.i18n import Localizer
+        from pyramid.testing import DummyRequest
+        if translations is None:
+            translations = FakeTranslations(u'fr: ')
+        request = DummyRequest()
+        request.localizer = Localizer(locale_name, translations)
+        return request
+
+    def makeOne(self, request, domain=None):
+        from ..i18n import TranslationAdapter
+        return TranslationAdapter(request, domain=domain, cache=self.cache)
+
+    def test_hits_and_misses(self):
+        """Each distinct message is translated once, however many requests
+          render it.
+        """
+
+        request = self.make_request()
+        translations = request.localizer.translations
+        for i in range(10):
+            translator = self.makeOne(self.make_request(translations=translations))
+            self.assertEqual(translator.translate('Hello'), u'fr: Hello')
+            self.assertEqual(translator.translate('Bye'), u'fr: Bye')
+        stats = self.cache.stats()
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 18)
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(translations.calls, 2)
+
+    def test_keyed_by_locale_and_domain(self):
+        """Locales and domains don't share entries."""
+
+        request = self.make_request()
+        translations = request.localizer.translations
+        self.makeOne(request).translate('Hello')
+        self.makeOne(request, domain='other').translate('Hello')
+        self.makeOne(self.make_request('de', translations)).translate('Hello')
+        self.assertEqual(self.cache.stats()['misses'], 3)
+        self.assertEqual(self.cache.stats()['size'], 3)
+
+    def test_invalidated_by_new_translations(self):
+        """Reloading the catalog (i.e.: new ``localizer.translations``)
+          misses the cache, rather than serving stale strings.
+        """
+
+        request = self.make_request()
+        translator = self.makeOne(request)
+        self.assertEqual(translator.translate('Hello'), u'fr: Hello')
+        reloaded = FakeTranslations(u'reloaded: ')
+        request.localizer.translations = reloaded
+        request.localizer.translator = None
+        self.assertEqual(translator.translate('Hello'), u'reloaded: Hello')
+        self.assertEqual(translator.translate('Hello'), u'reloaded: Hello')
+        self.assertEqual(reloaded.calls, 1)
+
@@ -18,6 +18,8 @@ class TestI18N(unittest.TestCase):
         self.mock_translate = Mock()
         self.mock_translate.return_value = 'Bonjour'
         Localizer.translate = self.mock_translate
+        from ..i18n import clear_translation_cache
+        clear_translation_cache()
     
     def tearDown(self):
         self._localizer.translate = self._original_translate
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for `pyramid_weblayer.markdown`."""
+
+import unittest
+
+class TestMarkdownRenderer(unittest.TestCase):
+    """Test py:class:`~pyramid_weblayer.markdown.MarkdownRenderer`."""
+    
+    def makeOne(self, **kwargs):
+        from ..markdown import MarkdownRenderer
+        return MarkdownRenderer(**kwargs)
+    
+    def test_non_ascii_byte_string(self):
+        """Utf-8 encoded byte strings render, and share the cache entry of
+          the equivalent unicode string.
+        """
+        
+        renderer = self.makeOne(extras=['tables'])
+        text = u'*café* ünïcode'
+        data = text.encode('utf-8')
+        self.assertEqual(renderer.get_key(data), renderer.get_key(text))
+        html = renderer.render(data)
+        self.assertEqual(html, u'<p><em>café</em> ünïcode</p>\n')
+        self.assertEqual(renderer.render(text), html)
+        self.assertEqual(renderer.cache.stats()['size'], 1)
+    
+
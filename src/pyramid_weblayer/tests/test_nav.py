@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for `pyramid_weblayer.nav`."""
+
+import unittest
+
+try: # pragma: no cover
+    from mock import Mock
+except: # pragma: no cover
+    pass
+
+# ``(request_path, paths, expected)``: each path is matched on its own, with
+# only '/' requiring an exact match.
+MULTI_PATH_CASES = (
+    ('/foo/bar', ('/', '/foo'), 'active'),
+    ('/foo/bar', ('/foo', '/'), 'active'),
+    ('/bar', ('/foo', '/'), ''),
+    ('/', ('/foo', '/'), 'active'),
+    ('/', ('/', '/foo'), 'active'),
+    ('/qux', ('/', '/foo'), ''),
+)
+
+class TestIsActive(unittest.TestCase):
+    """Test py:meth:`~pyramid_weblayer.nav.ActiveNavigationAdapter.is_active`
+      with several paths.
+    """
+    
+    def makeOne(self, request_path, matcher=None):
+        from pyramid.registry import Registry
+        from ..nav import ActiveNavigationAdapter
+        mock_request = Mock()
+        mock_request.registry = Registry()
+        mock_request.path = request_path
+        return ActiveNavigationAdapter(mock_request, matcher=matcher)
+    
+    def test_multiple_paths(self):
+        """Each path is matched on its own terms."""
+        
+        for request_path, paths, expected in MULTI_PATH_CASES:
+            nav = self.makeOne(request_path)
+            self.assertEqual(nav.is_active(*paths), expected,
+                    (request_path, paths))
+    
+    def test_multiple_paths_with_matcher(self):
+        """The precompiled matcher gives the same results."""
+        
+        from ..nav import NavigationMatcher
+        matcher = NavigationMatcher(['/', '/foo'])
+        for request_path, paths, expected in MULTI_PATH_CASES:
+            nav = self.makeOne(request_path, matcher=matcher)
+            self.assertEqual(nav.is_active(*paths), expected,
+                    (request_path, paths))
+    
+
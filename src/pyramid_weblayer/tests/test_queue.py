@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for `pyramid_weblayer.queue`."""
+
+import threading
+import time
+import unittest
+
+class FakePipeline(object):
+    """Buffer commands and run them against the ``FakeRedis`` on execute."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [getattr(self.redis, name)(*args, **kwargs)
+                for name, args, kwargs in commands]
+
+
+class FakeRedis(object):
+    """Minimal in memory, thread safe stand-in for the redis list commands."""
+
+    def __init__(self):
+        self.lists = {}
+        self.zsets = {}
+        self.lock = threading.Condition()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def rpush(self, key, *values):
+        with self.lock:
+            self.lists.setdefault(key, []).extend(values)
+            self.lock.notify_all()
+            return len(self.lists[key])
+
+    def lpop(self, key):
+        with self.lock:
+            items = self.lists.get(key)
+            return items.pop(0) if items else None
+
+    def lpush(self, key, *values):
+        with self.lock:
+            items = self.lists.setdefault(key, [])
+            for value in values:
+                items.insert(0, value)
+            self.lock.notify_all()
+            return len(items)
+
+    def lrem(self, key, count, value):
+        with self.lock:
+            items = self.lists.get(key, [])
+            if value in items:
+                items.remove(value)
+                return 1
+            return 0
+
+    def rpoplpush(self, src, dst):
+        with self.lock:
+            items = self.lists.get(src)
+            if not items:
+                return None
+            value = items.pop()
+            self.lists.setdefault(dst, []).insert(0, value)
+            return value
+
+    def brpoplpush(self, src, dst, timeout=0):
+        deadline = time.time() + timeout
+        with self.lock:
+            while not self.lists.get(src):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+            return self.rpoplpush(src, dst)
+
+    def zadd(self, key, mapping):
+        with self.lock:
+            self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, *members):
+        with self.lock:
+            zset = self.zsets.get(key, {})
+            return len([zset.pop(item) for item in members if item in zset])
+
+    def zrangebyscore(self, key, min, max):
+        with self.lock:
+            zset = self.zsets.get(key, {})
+            return sorted([k for k, v in zset.items() if min <= v <= max],
+                    key=zset.get)
+
+    def register_script(self, script):
+        """Emulate the ``PROMOTE_SCRIPT``, the only script the queue uses."""
+
+        def promote(keys, args):
+            delayed, channel = keys
+            now, limit, command = args
+            with self.lock:
+                due = self.zrangebyscore(delayed, float('-inf'), now)[:limit]
+                for member in due:
+                    sep = b'|' if isinstance(member, bytes) else '|'
+                    getattr(self, command)(channel, member.split(sep, 1)[1])
+                self.zrem(delayed, *due)
+                return len(due)
+        return promote
+
+    def llen(self, key):
+        with self.lock:
+            return len(self.lists.get(key, []))
+
+    def blpop(self, keys, timeout=0):
+        deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                for key in keys:
+                    if self.lists.get(key):
+                        return key, self.lists[key].pop(0)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+
+
+def fail_on_bad(body):
+    """Module level (i.e.: picklable) handler that fails on ``'bad'``."""
+
+    if body == 'bad':
+        raise ValueError(body)
+
+
+class TestQueueProcessor(unittest.TestCase):
+    """Test the logic of py:class:`~pyramid_weblayer.queue.QueueProcessor`."""
+
+    def makeOne(self, redis, handler, **kwargs):
+        from ..queue import QueueProcessor
+        kwargs.setdefault('timeout', 0.05)
+        return QueueProcessor(redis, ['c'], handler, **kwargs)
+
+    def run_until(self, processor, predicate, limit=5):
+        thread = threading.Thread(target=processor._start)
+        thread.start()
+        deadline = time.time() + limit
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.01)
+        processor.stop()
+        thread.join()
+
+    def test_batch_mode(self):
+        """Drains messages in batches."""
+
+        redis = FakeRedis()
+        redis.rpush('c', *range(10))
+        batches = []
+        processor = self.makeOne(redis, None, batch_size=4,
+                handle_batch=batches.append)
+        self.run_until(processor, lambda: sum(map(len, batches)) == 10)
+        self.assertEqual(batches, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_thread_pool(self):
+        """Handles messages concurrently, never exceeding the concurrency."""
+
+        redis = FakeRedis()
+        redis.rpush('c', *range(20))
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0, 'done': 0}
+        def handle(body):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.01)
+            with lock:
+                state['active'] -= 1
+                state['done'] += 1
+        processor = self.makeOne(redis, handle, concurrency=4)
+        self.run_until(processor, lambda: state['done'] == 20)
+        self.assertEqual(state['done'], 20)
+        self.assertTrue(1 < state['peak'] <= 4)
+
+    def test_thread_pool_requeues(self):
+        """Failed messages are requeued when handled by the pool."""
+
+        redis = FakeRedis()
+        redis.rpush('c', 'bad')
+        calls = []
+        def handle(body):
+            calls.append(body)
+            if len(calls) == 1:
+                raise ValueError(body)
+        processor = self.makeOne(redis, handle, concurrency=2,
+                should_requeue=True)
+        self.run_until(processor, lambda: len(calls) == 2)
+        self.assertEqual(calls, ['bad', 'bad'])
+
+    def test_process_pool_requeues(self):
+        """Failed messages are requeued when handled by a process pool."""
+
+        redis = FakeRedis()
+        redis.rpush('c', 'good', 'bad')
+        processor = self.makeOne(redis, fail_on_bad, concurrency=2,
+                pool_type='process', should_requeue=True)
+        self.run_until(processor, lambda: redis.llen('c') == 1)
+        self.assertEqual(redis.lists['c'], ['bad'])
+
+    def test_reliable_mode_acks(self):
+        """In reliable mode, handled messages are removed from the processing
+          list, as are failed ones (when not requeued).
+        """
+
+        redis = FakeRedis()
+        redis.lpush('c', 'a', 'bad', 'b')
+        handled = []
+        def handle(body):
+            fail_on_bad(body)
+            handled.append(body)
+        processor = self.makeOne(redis, handle, reliable=True, worker_id='w1')
+        self.run_until(processor, lambda: len(handled) == 2)
+        self.assertEqual(handled, ['a', 'b'])
+        self.assertEqual(redis.lists['c:processing:w1'], [])
+        self.assertEqual(redis.zsets['c:workers'].keys(), ['w1'])
+
+    def test_reliable_mode_reaps_dead_workers(self):
+        """Messages in flight when a worker dies are re-enqueued and handled
+          by another worker.
+        """
+
+        redis = FakeRedis()
+        redis.lpush('c', 'a', 'b')
+        # Worker 1 takes a message and then dies without acking it.
+        dead = self.makeOne(redis, None, reliable=True, worker_id='w1',
+                visibility_timeout=60)
+        self.assertEqual(dead._pop(), ('c', ['a']))
+        redis.zadd('c:workers', {'w1': time.time() - 120})
+        # Worker 2 reaps it.
+        handled = []
+        processor = self.makeOne(redis, handled.append, reliable=True,
+                worker_id='w2', visibility_timeout=60)
+        self.run_until(processor, lambda: len(handled) == 2)
+        self.assertEqual(sorted(handled), ['a', 'b'])
+        self.assertEqual(redis.lists['c:processing:w1'], [])
+        self.assertFalse('w1' in redis.zsets['c:workers'])
+
+    def test_reliable_mode_heartbeats_while_busy(self):
+        """A worker keeps heartbeating while a handler runs for longer than
+          the visibility timeout, so it isn't reaped by other workers.
+        """
+
+        redis = FakeRedis()
+        redis.lpush('c', 'slow')
+        handled = []
+        def handle(body):
+            time.sleep(0.5)
+            handled.append(body)
+        processor = self.makeOne(redis, handle, reliable=True, worker_id='w1',
+                visibility_timeout=0.2)
+        reaper = self.makeOne(redis, None, reliable=True, worker_id='w2',
+                visibility_timeout=0.2)
+        reaped = []
+        def reap_while_handling():
+            time.sleep(0.3)
+            reaped.append(reaper.reap())
+            return len(handled) == 1
+        self.run_until(processor, reap_while_handling)
+        self.assertEqual(handled, ['slow'])
+        self.assertEqual(reaped[0], 0)
+        self.assertEqual(redis.llen('c'), 0)
+
+    def test_metrics(self):
+        """Records throughput, latency, error and queue length metrics."""
+
+        from ..metrics import RegistrySink
+        redis = FakeRedis()
+        redis.rpush('c', 'a', 'bad', 'b')
+        sink = RegistrySink()
+        processor = self.makeOne(redis, fail_on_bad, metrics=sink,
+                should_requeue=True)
+        processor._sample()
+        self.run_until(processor, lambda: sink.counter('queue.messages') >= 3)
+        self.assertTrue(sink.counter('queue.messages') >= 3)
+        self.assertTrue(sink.counter('queue.errors') >= 1)
+        self.assertTrue(sink.counter('queue.requeued') >= 1)
+        self.assertTrue(sink.histogram('queue.handler')['count'] >= 3)
+        self.assertTrue(sink.histogram('queue.pop_wait')['count'] >= 3)
+        self.assertEqual(sink.snapshot()['gauges']['queue.length.c'], 3)
+
+    def test_delayed_jobs(self):
+        """Scheduled jobs are promoted onto the channel once they're due."""
+
+        from ..queue import schedule
+        redis = FakeRedis()
+        schedule(redis, 'c', 'later', delay=60)
+        schedule(redis, 'c', 'a', delay=-1)
+        schedule(redis, 'c', 'b', delay=-1)
+        handled = []
+        processor = self.makeOne(redis, handled.append, promote_delayed=True)
+        self.run_until(processor, lambda: len(handled) == 2)
+        self.assertEqual(sorted(handled), ['a', 'b'])
+        self.assertEqual(len(redis.zsets['c:delayed']), 1)
+
+    def test_delayed_bytes_round_trip(self):
+        """Byte string bodies, like retried messages, come out of the delayed
+          set as they went in.
+        """
+
+        from ..queue import add_attempts, schedule
+        redis = FakeRedis()
+        body = add_attempts(b'payload', 1)
+        schedule(redis, 'c', body, delay=-1)
+        handled = []
+        processor = self.makeOne(redis, handled.append, promote_delayed=True)
+        self.assertEqual(processor.promote(), 1)
+        self.assertEqual(redis.lists['c'], [body])
+        self.run_until(processor, lambda: handled)
+        self.assertEqual(handled, [b'payload'])
+
+    def test_retry_backoff(self):
+        """Failed messages are retried with backoff and then given up on."""
+
+        redis = FakeRedis()
+        redis.rpush('c', 'bad')
+        calls = []
+        def handle(body):
+            calls.append(body)
+            fail_on_bad(body)
+        processor = self.makeOne(redis, handle, should_requeue=True,
+                promote_delayed=True, promote_interval=0.01,
+                retry_backoff=0.01, max_retries=2)
+        self.run_until(processor, lambda: redis.llen('c:dead') == 1)
+        self.assertEqual(calls, ['bad', 'bad', 'bad'])
+        self.assertEqual(redis.lists['c:dead'], ['bad'])
+        self.assertEqual(redis.zsets['c:delayed'], {})
+
+    def test_retry_budget_per_message(self):
+        """Identical messages each get their own retries."""
+
+        redis = FakeRedis()
+        redis.rpush('c', 'bad', 'bad')
+        calls = []
+        def handle(body):
+            calls.append(body)
+            fail_on_bad(body)
+        processor = self.makeOne(redis, handle, should_requeue=True,
+                promote_delayed=True, promote_interval=0.01,
+                retry_backoff=0.01, max_retries=1)
+        self.run_until(processor, lambda: redis.llen('c:dead') == 2)
+        self.assertEqual(calls, ['bad'] * 4)
+        self.assertEqual(redis.lists['c:dead'], ['bad', 'bad'])
+
+    def test_weighted_channels(self):
+        """Pops are shared between busy channels in proportion to their
+          weights, rather than draining the first channel.
+        """
+
+        from ..queue import QueueProcessor
+        redis = FakeRedis()
+        redis.rpush('interactive', *range(100))
+        redis.rpush('bulk', *range(100))
+        processor = QueueProcessor(redis, ['bulk', 'interactive'], None,
+                timeout=0.05, weights={'interactive': 3, 'bulk': 1})
+        channels = []
+        for i in range(40):
+            channel, bodies = processor._pop()
+            processor._finish(channel, len(bodies))
+            channels.append(channel)
+        self.assertEqual(channels.count('interactive'), 30)
+        self.assertEqual(channels.count('bulk'), 10)
+
+    def test_channel_concurrency(self):
+        """A channel never has more than its cap of messages in flight."""
+
+        from ..queue import QueueProcessor
+        redis = FakeRedis()
+        redis.rpush('bulk', *['b{0}'.format(i) for i in range(12)])
+        redis.rpush('interactive', *['i{0}'.format(i) for i in range(12)])
+        lock = threading.Lock()
+        state = {'bulk': 0, 'peak': 0, 'done': 0}
+        def handle(body):
+            channel = 'bulk' if body.startswith('b') else 'interactive'
+            with lock:
+                if channel == 'bulk':
+                    state['bulk'] += 1
+                    state['peak'] = max(state['peak'], state['bulk'])
+            time.sleep(0.01)
+            with lock:
+                if channel == 'bulk':
+                    state['bulk'] -= 1
+                state['done'] += 1
+        processor = QueueProcessor(redis, ['bulk', 'interactive'], handle,
+                timeout=0.05, concurrency=6, batch_size=4,
+                channel_concurrency={'bulk': 2})
+        self.run_until(processor, lambda: state['done'] == 24)
+        self.assertEqual(state['done'], 24)
+        self.assertEqual(state['peak'], 2)
+
+    def test_start_async_is_deprecated(self):
+        """The old ``start(async=True)`` spelling still starts a thread, with
+          a deprecation warning.
+        """
+
+        import warnings
+        redis = FakeRedis()
+        redis.rpush('c', 'a')
+        handled = []
+        processor = self.makeOne(redis, handled.append)
+        kwargs = {'async': True}
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            processor.start(**kwargs)
+        try:
+            deadline = time.time() + 5
+            while not handled and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            processor.stop()
+        self.assertEqual(handled, ['a'])
+        self.assertEqual([w.category for w in caught], [DeprecationWarning])
+        self.assertRaises(TypeError, processor.start, asynch=True)
+
@@ -12,6 +12,14 @@ except: # pragma: no cover
 
 from pyramid_weblayer import request_logger
 from pyramid import testing
+from pyramid.registry import Registry
+
+def make_registry():
+    """Return a real, empty registry."""
+
+    registry = Registry()
+    registry.settings = {}
+    return registry
 
 
 # XXX Stub the handler so we have better control.
@@ -34,27 +42,88 @@ class TestRequestLogger(unittest.TestCase):
 
         # Stub our request handler.
         handler = StubHandler(return_status_code=200)
-        # Mock DynamoDB client.
-        client = Mock()
+        # In memory DynamoDB client.
+        client = request_logger.MemoryClient()
         # Create a dummy request and an empty registry.
         request = testing.DummyRequest(post={}, content_type='', body_file_seekable=Mock())
-        registry = Mock()
+        registry = make_registry()
         # Instantiate the client and call it with the mock request.
         tween_client = request_logger.RequestLoggerTweenFactory(handler, registry, client=client)
         # Let the client process the request.
         logger = tween_client(request)
+        tween_client.writer.flush()
         # Assert we didn't log as we don't have the right header keys and we have a 200.
-        assert not client.put_item.called
+        assert not client.items
         # Now let's put the right header key but status is still 200.
         request = testing.DummyRequest(
                 headers={'X_REQUEST_ID': '3rij'},
                 post={}, content_type='',
                 body_file_seekable=Mock())
         logger = tween_client(request)
-        assert not client.put_item.called
+        tween_client.writer.flush()
+        assert not client.items
         # And now we have an error with the right key, should log.
         handler = StubHandler(return_status_code=400)
         tween_client = request_logger.RequestLoggerTweenFactory(handler, registry, client=client)
         logger = tween_client(request)
+        tween_client.writer.flush()
         # Assert it was logged.
-        assert client.put_item.called
+        assert client.items[0]['request_id'] == '3rij'
+
+    def test_batch_writer(self):
+        """The writer writes in batches of 25 and sheds load when full."""
+
+        client = request_logger.MemoryClient()
+        writer = request_logger.BatchWriter(client, max_buffer_size=60)
+        for i in range(70):
+            writer.put({'request_id': i})
+        self.assertEqual(writer.flush(), 60)
+        self.assertEqual(client.batch_calls, 3)
+        self.assertEqual(client.items[0]['request_id'], 10)
+        stats = writer.stats()
+        self.assertEqual(stats['written'], 60)
+        self.assertEqual(stats['dropped'], 10)
+
+    def test_background_writer(self):
+        """The writer thread flushes a full batch in the background."""
+
+        import time
+        client = request_logger.MemoryClient()
+        writer = request_logger.BatchWriter(client, flush_interval=60)
+        writer.start()
+        for i in range(25):
+            writer.put({'request_id': i})
+        for _ in range(100):
+            if len(client.items) == 25:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(client.items), 25)
+        self.assertEqual(client.batch_calls, 1)
+
+    def test_stop_writes_buffered_rows(self):
+        """Stopping the writer thread writes what's still buffered."""
+
+        client = request_logger.MemoryClient()
+        writer = request_logger.BatchWriter(client, flush_interval=60)
+        writer.start()
+        for i in range(3):
+            writer.put({'request_id': i})
+        writer.stop(timeout=5)
+        self.assertEqual(len(client.items), 3)
+        self.assertFalse(writer._thread.is_alive())
+
+    def test_one_writer_per_registry(self):
+        """Tweens made for the same registry share a writer thread, which is
+          stopped at exit.
+        """
+
+        client = request_logger.MemoryClient()
+        registry = make_registry()
+        handler = StubHandler(return_status_code=200)
+        a = request_logger.RequestLoggerTweenFactory(handler, registry, client=client)
+        b = request_logger.RequestLoggerTweenFactory(handler, registry, client=client)
+        self.assertTrue(a.writer is b.writer)
+        self.assertTrue(a.writer in request_logger._writers)
+        a.writer.put({'request_id': 'x'})
+        request_logger._stop_at_exit()
+        self.assertEqual(client.items, [{'request_id': 'x'}])
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Functional tests for `pyramid_weblayer.serve` against a local http
+  stand-in for the static file host.
+"""
+
+import threading
+import unittest
+
+try: # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError: # py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from mock import Mock
+
+FILE_BODY = b''.join(bytes(bytearray([i % 256])) for i in range(1024 * 1024))
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve ``FILE_BODY`` with keep-alive and single range support."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        self.server.accept_encodings.append(self.headers.get('Accept-Encoding'))
+        if self.path.endswith('.css'):
+            self.send_response(200)
+            self.send_header('Content-Length', '5')
+            self.end_headers()
+            self.wfile.write(b'hello')
+            return
+        if not self.path.endswith('.bin'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = FILE_BODY
+        range_header = self.headers.get('Range')
+        if range_header:
+            start, end = range_header.split('=')[1].split('-')
+            start, end = int(start), int(end)
+            body = FILE_BODY[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                    start, end, len(FILE_BODY)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"stand-in"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = 0
+        self.hits = []
+        self.accept_encodings = []
+
+
+class TestServeSpec(unittest.TestCase):
+    """Test the logic of py:func:`~pyramid_weblayer.serve.get_serve_spec`."""
+
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        host, port = self.server.server_address
+        self.base_url = 'http://{0}:{1}/static/'.format(host, port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def makeRequest(self, headers=None):
+        request = Mock()
+        request.headers = headers or {}
+        request.registry.queryUtility.return_value = None
+        request.static_url = lambda spec: self.base_url + spec.split(':')[1]
+        return request
+
+    def makeOne(self, request, **kwargs):
+        from ..serve import get_serve_spec
+        from ..serve import PooledSession
+        kwargs.setdefault('session', PooledSession(pool_size=2))
+        return get_serve_spec(request, **kwargs)
+
+    def download(self, session, n):
+        """Serve and read ``n`` small files."""
+
+        for i in range(n):
+            serve = self.makeOne(self.makeRequest(), session=session)
+            response = serve('mypkg:data/file{0}.css'.format(i))
+            self.assertEqual(response.body, b'hello')
+
+    def test_streams_in_chunks(self):
+        """The file is served in bounded chunks with its upstream headers."""
+
+        serve = self.makeOne(self.makeRequest(), chunk_size=8192)
+        response = serve('mypkg:data/file.bin')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.headers['Content-Length'], str(len(FILE_BODY)))
+        self.assertEqual(response.headers['ETag'], '"stand-in"')
+        chunks = list(response.app_iter)
+        response.app_iter.close()
+        self.assertTrue(len(chunks) >= len(FILE_BODY) // 8192)
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 8192)
+        self.assertEqual(b''.join(chunks), FILE_BODY)
+
+    def test_range(self):
+        """Range requests are passed upstream and the partial content back."""
+
+        request = self.makeRequest(headers={'Range': 'bytes=100-199'})
+        response = self.makeOne(request)('mypkg:data/file.bin')
+        self.assertEqual(response.status_int, 206)
+        self.assertEqual(response.headers['Content-Range'],
+                'bytes 100-199/{0}'.format(len(FILE_BODY)))
+        self.assertEqual(response.body, FILE_BODY[100:200])
+
+    def test_accept_encoding(self):
+        """The client's ``Accept-Encoding`` is passed upstream, rather than
+          the ``requests`` default, as the body is passed through undecoded.
+        """
+
+        self.makeOne(self.makeRequest())('mypkg:data/file.css')
+        request = self.makeRequest(headers={'Accept-Encoding': 'br'})
+        self.makeOne(request)('mypkg:data/file.css')
+        self.assertEqual(self.server.accept_encodings, ['identity', 'br'])
+
+    def test_not_found(self):
+        """A missing upstream file is a 404."""
+
+        response = self.makeOne(self.makeRequest())('mypkg:data/missing.txt')
+        self.assertEqual(response.status_int, 404)
+
+    def test_pooled_session_reuses_connections(self):
+        """Downloads share a keep-alive connection, rather than making a new
+          connection per download.
+        """
+
+        import requests
+        from ..serve import PooledSession
+        n = 20
+        self.download(requests, n)
+        self.assertEqual(self.server.connections, n)
+        self.server.connections = 0
+        self.download(PooledSession(), n)
+        self.assertEqual(self.server.connections, 1)
+
+    def makeLocalRequest(self, **kwargs):
+        from pyramid.request import Request
+        from pyramid.testing import setUp
+        config = setUp()
+        self.addCleanup(config.end)
+        config.add_static_view('static', 'pyramid_weblayer.tests:')
+        request = Request.blank('/', **kwargs)
+        request.registry = config.registry
+        return config, request
+
+    def test_local_files_are_served_from_disk(self):
+        """Specs that resolve to a file on disk are served without a round
+          trip to the static file host, with range support.
+        """
+
+        from pkg_resources import resource_string
+        data = resource_string('pyramid_weblayer.tests', 'test_i18n.mako')
+        config, request = self.makeLocalRequest(headers={'Range': 'bytes=0-4'})
+        response = self.makeOne(request)('pyramid_weblayer.tests:test_i18n.mako')
+        self.assertEqual(response.headers['Content-Disposition'],
+                'attachment; filename="test_i18n.mako"')
+        partial = request.get_response(response)
+        self.assertEqual(partial.status_int, 206)
+        self.assertEqual(partial.body, data[:5])
+        self.assertEqual(self.server.hits, [])
+
+    def test_local_files_are_overridable(self):
+        """Asset overrides are applied to files served from disk."""
+
+        from pkg_resources import resource_string
+        data = resource_string('pyramid_weblayer', 'templates/form.mako')
+        config, request = self.makeLocalRequest()
+        config.override_asset(to_override='pyramid_weblayer.tests:test_i18n.mako',
+                override_with='pyramid_weblayer:templates/form.mako')
+        response = self.makeOne(request)('pyramid_weblayer.tests:test_i18n.mako')
+        self.assertEqual(request.get_response(response).body, data)
+
+    def test_local_files_cant_escape_the_static_view(self):
+        """Paths outside the static view's directory aren't served."""
+
+        from ..serve import get_local_path
+        config, request = self.makeLocalRequest()
+        for spec in ('pyramid_weblayer.tests:../serve.py',
+                'pyramid_weblayer.tests:../../setup.py',
+                'pyramid_weblayer.tests:/etc/passwd'):
+            self.assertEqual(get_local_path(request, spec), None)
+            response = self.makeOne(request)(spec)
+            self.assertEqual(response.status_int, 404)
+        self.assertEqual(self.server.hits, [])
+
+    def test_unregistered_specs_arent_served(self):
+        """Files that aren't under a registered static view aren't served."""
+
+        from ..serve import get_local_path
+        config, request = self.makeLocalRequest()
+        spec = 'pyramid_weblayer:serve.py'
+        self.assertEqual(get_local_path(request, spec), None)
+        self.assertEqual(self.makeOne(request)(spec).status_int, 404)
+        self.assertEqual(self.server.hits, [])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for `pyramid_weblayer.snip`."""
+
+import unittest
+
+ARTICLE = (u'<h2>Section</h2><p>Lorem <em>ipsum</em> dolor sit amet, '
+        u'<a href="/x">consectetur</a> adipiscing&nbsp;elit. '
+        u'Sed do <strong>eiusmod</strong> tempor incididunt.</p>\n')
+
+class TestSnipHTML(unittest.TestCase):
+    """Test the streaming ``snip_html`` against converting the whole document."""
+    
+    def snip_whole(self, html, n):
+        import html2text
+        from ..snip import snip_text
+        handler = html2text.HTML2Text()
+        handler.ignore_links = True
+        handler.ignore_images = True
+        return snip_text(handler.handle(html), n=n)
+    
+    def test_same_output(self):
+        """Stopping early gives the same snippet as converting everything."""
+        
+        from ..htmltext import HTMLToText
+        from ..snip import snip_text
+        html = ARTICLE * 20
+        for n in (1, 5, 40, 140, 500, 100000):
+            for chunk_size in (1, 7, 2048):
+                text = HTMLToText().convert_prefix(html, n, chunk_size=chunk_size)
+                self.assertEqual(snip_text(text, n=n), self.snip_whole(html, n))
+    
+    def test_large_body(self):
+        """Snipping a 100KB+ body only parses its start."""
+        
+        import html2text
+        from ..htmltext import HTMLToText
+        from ..snip import snip_html, snip_text
+        html = ARTICLE * 1000
+        self.assertTrue(len(html) > 100 * 1024)
+        
+        fed = []
+        class RecordingHandler(html2text.HTML2Text):
+            def feed(self, data):
+                fed.append(data)
+                return html2text.HTML2Text.feed(self, data)
+        
+        engine = HTMLToText(handler_cls=RecordingHandler)
+        snippet = snip_text(engine.convert_prefix(html, 140), n=140)
+        self.assertEqual(snippet, self.snip_whole(html, 140))
+        self.assertEqual(snip_html(html), snippet)
+        self.assertTrue(sum(len(chunk) for chunk in fed) < 2 * 2048)
+    
+    def test_snip_text_long_text(self):
+        """``snip_text`` doesn't split the whole of a long text."""
+        
+        from .. import snip
+        original = snip.WORD
+        matched = []
+        class RecordingPattern(object):
+            def finditer(self, text):
+                for match in original.finditer(text):
+                    matched.append(match)
+                    yield match
+        
+        snip.WORD = RecordingPattern()
+        try:
+            snippet = snip.snip_text(u'word ' * 100000, n=20)
+        finally:
+            snip.WORD = original
+        self.assertEqual(snippet, u'word word word word …')
+        self.assertEqual(len(matched), 5)
+    
+
+
+
+class TestBulk(unittest.TestCase):
+    """Test the bulk snip and flatten functions."""
+    
+    def test_matches_item_by_item(self):
+        """Bulk results match calling the functions item by item."""
+        
+        from ..flat import as_flat_string, as_flat_strings
+        from ..snip import snip_html, snip_htmls
+        htmls = [ARTICLE * i for i in range(1, 20)]
+        self.assertEqual(snip_htmls(htmls, n=50),
+                [snip_html(item, n=50) for item in htmls])
+        self.assertEqual(as_flat_strings(htmls),
+                [as_flat_string(item) for item in htmls])
+    
+    def test_process_pool(self):
+        """Large lists can be fanned out across a process pool."""
+        
+        import multiprocessing
+        from ..snip import snip_html, snip_htmls
+        htmls = [ARTICLE * i for i in range(1, 200)]
+        pool = multiprocessing.Pool(2)
+        try:
+            snippets = snip_htmls(htmls, n=50, pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(snippets, [snip_html(item, n=50) for item in htmls])
+    
+
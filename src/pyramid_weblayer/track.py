@@ -4,7 +4,10 @@
   method which fires the equivalent of a client side ``ga._trackEvent(...)``
   request to google analytics.
   
-  The request is joined to the transaction and made in a background thread.
+  The hit is joined to the transaction and, after commit, buffered by the
+  process wide ``TrackingDispatcher``, which sends it in a batch from its
+  background thread. Set ``track.batch = false`` to instead make each request
+  using ``call_in_background``.
 """
 
 __all__ = [
@@ -20,11 +23,22 @@ from pyga.entities import Session
 from pyga.entities import Visitor
 from pyga.requests import Tracker
 
+from pyramid.settings import asbool
+
+from .cache import LRUCache
+from .dispatch import get_dispatcher
 from .tx import call_in_background
+from .tx import join_to_transaction
+
+# Key the per request ``tracker, session, visitor`` are stored under.
+ENVIRON_KEY = 'pyramid_weblayer.track.pyga'
 
 class PyGAFactory(object):
     """Shared boilerplate to get configured ``tracker, session, visitor``
-      instances from the current request::
+      instances from the current request.
+      
+      The trackers are shared between requests (one per tracking id and
+      host) and the session and visitor are built once per request.
       
       Setup::
       
@@ -32,6 +46,8 @@ class PyGAFactory(object):
           >>> mock_request = Mock()
           >>> mock_request.registry.settings = {'gae.tracking_id': '...'}
           >>> mock_request.session = {}
+          >>> mock_request.environ = {}
+          >>> mock_request.host = 'example.com'
           >>> mock_session_cls = Mock()
           >>> mock_tracker_cls = Mock()
           >>> mock_visitor_cls = Mock()
@@ -46,9 +62,51 @@ class PyGAFactory(object):
           >>> assert session is mock_session_cls.return_value
           >>> assert visitor is mock_visitor_cls.return_value
       
+      Builds the session and visitor once per request::
+      
+          >>> factory(mock_request) == (tracker, session, visitor)
+          True
+          >>> mock_session_cls.call_count, mock_visitor_cls.call_count
+          (1, 1)
+      
+      And the tracker once per tracking id and host::
+      
+          >>> mock_request.environ = {}
+          >>> tracker is factory(mock_request)[0]
+          True
+          >>> mock_tracker_cls.call_count, mock_session_cls.call_count
+          (1, 2)
+      
     """
     
     def __call__(self, request):
+        """Return the pyga ``tracker, session, visitor`` for the ``request``."""
+        
+        entities = request.environ.get(ENVIRON_KEY)
+        if entities is None:
+            entities = self.build(request)
+            request.environ[ENVIRON_KEY] = entities
+        return entities
+    
+    def __init__(self, session_cls=None, tracker_cls=None, visitor_cls=None,
+            cache_size=1024):
+        """Initialise with the dependencies provided."""
+        
+        # Compose.
+        if session_cls is None: #pragma: no cover
+            session_cls = Session
+        if tracker_cls is None: #pragma: no cover
+            tracker_cls = Tracker
+        if visitor_cls is None: #pragma: no cover
+            visitor_cls = Visitor
+        
+        # Assign.
+        self.session_cls = session_cls
+        self.tracker_cls = tracker_cls
+        self.visitor_cls = visitor_cls
+        self.trackers = LRUCache(max_size=cache_size)
+    
+    def build(self, request):
         """Instantiate and return pyga ``tracker, session, visitor`` instances."""
         
         # Prepare the tracking id, session id and utm cookies.
@@ -60,8 +118,10 @@ class PyGAFactory(object):
         utma_cookie = request.cookies.get('__utma', None)
         utmb_cookie = request.cookies.get('__utmb', None)
         
-        # Instantiate the tracker, session and visitor.
-        tracker = self.tracker_cls(gae_tracking_id, request.host)
+        # Get the shared tracker and instantiate the session and visitor.
+        host = request.host
+        tracker = self.trackers.get_or_set((gae_tracking_id, host),
+                lambda: self.tracker_cls(gae_tracking_id, host))
         session = self.session_cls()
         session.session_id = gae_session_id
         if utmb_cookie:
@@ -74,25 +134,12 @@ class PyGAFactory(object):
         # Return the tuple.
         return tracker, session, visitor
     
-    def __init__(self, session_cls=None, tracker_cls=None, visitor_cls=None):
-        """Initialise with the dependencies provided."""
-        
-        # Compose.
-        if session_cls is None: #pragma: no cover
-            session_cls = Session
-        if tracker_cls is None: #pragma: no cover
-            tracker_cls = Tracker
-        if visitor_cls is None: #pragma: no cover
-            visitor_cls = Visitor
-        
-        # Assign.
-        self.session_cls = session_cls
-        self.tracker_cls = tracker_cls
-        self.visitor_cls = visitor_cls
-    
 
 
-def get_track_event(request, call_in_bg=None, event_cls=None, factory_cls=None):
+pyga_factory = PyGAFactory()
+
+def get_track_event(request, call_in_bg=None, event_cls=None, factory=None,
+        get_dispatch=None, join=None):
     """Return a request method that uses the pyga library to track a custom
       event with google analytics.
       
@@ -102,15 +149,13 @@ def get_track_event(request, call_in_bg=None, event_cls=None, factory_cls=None):
           >>> mock_call_in_bg = Mock()
           >>> mock_event_cls = Mock()
           >>> mock_event_cls.return_value = '<event>'
-          >>> mock_factory_cls = Mock()
           >>> mock_factory = Mock()
           >>> mock_tracker = Mock()
           >>> mock_factory.return_value = (mock_tracker, '<session>', '<visitor>')
-          >>> mock_factory_cls.return_value = mock_factory
           >>> mock_request = Mock()
           >>> track_event = get_track_event(mock_request,
           ...         call_in_bg=mock_call_in_bg, event_cls=mock_event_cls,
-          ...         factory_cls=mock_factory_cls)
+          ...         factory=mock_factory)
       
       Tracks the event::
       
@@ -124,19 +169,36 @@ def get_track_event(request, call_in_bg=None, event_cls=None, factory_cls=None):
           >>> mock_call_in_bg = Mock()
           >>> track_event = get_track_event(mock_request,
           ...         call_in_bg=mock_call_in_bg, event_cls=mock_event_cls,
-          ...         factory_cls=mock_factory_cls)
+          ...         factory=mock_factory)
           >>> return_value = track_event('cat', 'act')
           >>> assert not mock_call_in_bg.called
       
+      By default, joins the event to the transaction to be buffered by the
+      dispatcher::
+      
+          >>> mock_request.registry.settings = {}
+          >>> mock_get_dispatch = Mock()
+          >>> mock_join = Mock()
+          >>> track_event = get_track_event(mock_request, event_cls=mock_event_cls,
+          ...         factory=mock_factory, get_dispatch=mock_get_dispatch,
+          ...         join=mock_join)
+          >>> return_value = track_event('cat', 'act')
+          >>> mock_get_dispatch.assert_called_with({})
+          >>> mock_join.assert_called_with(
+          ...         mock_get_dispatch.return_value.track_event, mock_tracker,
+          ...         '<event>', '<session>', '<visitor>')
+      
     """
     
     # Compose.
-    if call_in_bg is None: #pragma: no cover
-        call_in_bg = call_in_background
+    if get_dispatch is None: #pragma: no cover
+        get_dispatch = get_dispatcher
+    if join is None: #pragma: no cover
+        join = join_to_transaction
     if event_cls is None: #pragma: no cover
         event_cls = Event
-    if factory_cls is None: #pragma: no cover
-        factory_cls = PyGAFactory
+    if factory is None: #pragma: no cover
+        factory = pyga_factory
     
     def track_event(category, action, label=None, value=None, noninteraction=False):
         """Join a call to ping google analytics with the given event in a background thread
@@ -148,20 +210,25 @@ def get_track_event(request, call_in_bg=None, event_cls=None, factory_cls=None):
         if settings.get('mode', None) in ['development', 'testing']:
             return
         
-        # Instantiate configured pyga ``tracker``, ``session`` and ``visitor``s.
-        factory = factory_cls()
+        # Get the configured pyga ``tracker``, ``session`` and ``visitor``.
         tracker, session, visitor = factory(request)
         
         # Create the event to track.
         event = event_cls(category=category, action=action, label=label,
                 value=value, noninteraction=noninteraction)
         
-        # Join a background call to track the event to the current transaction.
-        return call_in_bg(tracker.track_event, args=(event, session, visitor))
+        # Either make the request in a background thread, if explicitly
+        # configured to, or hand the event to the batching dispatcher.
+        if call_in_bg is not None or not asbool(settings.get('track.batch', True)):
+            bg = call_in_bg or call_in_background
+            return bg(tracker.track_event, args=(event, session, visitor))
+        dispatcher = get_dispatch(settings)
+        return join(dispatcher.track_event, tracker, event, session, visitor)
     
     return track_event
 
-def get_track_page(request, call_in_bg=None, page_cls=None, factory_cls=None):
+def get_track_page(request, call_in_bg=None, page_cls=None, factory=None,
+        get_dispatch=None, join=None):
     """Return a request method that uses the pyga library to track a page view
       (or a virtual page view) with google analytics.
       
@@ -171,15 +238,13 @@ def get_track_page(request, call_in_bg=None, page_cls=None, factory_cls=None):
           >>> mock_call_in_bg = Mock()
           >>> mock_page_cls = Mock()
           >>> mock_page_cls.return_value = '<page>'
-          >>> mock_factory_cls = Mock()
           >>> mock_factory = Mock()
           >>> mock_tracker = Mock()
           >>> mock_factory.return_value = (mock_tracker, '<session>', '<visitor>')
-          >>> mock_factory_cls.return_value = mock_factory
           >>> mock_request = Mock()
           >>> track_page = get_track_page(mock_request,
           ...         call_in_bg=mock_call_in_bg, page_cls=mock_page_cls,
-          ...         factory_cls=mock_factory_cls)
+          ...         factory=mock_factory)
       
       Tracks the page view::
       
@@ -194,19 +259,35 @@ def get_track_page(request, call_in_bg=None, page_cls=None, factory_cls=None):
           >>> mock_call_in_bg = Mock()
           >>> track_page = get_track_page(mock_request,
           ...         call_in_bg=mock_call_in_bg, page_cls=mock_page_cls,
-          ...         factory_cls=mock_factory_cls)
+          ...         factory=mock_factory)
           >>> return_value = track_page('/foo?baz=bar')
           >>> assert not mock_call_in_bg.called
       
+      By default, joins the page view to the transaction to be buffered by the
+      dispatcher::
+      
+          >>> mock_request.registry.settings = {}
+          >>> mock_get_dispatch = Mock()
+          >>> mock_join = Mock()
+          >>> track_page = get_track_page(mock_request, page_cls=mock_page_cls,
+          ...         factory=mock_factory, get_dispatch=mock_get_dispatch,
+          ...         join=mock_join)
+          >>> return_value = track_page('/foo')
+          >>> mock_join.assert_called_with(
+          ...         mock_get_dispatch.return_value.track_pageview, mock_tracker,
+          ...         '<page>', '<session>', '<visitor>')
+      
     """
     
     # Compose.
-    if call_in_bg is None: #pragma: no cover
-        call_in_bg = call_in_background
+    if get_dispatch is None: #pragma: no cover
+        get_dispatch = get_dispatcher
+    if join is None: #pragma: no cover
+        join = join_to_transaction
     if page_cls is None: #pragma: no cover
         page_cls = Page
-    if factory_cls is None: #pragma: no cover
-        factory_cls = PyGAFactory
+    if factory is None: #pragma: no cover
+        factory = pyga_factory
     
     def track_page(path):
         """Join a call to ping google analytics with the given event in a background thread
@@ -218,15 +299,19 @@ def get_track_page(request, call_in_bg=None, page_cls=None, factory_cls=None):
         if settings.get('mode', None) in ['development', 'testing']:
             return
         
-        # Instantiate configured pyga ``tracker``, ``session`` and ``visitor``s.
-        factory = factory_cls()
+        # Get the configured pyga ``tracker``, ``session`` and ``visitor``.
         tracker, session, visitor = factory(request)
         
         # Create the page to track.
         page = page_cls(path)
         
-        # Join a background call to track the event to the current transaction.
-        return call_in_bg(tracker.track_pageview, args=(page, session, visitor))
+        # Either make the request in a background thread, if explicitly
+        # configured to, or hand the page view to the batching dispatcher.
+        if call_in_bg is not None or not asbool(settings.get('track.batch', True)):
+            bg = call_in_bg or call_in_background
+            return bg(tracker.track_pageview, args=(page, session, visitor))
+        dispatcher = get_dispatch(settings)
+        return join(dispatcher.track_pageview, tracker, page, session, visitor)
     
     return track_page
 
@@ -7,9 +7,10 @@
 import logging
 logger = logging.getLogger(__name__)
 
-import threading
 import transaction
 
+from .executor import get_executor
+
 def _handle_commit(tx_succeeded, *args_list, **kwargs):
     """Handle a successful commit by calling the callable registered as an after
       commit hook.
@@ -171,22 +172,50 @@ def join_after_transaction(callable_, *args, **kwargs):
 # Default the main ``join_to_transaction`` to use an after commit hook.
 join_to_transaction = join_after_transaction
 
-def call_in_background(target, args=None, kwargs=None, join=None, thread_cls=None):
+def call_in_background(target, args=None, kwargs=None, join=None, thread_cls=None,
+        executor=None):
     """Helper function for the common use case of firing and forgetting a
-      function call in a background thread.
+      function call in the background, iff the current transaction succeeds.
+      
+      Setup::
+      
+          >>> from mock import Mock
+          >>> mock_join = Mock()
+          >>> mock_executor = Mock()
+      
+      By default, joins a call to submit the job to the process wide
+      (bounded) background executor::
+      
+          >>> _ = call_in_background('target', args=('a',), join=mock_join,
+          ...         executor=mock_executor)
+          >>> mock_join.assert_called_with(mock_executor.submit, 'target',
+          ...         args=('a',), kwargs=None)
+      
+      Passing a ``thread_cls`` starts a dedicated thread instead::
+      
+          >>> mock_thread_cls = Mock()
+          >>> _ = call_in_background('target', kwargs={'b': 1}, join=mock_join,
+          ...         thread_cls=mock_thread_cls)
+          >>> mock_thread_cls.assert_called_with(target='target', kwargs={'b': 1})
+          >>> mock_join.assert_called_with(mock_thread_cls.return_value.start)
+      
     """
     
     # Compose.
     if join is None:
         join = join_to_transaction
-    if thread_cls is None:
-        thread_cls = threading.Thread
     
-    thread_kwargs = {}
-    if args is not None:
-        thread_kwargs['args'] = args
-    if kwargs is not None:
-        thread_kwargs['kwargs'] = kwargs
-    thread = thread_cls(target=target, **thread_kwargs)
-    return join(thread.start)
-
+    # If explicitly asked to, start a dedicated thread.
+    if thread_cls is not None:
+        thread_kwargs = {}
+        if args is not None:
+            thread_kwargs['args'] = args
+        if kwargs is not None:
+            thread_kwargs['kwargs'] = kwargs
+        thread = thread_cls(target=target, **thread_kwargs)
+        return join(thread.start)
+    
+    # Otherwise submit to the bounded executor.
+    if executor is None:
+        executor = get_executor()
+    return join(executor.submit, target, args=args, kwargs=kwargs)